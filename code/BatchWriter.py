@@ -0,0 +1,270 @@
+"""
+Batched Neo4j writes.
+Rows are collected per statement and written with UNWIND, one transaction per flush,
+so a batch of pull requests costs a handful of round trips instead of dozens per pull request.
+"""
+import time
+from collections import OrderedDict
+from Fingerprints import fingerprint
+
+class BatchWriter(object):
+    """
+    Collects parameter rows for named cypher statements and runs them all in one transaction.
+    Statements run in the order they were added so nodes are merged before they are linked.
+    With a fingerprint store, a record whose rows hash the same as when its unit was last
+    written is dropped, the new fingerprint is recorded once the flush commits.
+
+    :param Graph graph:
+        py2neo graph
+    :param int batch_size:
+        number of records to collect before flushing
+    :param function on_flush:
+        called with the units passed to record_done once their rows are committed
+    :param FingerprintStore fingerprints:
+        skips records that have not changed, None writes everything
+    """
+
+    #fingerprints are stored under this kind, None turns them off for the writer
+    FINGERPRINT_KIND = None
+
+    def __init__(self, graph, batch_size=500, on_flush=None, fingerprints=None):
+        self.graph = graph
+        self.batch_size = max(1, batch_size)
+        self.on_flush = on_flush
+        self.fingerprints = fingerprints if self.FINGERPRINT_KIND is not None else None
+        self._statements = OrderedDict()
+        self._rows = {}
+        self._units = []
+        self._record_start = {}
+        self._digests = []
+        self.unchanged = 0
+        self.pending = 0
+        self.flushes = 0
+        self.records = 0
+        self.rows_written = 0
+        self.seconds = 0.0
+
+    def add_statement(self, name, cypher):
+        """
+        :param string cypher:
+            statement that reads its rows from the $rows parameter, usually UNWIND $rows AS row ...
+        """
+        self._statements[name] = cypher
+        self._rows[name] = []
+        self._record_start[name] = 0
+
+    def add(self, name, row):
+        """
+        queues one parameter row for a statement
+        """
+        self._rows[name].append(row)
+
+    def record_done(self, unit=None):
+        """
+        Called once all rows of a record are queued, flushes when the batch is full.
+        :param unit: handed to on_flush once the record is committed, such as a pull request id
+        """
+        if unit is not None:
+            self._units.append(unit)
+            if self.fingerprints is not None:
+                self._check_fingerprint(unit)
+        self._mark_record_start()
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        writes every queued row in a single transaction
+        """
+        if not any(self._rows.values()):
+            self.pending = 0
+            self._done(self._units)
+            return
+        start = time.time()
+        transaction = self.graph.begin()
+        try:
+            for name, cypher in self._statements.items():
+                rows = self._rows[name]
+                if rows:
+                    transaction.run(cypher, rows=rows)
+            transaction.commit()
+        except Exception:
+            transaction.rollback()
+            raise
+        self.flushes += 1
+        self.records += self.pending
+        self.rows_written += sum(len(rows) for rows in self._rows.values())
+        self.seconds += time.time() - start
+        for rows in self._rows.values():
+            del rows[:]
+        self._mark_record_start()
+        self.pending = 0
+        if self._digests:
+            self.fingerprints.record(self.FINGERPRINT_KIND, self._digests)
+            self._digests = []
+        self._done(self._units)
+
+    def _mark_record_start(self):
+        for name, rows in self._rows.items():
+            self._record_start[name] = len(rows)
+
+    def _check_fingerprint(self, unit):
+        """
+        drops the rows of the record just finished when they match the last write of the unit
+        """
+        record = [(name, rows[self._record_start[name]:]) for name, rows in self._rows.items()
+                  if len(rows) > self._record_start[name]]
+        if not record:
+            return
+        digest = fingerprint(record)
+        if self.fingerprints.unchanged(self.FINGERPRINT_KIND, unit, digest):
+            for name, rows in self._rows.items():
+                del rows[self._record_start[name]:]
+            self.unchanged += 1
+        else:
+            self._digests.append((unit, digest))
+
+    def _done(self, units):
+        self._units = []
+        if units and self.on_flush is not None:
+            self.on_flush(units)
+
+    def summary(self):
+        """
+        :returns: string suitable for printing at the end of a crawl
+        """
+        text = "Neo4j batches: {0} records: {1} rows: {2} ({3:.1f}s)".format(self.flushes,
+                                                                            self.records,
+                                                                            self.rows_written,
+                                                                            self.seconds)
+        if self.fingerprints is not None:
+            text += " unchanged, not written: {0}".format(self.unchanged)
+        return text
+
+class PullRequestBatchWriter(BatchWriter):
+    """
+    Pull requests with their repository, reviewers, creator and linked work items.
+    Relationship types match what the py2neo models create.
+    Every endpoint is merged, an unchanged pull request is never written again
+    so an edge skipped for a missing node would never be retried.
+    """
+
+    FINGERPRINT_KIND = "pull_request"
+
+    def __init__(self, graph, batch_size=500, on_flush=None, fingerprints=None):
+        super().__init__(graph, batch_size, on_flush, fingerprints)
+        self.add_statement("pull_requests", """
+            UNWIND $rows AS row
+            MERGE (pr:PullRequest {Id: row.Id})
+            SET pr += row.props""")
+        self.add_statement("repositories", """
+            UNWIND $rows AS row
+            MATCH (pr:PullRequest {Id: row.Id})
+            MERGE (repo:Repository {Id: row.RepositoryId})
+            MERGE (pr)-[:FOR_REPOSITORY]->(repo)""")
+        self.add_statement("reviewers", """
+            UNWIND $rows AS row
+            MATCH (pr:PullRequest {Id: row.Id})
+            MERGE (person:Person {Id: row.PersonId})
+            MERGE (pr)-[:REVIEWED_BY]->(person)""")
+        self.add_statement("created_by", """
+            UNWIND $rows AS row
+            MATCH (pr:PullRequest {Id: row.Id})
+            MERGE (person:Person {Id: row.PersonId})
+            MERGE (pr)-[:CREATED_BY]->(person)""")
+        self.add_statement("work_items", """
+            UNWIND $rows AS row
+            MATCH (pr:PullRequest {Id: row.Id})
+            MERGE (work_item:WorkItem {Id: row.WorkItemId})
+            MERGE (work_item)-[:LINKED_TO]->(pr)""")
+
+class CommentBatchWriter(BatchWriter):
+    """
+    Pull request threads and their comments, parent comments and authors.
+    Relationship types match what the py2neo models create.
+    One record is every thread and comment of a pull request.
+    """
+
+    FINGERPRINT_KIND = "pull_request_comments"
+
+    def __init__(self, graph, batch_size=50, on_flush=None, fingerprints=None):
+        super().__init__(graph, batch_size, on_flush, fingerprints)
+        self.add_statement("threads", """
+            UNWIND $rows AS row
+            MERGE (thread:PullRequestThread {Id: row.Id})
+            SET thread += row.props
+            WITH thread, row
+            MATCH (pr:PullRequest {Id: row.PullRequestId})
+            MERGE (thread)-[:PART_OF]->(pr)""")
+        self.add_statement("comments", """
+            UNWIND $rows AS row
+            MERGE (comment:Comment {Id: row.Id})
+            SET comment += row.props
+            WITH comment, row
+            MATCH (thread:PullRequestThread {Id: row.ThreadId})
+            MERGE (comment)-[:PART_OF]->(thread)""")
+        self.add_statement("parents", """
+            UNWIND $rows AS row
+            MATCH (comment:Comment {Id: row.Id})
+            MERGE (parent:Comment {Id: row.ParentId})
+            MERGE (comment)-[:PARENT_COMMENT]->(parent)""")
+        self.add_statement("authors", """
+            UNWIND $rows AS row
+            MATCH (comment:Comment {Id: row.Id})
+            MERGE (person:Person {Id: row.PersonId})
+            MERGE (comment)-[:AUTHOR]->(person)""")
+
+class WorkItemBatchWriter(BatchWriter):
+    """
+    Work items with their project and people, and the links between them.
+    Link statements are added per link type as they are first seen,
+    cypher can't take a relationship type as a parameter.
+    Every work item and every link is a record of its own, so each is fingerprinted on its own.
+    """
+
+    FINGERPRINT_KIND = "work_item_links"
+
+    def __init__(self, graph, batch_size=500, on_flush=None, fingerprints=None):
+        super().__init__(graph, batch_size, on_flush, fingerprints)
+        self.add_statement("work_items", """
+            UNWIND $rows AS row
+            MERGE (work_item:WorkItem {Id: row.Id})
+            SET work_item += row.props""")
+        self.add_statement("projects", """
+            UNWIND $rows AS row
+            MATCH (work_item:WorkItem {Id: row.Id})
+            MATCH (proj:Project {Id: row.ProjectId})
+            MERGE (work_item)-[:FOR_PROJECT]->(proj)""")
+        self.add_statement("created_by", """
+            UNWIND $rows AS row
+            MATCH (work_item:WorkItem {Id: row.Id})
+            MATCH (person:Person {Id: row.PersonId})
+            MERGE (work_item)-[:CREATED_BY]->(person)""")
+        self.add_statement("assigned_to", """
+            UNWIND $rows AS row
+            MATCH (work_item:WorkItem {Id: row.Id})
+            MATCH (person:Person {Id: row.PersonId})
+            MERGE (work_item)-[:ASSIGNED_TO]->(person)""")
+
+    def work_item_done(self, work_item_id):
+        """
+        ends the record of a work item queued with its project and people
+        """
+        self.record_done("work_item:" + work_item_id)
+
+    def add_link(self, link_type, source_id, target_id, properties):
+        """
+        queues a link between two work items as a record of its own,
+        both work items must be queued or already in Neo4j
+        """
+        name = "link:" + link_type
+        if name not in self._rows:
+            self.add_statement(name, """
+            UNWIND $rows AS row
+            MATCH (source:WorkItem {Id: row.SourceId})
+            MATCH (target:WorkItem {Id: row.TargetId})
+            MERGE (source)-[link:`%s`]->(target)
+            SET link += row.props""" % link_type.replace("`", "``"))
+        self.add(name, {"SourceId": source_id, "TargetId": target_id, "props": properties})
+        self.record_done("link:{0}:{1}:{2}".format(link_type, source_id, target_id))
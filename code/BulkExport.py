@@ -0,0 +1,482 @@
+"""
+Bulk load mode for the first import of a large VSTS collection.
+Maps the cached VSTS responses to node and relationship csv files using the
+same mappers and models as the crawlers, then loads them with LOAD CSV and
+periodic commit, or hands them to neo4j-admin import for an empty database.
+The crawlers remain the way to keep the graph up to date afterwards.
+
+    python ResponseCache.py migrate     first, if the cache still has legacy files
+    python BulkExport.py export         writes the csv files, load.cypher and import.txt
+    python BulkExport.py load           runs load.cypher, copy the csv files to the neo4j import folder first
+"""
+import os
+import re
+import csv
+import sys
+from collections import OrderedDict
+from models import Project, Repository, Team, Person, PullRequest, WorkItem, get_properties
+from IdentityMap import PersonNameIndex
+from PullRequests import PullRequestsWorker
+from Comments import CommentsWorker
+from WorkItems import PullReqeustWorkItemsWorker
+from WorkItemLinks import WorkItemLinksWorker
+
+TEAM_MEMBERS_URL = re.compile(r"/_apis/projects/([^/?]+)/teams/([^/?]+)/members", re.I)
+TEAMS_URL = re.compile(r"/_apis/projects/([^/?]+)/teams(\?|$)", re.I)
+PROJECTS_URL = re.compile(r"/_apis/projects(\?|$)", re.I)
+REPOSITORIES_URL = re.compile(r"/_apis/git/repositories(\?|$)", re.I)
+THREADS_URL = re.compile(r"/pullRequests/(\d+)/threads", re.I)
+PULL_REQUEST_WORK_ITEMS_URL = re.compile(r"/pullRequests/(\d+)/workitems", re.I)
+WORK_ITEM_LINKS_URL = re.compile(r"/_apis/wit/reporting/workItemLinks", re.I)
+
+#without these lists pull requests, repositories and work items have nothing to link to
+REQUIRED_LISTS = ("projects", "repositories")
+
+class CsvNodes(object):
+    """
+    Nodes of one label, merged by Id so a pull request seen on a list page
+    and on its own page ends up as one row.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.rows = OrderedDict()
+        self.columns = ["Id"]
+
+    def add(self, properties):
+        """
+        merges a node's properties into its row, None values never overwrite
+        """
+        node_id = properties.get("Id")
+        if node_id is None:
+            return
+        row = self.rows.setdefault(node_id, {})
+        for name, value in properties.items():
+            if value is None:
+                continue
+            if name not in self.columns:
+                self.columns.append(name)
+            row[name] = value
+
+    def column_type(self, name):
+        """
+        neo4j-admin type of a column, long, double, boolean or string
+        """
+        kinds = set()
+        for row in self.rows.values():
+            value = row.get(name)
+            if isinstance(value, bool):
+                kinds.add("boolean")
+            elif isinstance(value, int):
+                kinds.add("long")
+            elif isinstance(value, float):
+                kinds.add("double")
+            elif value is not None:
+                kinds.add("string")
+        if len(kinds) == 1:
+            return kinds.pop()
+        if kinds == {"long", "double"}:
+            return "double"
+        return "string"
+
+class BulkExporter(object):
+    """
+    :param VstsInfo vsts:
+        used for the response cache, the project whitelist and to build the crawler mappers
+    """
+
+    def __init__(self, vsts):
+        self.vsts = vsts
+        self.pull_requests = PullRequestsWorker("", vsts)
+        self.comments = CommentsWorker(vsts)
+        self.work_items = PullReqeustWorkItemsWorker(vsts.get_request_settings(), vsts)
+        self.links = WorkItemLinksWorker(vsts)
+        self.nodes = OrderedDict()
+        self.relationships = OrderedDict()
+        #work items name their project and people, resolved once every node is known
+        self.project_links = []
+        self.person_links = []
+        self.skipped = 0
+        self.lists_seen = set()
+
+    def add_node(self, graph_object):
+        """
+        queues a mapped model as a node row
+        """
+        label = graph_object.__primarylabel__
+        if label not in self.nodes:
+            self.nodes[label] = CsvNodes(label)
+        self.nodes[label].add(get_properties(graph_object))
+
+    def add_bare_node(self, model, node_id):
+        """
+        the crawlers create a node with only an Id when the other end of a link is not known yet
+        """
+        bare = model()
+        bare.Id = node_id
+        self.add_node(bare)
+
+    def add_relationship(self, start_label, start_id, rel_type, end_label, end_id, properties=None):
+        """
+        queues a relationship, files are split by start label, type and end label
+        """
+        if start_id is None or end_id is None:
+            return
+        key = (start_label, rel_type, end_label)
+        rows = self.relationships.setdefault(key, OrderedDict())
+        rows[(start_id, end_id)] = properties or {}
+
+    def map_entry(self, entry):
+        """
+        maps one cached response, responses the export does not know are skipped
+        """
+        url, data = entry.url, entry.data
+        if not isinstance(data, dict):
+            self.skipped += 1
+            return
+        match = TEAM_MEMBERS_URL.search(url)
+        if match:
+            return self.map_team_members(match.group(2), data)
+        match = TEAMS_URL.search(url)
+        if match:
+            return self.map_teams(match.group(1), data)
+        if PROJECTS_URL.search(url):
+            self.lists_seen.add("projects")
+            return self.map_projects(data)
+        if REPOSITORIES_URL.search(url):
+            self.lists_seen.add("repositories")
+            return self.map_repositories(data)
+        match = THREADS_URL.search(url)
+        if match:
+            return self.map_threads(int(match.group(1)), url, data)
+        match = PULL_REQUEST_WORK_ITEMS_URL.search(url)
+        if match:
+            return self.map_pull_request_work_items(int(match.group(1)), data)
+        if WORK_ITEM_LINKS_URL.search(url):
+            return self.map_work_item_links(data)
+        values = data.get("value") if isinstance(data.get("value"), list) else [data]
+        mapped = False
+        for raw in values:
+            if "pullRequestId" in raw:
+                self.map_pull_request(raw)
+                mapped = True
+            elif "fields" in raw and "id" in raw:
+                self.map_work_item(raw)
+                mapped = True
+        if not mapped:
+            self.skipped += 1
+
+    def map_projects(self, data):
+        """
+        whitelisted projects, same as ProjectsTeamsUsers.py
+        """
+        for raw in data.get("value", []):
+            if raw.get("name") not in self.vsts.project_whitelist:
+                continue
+            proj = Project()
+            proj.Id = raw.get("id")
+            proj.Name = raw.get("name")
+            proj.Revision = raw.get("revision")
+            self.add_node(proj)
+
+    def map_teams(self, project_id, data):
+        """
+        teams of a project
+        """
+        for raw in data.get("value", []):
+            team = Team()
+            team.Id = raw.get("id")
+            team.Name = raw.get("name")
+            self.add_node(team)
+            self.add_relationship("Team", team.Id, "PART_OF", "Project", project_id)
+
+    def map_team_members(self, team_id, data):
+        """
+        people and the teams they are members of
+        """
+        for raw in data.get("value", []):
+            #we don't want system users
+            if raw.get("isContainer", False):
+                continue
+            user = Person()
+            user.Id = raw.get("id")
+            user.Name = raw.get("displayName")
+            user.Url = raw.get("url")
+            user.UniqueName = raw.get("uniqueName")
+            self.add_node(user)
+            self.add_relationship("Person", user.Id, "MEMBER_OF", "Team", team_id)
+
+    def map_repositories(self, data):
+        """
+        git repositories and their projects
+        """
+        for raw in data.get("value", []):
+            repo = Repository()
+            repo.Id = raw.get("id")
+            repo.Name = raw.get("name")
+            repo.Url = raw.get("url")
+            self.add_node(repo)
+            raw_proj = raw.get("project") or {}
+            self.add_relationship("Repository", repo.Id, "BELONGS_TO", "Project", raw_proj.get("id"))
+
+    def map_pull_request(self, raw):
+        """
+        a pull request with its repository, reviewers and creator, same as PullRequests.py
+        """
+        pull = PullRequest()
+        self.pull_requests.map_pull_request_parameters(pull, raw)
+        self.add_node(pull)
+        repo = raw.get("repository") or {}
+        self.add_relationship("PullRequest", pull.Id, "FOR_REPOSITORY", "Repository", repo.get("id"))
+        for reviewer in raw.get("reviewers", []):
+            self.add_relationship("PullRequest", pull.Id, "REVIEWED_BY", "Person", reviewer.get("id"))
+        creator_id = (raw.get("createdBy") or {}).get("id")
+        if creator_id is not None:
+            self.add_bare_node(Person, creator_id)
+            self.add_relationship("PullRequest", pull.Id, "CREATED_BY", "Person", creator_id)
+
+    def map_threads(self, pull_request_id, url, data):
+        """
+        comment threads of a pull request, only threads with user comments are kept
+        """
+        for item in data.get("value", []):
+            thread = self.comments.make_thread_node(item)
+            thread_added = False
+            for raw_comment in item.get("comments", []):
+                if self.comments.exclude_system_comments and not self.comments.is_user_comment(raw_comment):
+                    continue
+                comment = self.comments.make_comment_node(raw_comment, thread.Id, url)
+                if comment is None:
+                    continue
+                if not thread_added:
+                    self.add_node(thread)
+                    self.add_relationship("PullRequestThread", thread.Id, "PART_OF",
+                                          "PullRequest", pull_request_id)
+                    thread_added = True
+                self.add_node(comment)
+                self.add_relationship("Comment", comment.Id, "PART_OF", "PullRequestThread", thread.Id)
+                parent_id = raw_comment.get("parentCommentId")
+                if parent_id:
+                    parent_key = comment.get_id(parent_id, thread.Id)
+                    self.add_bare_node(type(comment), parent_key)
+                    self.add_relationship("Comment", comment.Id, "PARENT_COMMENT", "Comment", parent_key)
+                author_id = (raw_comment.get("author") or {}).get("id")
+                if author_id is not None:
+                    self.add_bare_node(Person, author_id)
+                    self.add_relationship("Comment", comment.Id, "AUTHOR", "Person", author_id)
+
+    def map_pull_request_work_items(self, pull_request_id, data):
+        """
+        work items linked to a pull request
+        """
+        for raw in data.get("value", []):
+            work_item_id = str(raw.get("id"))
+            self.add_bare_node(WorkItem, work_item_id)
+            self.add_relationship("WorkItem", work_item_id, "LINKED_TO", "PullRequest", pull_request_id)
+
+    def map_work_item(self, raw):
+        """
+        a work item, its project and people are linked by name in resolve_names
+        """
+        work_item = WorkItem()
+        work_item.Id = str(raw.get("id"))
+        self.work_items.map_work_item_fields(work_item, raw)
+        self.add_node(work_item)
+        fields = raw.get("fields")
+        if fields.get("System.TeamProject") is not None:
+            self.project_links.append((work_item.Id, fields.get("System.TeamProject")))
+        for field, rel_type in (("System.CreatedBy", "CREATED_BY"), ("System.AssignedTo", "ASSIGNED_TO")):
+            if fields.get(field) is not None:
+                self.person_links.append((work_item.Id, rel_type, fields.get(field)))
+
+    def map_work_item_links(self, data):
+        """
+        links between work items, same relationship types as WorkItemLinks.py
+        """
+        for raw_link in data.get("values", []):
+            source_id, target_id = raw_link.get("sourceId"), raw_link.get("targetId")
+            if source_id is None or target_id is None or raw_link.get("linkType") is None:
+                continue
+            self.add_bare_node(WorkItem, str(source_id))
+            self.add_bare_node(WorkItem, str(target_id))
+            properties = {}
+            self.links.set_link_props(properties, raw_link)
+            self.add_relationship("WorkItem", str(source_id),
+                                  self.links.parse_link_type(raw_link["linkType"]),
+                                  "WorkItem", str(target_id), properties)
+
+    def resolve_names(self):
+        """
+        links work items to projects and people now that every project and person is known
+        """
+        projects = {row.get("Name"): node_id
+                    for node_id, row in self.nodes.get("Project", CsvNodes("Project")).rows.items()}
+        for work_item_id, project_name in self.project_links:
+            self.add_relationship("WorkItem", work_item_id, "FOR_PROJECT", "Project",
+                                  projects.get(project_name))
+        names = PersonNameIndex()
+        for node_id, row in self.nodes.get("Person", CsvNodes("Person")).rows.items():
+            names.add(node_id, row.get("Name"), row.get("UniqueName"))
+        for work_item_id, rel_type, raw_name in self.person_links:
+            self.add_relationship("WorkItem", work_item_id, rel_type, "Person", names.find(raw_name))
+        self.project_links = []
+        self.person_links = []
+
+    def export(self, cache):
+        """
+        Maps every cached response.
+        Raises ValueError when the project or repository lists are not in the cache,
+        the export would silently leave pull requests and work items unlinked.
+        :returns: number of responses read
+        """
+        count = 0
+        for entry in cache.entries():
+            self.map_entry(entry)
+            count += 1
+        missing = [name for name in REQUIRED_LISTS if name not in self.lists_seen]
+        if missing:
+            raise ValueError("the response cache has no {0} list, run ProjectsTeamsUsers.py and "
+                             "Repositories.py to cache them first".format(" or ".join(missing)))
+        self.resolve_names()
+        return count
+
+    def id_type(self, label):
+        """
+        type of the Id of a label, string when no nodes of the label were exported
+        """
+        if label not in self.nodes:
+            return "string"
+        return self.nodes[label].column_type("Id")
+
+    def write(self, folder, import_url="file:///", periodic_commit=10000):
+        """
+        Writes headerless csv files with neo4j-admin header files next to them,
+        load.cypher with one LOAD CSV statement per file and import.txt with the neo4j-admin command.
+        """
+        os.makedirs(folder, exist_ok=True)
+        statements = []
+        admin_nodes = []
+        admin_relationships = []
+        for label, nodes in self.nodes.items():
+            name = label.lower()
+            types = [nodes.column_type(column) for column in nodes.columns]
+            header = [":ID({0})".format(label)]
+            header += [column if kind == "string" else column + ":" + kind
+                       for column, kind in zip(nodes.columns, types)]
+            header.append(":LABEL")
+            write_csv(os.path.join(folder, name + "_header.csv"), [header])
+            write_csv(os.path.join(folder, name + ".csv"),
+                      ([node_id] + [row.get(column) for column in nodes.columns] + [label]
+                       for node_id, row in nodes.rows.items()))
+            admin_nodes.append(name)
+            sets = ["n.{0} = coalesce({1}, n.{0})".format(column, cypher_value("row[{0}]".format(i + 1), kind))
+                    for i, (column, kind) in enumerate(zip(nodes.columns, types)) if column != "Id"]
+            statement = ("USING PERIODIC COMMIT {0}\n"
+                         "LOAD CSV FROM '{1}{2}.csv' AS row\n"
+                         "MERGE (n:{3} {{Id: {4}}})").format(periodic_commit, import_url, name, label,
+                                                            cypher_value("row[1]", types[0]))
+            if sets:
+                statement += "\nSET " + ",\n    ".join(sets)
+            statements.append(statement)
+
+        for (start_label, rel_type, end_label), rows in self.relationships.items():
+            name = "rel_" + re.sub(r"[^A-Za-z0-9]+", "_", "{0}_{1}_{2}".format(start_label, rel_type, end_label)).lower()
+            columns = []
+            for properties in rows.values():
+                columns.extend(column for column in properties if column not in columns)
+            header = [":START_ID({0})".format(start_label), ":END_ID({0})".format(end_label), ":TYPE"]
+            write_csv(os.path.join(folder, name + "_header.csv"), [header + columns])
+            write_csv(os.path.join(folder, name + ".csv"),
+                      ([start_id, end_id, rel_type] + [properties.get(column) for column in columns]
+                       for (start_id, end_id), properties in rows.items()))
+            admin_relationships.append(name)
+            statement = ("USING PERIODIC COMMIT {0}\n"
+                         "LOAD CSV FROM '{1}{2}.csv' AS row\n"
+                         "MATCH (a:{3} {{Id: {4}}})\n"
+                         "MATCH (b:{5} {{Id: {6}}})\n"
+                         "MERGE (a)-[r:`{7}`]->(b)").format(periodic_commit, import_url, name,
+                                                           start_label, cypher_value("row[0]", self.id_type(start_label)),
+                                                           end_label, cypher_value("row[1]", self.id_type(end_label)),
+                                                           rel_type)
+            if columns:
+                statement += "\nSET " + ", ".join("r.{0} = row[{1}]".format(column, i + 3)
+                                                  for i, column in enumerate(columns))
+            statements.append(statement)
+
+        with open(os.path.join(folder, "load.cypher"), "w") as cypher_file:
+            cypher_file.write(";\n\n".join(statements) + ";\n")
+        command = ["neo4j-admin import --database=graph.db --multiline-fields=true",
+                   "--ignore-duplicate-nodes=true --ignore-missing-nodes=true"]
+        command += ["--nodes={0}_header.csv,{0}.csv".format(name) for name in admin_nodes]
+        command += ["--relationships={0}_header.csv,{0}.csv".format(name) for name in admin_relationships]
+        with open(os.path.join(folder, "import.txt"), "w") as import_file:
+            import_file.write(" \\\n  ".join(command) + "\n")
+        return statements
+
+    def summary(self):
+        """
+        :returns: string suitable for printing at the end of an export
+        """
+        nodes = ", ".join("{0}: {1}".format(label, len(nodes.rows)) for label, nodes in self.nodes.items())
+        relationships = sum(len(rows) for rows in self.relationships.values())
+        return "Nodes {0} relationships: {1} skipped responses: {2}".format(nodes, relationships, self.skipped)
+
+def cypher_value(expression, kind):
+    """
+    LOAD CSV reads everything as strings, converts back to the exported type
+    """
+    if kind == "long":
+        return "toInteger({0})".format(expression)
+    if kind == "double":
+        return "toFloat({0})".format(expression)
+    if kind == "boolean":
+        return "({0} = 'true')".format(expression)
+    return expression
+
+def csv_value(value):
+    """
+    empty for None, lower case booleans like neo4j writes them
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return value
+
+def write_csv(path, rows):
+    """
+    writes rows to a utf-8 csv file
+    """
+    with open(path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        for row in rows:
+            writer.writerow([csv_value(value) for value in row])
+
+def load(graph, folder):
+    """
+    runs the statements in load.cypher one at a time, periodic commit can't run in an explicit transaction
+    """
+    with open(os.path.join(folder, "load.cypher")) as cypher_file:
+        statements = [statement.strip() for statement in cypher_file.read().split(";\n")]
+    for statement in statements:
+        if statement:
+            print(statement.splitlines()[1])
+            graph.run(statement)
+
+if __name__ == '__main__':
+    from VSTSInfo import VstsInfo
+    from models import GraphBuilder
+    VSTS = VstsInfo(None, None)
+    COMMAND = sys.argv[1] if len(sys.argv) > 1 else None
+    if COMMAND == "export":
+        EXPORTER = BulkExporter(VSTS)
+        READ = EXPORTER.export(VSTS.response_cache)
+        EXPORTER.write(VSTS.bulk_export_folder, VSTS.bulk_import_url, VSTS.bulk_periodic_commit)
+        print("Read {0} cached responses".format(READ))
+        print(EXPORTER.summary())
+        print("Wrote csv files to " + VSTS.bulk_export_folder)
+    elif COMMAND == "load":
+        GraphBuilder().create_unique_constraints()
+        load(GraphBuilder().GetNewGraph(), VSTS.bulk_export_folder)
+    else:
+        print("usage: python BulkExport.py export|load")
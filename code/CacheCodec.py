@@ -0,0 +1,186 @@
+"""
+Compression for cached VSTS responses.
+zstd is used when the zstandard package is installed, gzip from the standard library otherwise.
+Payloads are recognised by their magic bytes so a cache can hold a mix of
+plain, gzip and zstd entries and still be read back.
+"""
+import io
+import os
+import gzip
+import json
+import glob
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+class PlainCodec(object):
+    """
+    Uncompressed json, what the cache used to store.
+    """
+    name = "none"
+    extension = ".json"
+
+    def encode(self, data):
+        """
+        :returns: bytes
+        """
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, payload):
+        """
+        :returns: the decoded json data
+        """
+        return json.loads(payload.decode('utf-8'))
+
+    def load(self, data_file):
+        """
+        decodes straight from an open binary file
+        """
+        return json.load(io.TextIOWrapper(data_file, encoding='utf-8'))
+
+class GzipCodec(PlainCodec):
+    """
+    gzip compressed json
+    """
+    name = "gzip"
+    extension = ".json.gz"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def encode(self, data):
+        return gzip.compress(super().encode(data), self.level)
+
+    def decode(self, payload):
+        return super().decode(gzip.decompress(payload))
+
+    def load(self, data_file):
+        with gzip.GzipFile(fileobj=data_file, mode='rb') as stream:
+            return json.load(io.TextIOWrapper(stream, encoding='utf-8'))
+
+class ZstdCodec(PlainCodec):
+    """
+    zstd compressed json, optionally with a dictionary trained on our own responses.
+    Dictionaries are saved by id in the dictionary folder so older entries
+    can still be read after a new dictionary is trained.
+    """
+    name = "zstd"
+    extension = ".json.zst"
+
+    def __init__(self, level=10, dictionary_folder=None):
+        if zstandard is None:
+            raise ValueError("cache_compression is zstd but the zstandard package is not installed")
+        self.level = level
+        self.dictionary_folder = dictionary_folder
+        self._dictionaries = {}
+        self.dictionary = self._load_latest_dictionary()
+
+    def _dictionary_path(self, dict_id):
+        return os.path.join(self.dictionary_folder, "zstd-{0}.dict".format(dict_id))
+
+    def _load_latest_dictionary(self):
+        if not self.dictionary_folder:
+            return None
+        paths = glob.glob(os.path.join(self.dictionary_folder, "zstd-*.dict"))
+        if not paths:
+            return None
+        latest = max(paths, key=os.path.getmtime)
+        with open(latest, 'rb') as dict_file:
+            dictionary = zstandard.ZstdCompressionDict(dict_file.read())
+        self._dictionaries[dictionary.dict_id()] = dictionary
+        return dictionary
+
+    def _dictionary_for(self, payload):
+        dict_id = zstandard.get_frame_parameters(payload).dict_id
+        if not dict_id:
+            return None
+        if dict_id not in self._dictionaries:
+            with open(self._dictionary_path(dict_id), 'rb') as dict_file:
+                self._dictionaries[dict_id] = zstandard.ZstdCompressionDict(dict_file.read())
+        return self._dictionaries[dict_id]
+
+    def encode(self, data):
+        #compressors are not thread safe, each call gets its own
+        compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.dictionary)
+        return compressor.compress(super().encode(data))
+
+    def decode(self, payload):
+        dictionary = self._dictionary_for(payload)
+        decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+        return super().decode(decompressor.decompress(payload))
+
+    def load(self, data_file):
+        header = data_file.read(18)
+        data_file.seek(0)
+        decompressor = zstandard.ZstdDecompressor(dict_data=self._dictionary_for(header))
+        with decompressor.stream_reader(data_file) as stream:
+            return json.load(io.TextIOWrapper(stream, encoding='utf-8'))
+
+    def save_dictionary(self, samples, size=112640):
+        """
+        Trains a dictionary on sample payloads and uses it for new entries.
+        :param list samples:
+            list of uncompressed json bytes
+        :returns: the new dictionary id
+        """
+        dictionary = zstandard.train_dictionary(size, samples)
+        os.makedirs(self.dictionary_folder, exist_ok=True)
+        with open(self._dictionary_path(dictionary.dict_id()), 'wb') as dict_file:
+            dict_file.write(dictionary.as_bytes())
+        self._dictionaries[dictionary.dict_id()] = dictionary
+        self.dictionary = dictionary
+        return dictionary.dict_id()
+
+def make_codec(name, dictionary_folder=None):
+    """
+    :param string name:
+        auto, zstd, gzip or none. auto picks zstd when it is installed.
+    """
+    name = (name or "none").strip().lower()
+    if name == "auto":
+        name = "zstd" if zstandard is not None else "gzip"
+    if name == "zstd":
+        return ZstdCodec(dictionary_folder=dictionary_folder)
+    if name == "gzip":
+        return GzipCodec()
+    if name == "none":
+        return PlainCodec()
+    raise ValueError("Unknown cache_compression " + name + " expected auto, zstd, gzip or none")
+
+_READERS = {}
+
+def codec_for_payload(payload, dictionary_folder=None):
+    """
+    picks the codec that wrote a payload by looking at its magic bytes
+    """
+    if payload.startswith(ZSTD_MAGIC):
+        name = "zstd"
+    elif payload.startswith(GZIP_MAGIC):
+        name = "gzip"
+    else:
+        name = "none"
+    key = (name, dictionary_folder)
+    if key not in _READERS:
+        _READERS[key] = make_codec(name, dictionary_folder)
+    return _READERS[key]
+
+def decode_payload(payload, dictionary_folder=None):
+    """
+    decodes a payload written by any of the codecs
+    """
+    return codec_for_payload(payload, dictionary_folder).decode(payload)
+
+def load_file(data_file, dictionary_folder=None):
+    """
+    decodes an open binary file written by any of the codecs without reading it all in first
+    """
+    magic = data_file.read(4)
+    data_file.seek(0)
+    return codec_for_payload(magic, dictionary_folder).load(data_file)
+
+EXTENSIONS = [PlainCodec.extension, GzipCodec.extension, ZstdCodec.extension]
@@ -0,0 +1,67 @@
+"""
+Decides per cache entry whether a cached VSTS response can still be used.
+Completed and abandoned pull requests and closed work items never change so they are kept forever,
+everything else is refreshed once it is older than its time to live.
+"""
+
+FOREVER = None
+
+class CachePolicy(object):
+    """
+    :param float active_ttl:
+        seconds to keep active pull requests and open work items
+    :param float list_ttl:
+        seconds to keep list responses, pages of pull requests, threads, links and so on
+    :param list closed_states:
+        work item states that will not change again
+    """
+
+    def __init__(self, active_ttl=24 * 3600, list_ttl=3600,
+                 closed_states=("Closed", "Done", "Removed")):
+        self.active_ttl = active_ttl
+        self.list_ttl = list_ttl
+        self.closed_states = set(closed_states)
+
+    def is_immutable_pull_request(self, data):
+        """
+        completed and abandoned pull requests are done changing
+        """
+        return str(data.get("status", "")).lower() in ("completed", "abandoned")
+
+    def is_closed_work_item(self, data):
+        """
+        work items in a closed state are done changing
+        """
+        fields = data.get("fields")
+        if not isinstance(fields, dict):
+            return False
+        return fields.get("System.State") in self.closed_states
+
+    def ttl_for(self, url, data):
+        """
+        :returns: seconds the response can be used for, FOREVER (None) for immutable responses
+        """
+        if not isinstance(data, dict):
+            return self.list_ttl
+        if "value" in data or "values" in data:
+            return self.list_ttl
+        if "pullRequestId" in data:
+            if self.is_immutable_pull_request(data):
+                return FOREVER
+            return self.active_ttl
+        if "fields" in data:
+            if self.is_closed_work_item(data):
+                return FOREVER
+            return self.active_ttl
+        return self.active_ttl
+
+    def is_fresh(self, entry):
+        """
+        :param CacheEntry entry:
+            cached response with the time it was fetched
+        :returns: bool, False means the response should be fetched again
+        """
+        ttl = self.ttl_for(entry.url, entry.data)
+        if ttl is FOREVER:
+            return True
+        return entry.age < ttl
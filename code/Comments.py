@@ -3,15 +3,19 @@ Comments.py
 From VSTS imports the pull request comments and stores them in Neo4j linked to users and pull requests
 '''
 import logging
-from multiprocessing import Pool
 from VSTSInfo import VstsInfo
-from models import GraphBuilder, PullRequest, Comment, PullRequestThread, Person
+from models import GraphBuilder, PullRequest, Comment, PullRequestThread, get_properties
+from BatchWriter import CommentBatchWriter
+from StagedPipeline import StagedPipeline
+from Scheduler import Scheduler, get_pull_request_keys
 
 class CommentsWorker():
     '''
     Gets Comments from VSTS and saves them to Neo4J
     '''
 
+    JOURNAL_STAGE = "comments"
+
     def __init__(self, vsts, exclude_system_comments=True):
         self._exclude_system_comments = exclude_system_comments
         self._vsts = vsts
@@ -63,23 +67,24 @@ class CommentsWorker():
         Crawls the comments and puts them in Neo4J
         '''
         graph = GraphBuilder().GetNewGraph()
+        writer = CommentBatchWriter(graph, self.vsts_api.comment_batch_size,
+                                    fingerprints=self.vsts_api.fingerprints)
         pull_request = PullRequest.select(graph, pull_request_id).first()
         for repo in pull_request.ForRepository:
-            self.copy_over_comments(repo.Id, pull_request)
+            self.copy_over_comments(writer, repo.Id, pull_request.Id)
+        writer.flush()
         print("finished adding comments")
 
-    def make_comment_node(self, vsts_data, thread_id, graph, url):
+    def make_comment_node(self, vsts_data, thread_id, url=None):
         '''
-        make a node so we can link things to and later save
+        map a comment so it can be queued on the batch writer
         '''
         raw_id = vsts_data.get('id')
         if raw_id is None:
             print("comment was not added id could not be generated")
             return None
 
-        comment = Comment.select(graph, raw_id).first()
-        if comment is None:
-            comment = Comment()
+        comment = Comment()
         comment.Id = comment.get_id(raw_id, thread_id)
         if "commentType" in vsts_data:
             comment.CommentType = vsts_data.get("commentType", "")
@@ -90,16 +95,12 @@ class CommentsWorker():
         comment.Url = url
         return comment
 
-    def make_thread_node(self, vsts_data, graph):
+    def make_thread_node(self, vsts_data):
         '''
         Pull Request comments are stored in threads
         this builds a thread node
         '''
-        thread_id = vsts_data.get("id")
-        thread = PullRequestThread.select(graph, thread_id).first()
-        if thread is None:
-            thread = PullRequestThread()
-
+        thread = PullRequestThread()
         thread.Id = vsts_data.get("id")
         thread.IsDeleted = vsts_data.get("isDeleted", "")
         thread.Status = vsts_data.get("status")
@@ -111,40 +112,32 @@ class CommentsWorker():
 
     def save_comment(self, comment, graph):
         '''
-        save the pull request and all the linked nodes to neo4J
+        save a single comment and all the linked nodes to neo4J,
+        the crawl itself goes through CommentBatchWriter
         '''
         print("     Saving Comment " + str(comment.Id))
         transaction = graph.begin()
         transaction.merge(comment)
-        transaction.graph.push(comment)
+        transaction.push(comment)
+        transaction.commit()
 
-    def link_to_parent_comment(self, comment, vsts_data, thread_id, graph):
+    def link_to_parent_comment(self, writer, comment, vsts_data, thread_id):
         '''
-        link to parent comment
+        link to parent comment, a parentCommentId of 0 or none means a top level comment
         '''
-        parent_id = vsts_data.get("parentCommentId", "0")
-        if parent_id == 0:
+        parent_id = vsts_data.get("parentCommentId")
+        if not parent_id:
             return
-        else:
-            parent = list(Comment.select(graph, thread_id))
-            parent_comment = {}
-            if parent:
-                comment.ParentComment.add(parent[0])
-            else:
-                parent_comment = Comment()
-                parent_comment.Id = comment.get_id(parent_id, thread_id)
-                comment.ParentComment.add(parent_comment)
-
-    def link_to_author(self, comment, vsts_data, graph):
-        '''
-        Link to Author
-        '''
-        author_id = vsts_data.get("author").get("id")
-        author = Person.select(graph, author_id).first()
-        if author is None:
-            author = Person()
-            author.Id = author_id
-        comment.Author.add(author)
+        writer.add("parents", {"Id": comment.Id, "ParentId": comment.get_id(parent_id, thread_id)})
+
+    def link_to_author(self, writer, comment, vsts_data):
+        '''
+        Link to Author, a bare person is added when the author is not in Neo4j yet
+        '''
+        author = vsts_data.get("author")
+        if author is None or author.get("id") is None:
+            return
+        writer.add("authors", {"Id": comment.Id, "PersonId": author.get("id")})
 
     def get_vsts_comments(self, url):
         '''
@@ -164,45 +157,101 @@ class CommentsWorker():
             result = True
         return result
 
-    def copy_over_comments(self, repository_id, pull_request):
+    def copy_over_comments(self, writer, repository_id, pull_request_id):
         '''
-        Copy VSTS Comments to VSTS
+        Copy VSTS Comments to Neo4j through the batch writer,
+        one pull request is one record so its threads and comments commit together
         '''
-        print("adding comments for pull_request_id" + str(pull_request.Id))
-        url = self.generate_vsts_url(repository_id, pull_request.Id)
-        data = self.get_vsts_comments(url)
+        self.map_comments(writer, self.fetch_comments((repository_id, pull_request_id)))
+
+    def fetch_comments(self, key):
+        '''
+        pipeline fetch stage
+        :param tuple key: (repository id, pull request id)
+        :returns: (pull request id, url, comment threads from VSTS)
+        '''
+        repository_id, pull_request_id = key
+        url = self.generate_vsts_url(repository_id, pull_request_id)
+        return pull_request_id, url, self.get_vsts_comments(url)
+
+    def map_comments(self, writer, fetched):
+        '''
+        pipeline map stage, queues the threads and comments of one pull request
+        '''
+        pull_request_id, url, data = fetched
+        print("adding comments for pull_request_id" + str(pull_request_id))
         if data is None:
-            logging.warning("no comments from vsts for pull request " + pull_request.Id)
+            logging.warning("no comments from vsts for pull request " + str(pull_request_id))
             return
 
         for item in data["value"]:
-            graph = GraphBuilder().GetNewGraph()
             #vsts comment thread not python thread
-            thread = self.make_thread_node(item, graph)
+            thread = self.make_thread_node(item)
             print("working thread " + str(thread.Id))
+            thread_added = False
             for raw_comment in item.get("comments"):
                 if self.exclude_system_comments and not self.is_user_comment(raw_comment):
                     continue
-                else:
-                    thread.PartOf.add(pull_request)
-                    comment = self.make_comment_node(raw_comment, thread.Id, graph, url)
-                    print("saving comment " + str(comment.Id))
-                    graph.merge(comment)
-                    print("saved comment " + str(comment.Id))
-                    #this should save the therad too
-                    comment.PartOf.add(thread)
-                    self.link_to_parent_comment(comment, raw_comment, thread.Id, graph)
-                    self.link_to_author(comment, raw_comment, graph)
-                    graph.push(comment)
-                    print("added links for comment " + str(comment.Id))
-
-    def crawl_by_project(self, project_name):
+                comment = self.make_comment_node(raw_comment, thread.Id, url)
+                if comment is None:
+                    continue
+                if not thread_added:
+                    writer.add("threads", {"Id": thread.Id, "PullRequestId": pull_request_id,
+                                           "props": get_properties(thread)})
+                    thread_added = True
+                writer.add("comments", {"Id": comment.Id, "ThreadId": thread.Id,
+                                        "props": get_properties(comment)})
+                self.link_to_parent_comment(writer, comment, raw_comment, thread.Id)
+                self.link_to_author(writer, comment, raw_comment)
+        writer.record_done(pull_request_id)
+
+    def get_repository_pull_request_ids(self, project_name, graph=None):
+        """
+        from neo4j get the (repository id, pull request id) pairs for a given project.
+        """
+        if graph is None:
+            graph = GraphBuilder().GetNewGraph()
+        qry = '''MATCH (pr:PullRequest)-[]-
+                 (r:Repository)-[]-(p:Project{Name:$project_name})
+                 RETURN r.Id as RepositoryId, pr.Id as Id'''
+        ids = []
+        for item in graph.run(qry, project_name=project_name):
+            ids.append((item.get("RepositoryId"), item.get("Id")))
+        return ids
+
+    def crawl_by_project(self, project_name, keys=None, clear_journal=True):
         """
         Helps with multithreaded execution to crawl by project.
+        Comment threads are fetched, mapped and written on their own pipeline threads
+        so the VSTS requests overlap with each other and with the Neo4j writes,
+        comment_batch_size pull requests per transaction over one graph connection.
+
+        Pull requests are recorded in the journal as their comments are committed,
+        a crawl that was stopped part way skips them.
+
+        :param list keys:
+            (repository id, pull request id) pairs, queried from neo4j when not given
+        :param bool clear_journal:
+            forget the pull requests done once the project is finished
         """
-        pull_ids = self.get_pull_request_ids(project_name)
-        for pull_id in pull_ids:
-            self.crawl(pull_id)
+        vsts = self.vsts_api
+        journal = vsts.journal
+        graph = GraphBuilder().GetNewGraph()
+        writer = CommentBatchWriter(graph, vsts.comment_batch_size,
+                                    lambda units: journal.record(self.JOURNAL_STAGE, project_name, units),
+                                    vsts.fingerprints)
+        if keys is None:
+            keys = self.get_repository_pull_request_ids(project_name, graph)
+        keys = journal.remaining(self.JOURNAL_STAGE, project_name, dict.fromkeys(keys),
+                                 key=lambda key: str(key[1]))
+        pipeline = StagedPipeline(self.fetch_comments, self.map_comments, writer,
+                                  vsts.pipeline_fetch_workers, vsts.pipeline_map_workers,
+                                  vsts.pipeline_queue_size)
+        pipeline.run(keys)
+        if clear_journal:
+            journal.clear(self.JOURNAL_STAGE, project_name)
+        print(pipeline.summary())
+        print(writer.summary())
 
 if __name__ == '__main__':
     print("starting Comments")
@@ -217,8 +266,10 @@ if __name__ == '__main__':
     WORKER = CommentsWorker(VSTS)
 
     if RUN_MULTI_THREADED:
-        with Pool(5) as p:
-            p.map(WORKER.crawl_by_project, VSTS.project_whitelist)
+        SCHEDULER = Scheduler(VSTS.crawl_processes, journal=VSTS.journal)
+        SCHEDULER.crawl_comments(get_pull_request_keys(VSTS.project_whitelist), VSTS.comment_batch_size)
+        print(SCHEDULER.summary())
     else:
         for proj in VSTS.project_whitelist:
             WORKER.crawl_by_project(proj)
+    VSTS.print_stats()
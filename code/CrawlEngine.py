@@ -0,0 +1,369 @@
+"""
+Asyncio request engine so the crawlers can have many VSTS requests in flight at once.
+The token bucket replaces the old fixed time.sleep(crawl_throttle) before every request.
+"""
+import os
+import time
+import random
+import asyncio
+import threading
+import email.utils
+from concurrent.futures import ThreadPoolExecutor
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket rate limiter.
+
+    :param float rate:
+        requests per second allowed on average, 0 or less means no limit
+    :param int burst:
+        how many requests can go out back to back before the rate kicks in
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last
+        self._last = now
+        self._tokens = min(float(self.burst), self._tokens + elapsed * self.rate)
+
+    def reserve(self):
+        """
+        takes a token and returns how many seconds the caller must wait before using it
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        blocks until a request is allowed to go out
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+class RateLimitMetrics(object):
+    """
+    Counters for throttle and backoff events so we can see how close we run to the limit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.throttled = 0
+        self.server_busy = 0
+        self.server_delayed = 0
+        self.backoffs = 0
+        self.backoff_seconds = 0.0
+        self.rate_increases = 0
+        self.rate_decreases = 0
+
+    def add(self, name, amount=1):
+        """
+        thread safe increment of one of the counters
+        """
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def summary(self, rate):
+        """
+        :returns: string suitable for printing at the end of a crawl
+        """
+        return ("Rate limit: current rate {0:.2f}/s throttled (429): {1} server busy (503): {2} "
+                "delayed by server: {3} backoffs: {4} ({5:.1f}s) rate increases: {6} "
+                "rate decreases: {7}").format(rate, self.throttled, self.server_busy,
+                                              self.server_delayed, self.backoffs,
+                                              self.backoff_seconds, self.rate_increases,
+                                              self.rate_decreases)
+
+def parse_number(value):
+    """
+    rate limit headers are numbers, but a proxy can send anything
+    :returns: float or None
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def parse_retry_after(value):
+    """
+    Retry-After is either a number of seconds or an http date
+    :returns: seconds to wait or None
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+class AdaptiveRateLimiter(TokenBucket):
+    """
+    Token bucket whose rate follows what the VSTS server tells us.
+    Additive increase while the server is healthy, multiplicative decrease when
+    it throttles us or reports it is delaying our requests.
+
+    An unlimited limiter (rate 0) starts limiting below UNLIMITED_MAX_RATE when
+    throttled and goes back to unlimited once it has ramped up to it again.
+
+    :param float rate:
+        starting requests per second, 0 or less means no limit
+    :param float max_rate:
+        ceiling we ramp up to while the server is healthy
+    :param float min_rate:
+        floor we back down to while being throttled
+    """
+
+    UNLIMITED_MAX_RATE = 40.0
+
+    def __init__(self, rate, burst=1, max_rate=None, min_rate=None,
+                 backoff_base=1.0, backoff_cap=60.0):
+        super().__init__(rate, burst)
+        self.unlimited = rate <= 0
+        self.max_rate = max_rate if max_rate is not None else rate * 4
+        if self.max_rate <= 0:
+            self.max_rate = self.UNLIMITED_MAX_RATE
+        self.min_rate = min_rate if min_rate is not None else rate / 10
+        if self.min_rate <= 0:
+            #a rate of 0 would mean unlimited to the token bucket
+            self.min_rate = self.max_rate / 10
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.metrics = RateLimitMetrics()
+        self._blocked_until = 0.0
+
+    def acquire(self):
+        """
+        blocks while a Retry-After is in effect, then waits for a token
+        """
+        wait = self._blocked_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        super().acquire()
+
+    def block_for(self, seconds):
+        """
+        stops every request in this process from going out for a while
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def _decrease(self):
+        with self._lock:
+            if self.rate <= 0:
+                #we were unlimited, start limiting from the ceiling
+                self.rate = self.max_rate
+            self.rate = max(self.min_rate, self.rate / 2)
+        self.metrics.add("rate_decreases")
+
+    def _increase(self):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            if self.rate >= self.max_rate:
+                if not self.unlimited:
+                    return
+                #healthy at the ceiling, stop limiting again
+                self.rate = 0.0
+            else:
+                step = max(self.min_rate, self.max_rate / 20)
+                self.rate = min(self.max_rate, self.rate + step)
+        self.metrics.add("rate_increases")
+
+    def on_response(self, headers):
+        """
+        Called after every successful response so we can follow the X-RateLimit headers.
+
+        :param dict headers:
+            response headers with lower case names
+        """
+        retry_after = parse_retry_after(headers.get("retry-after"))
+        delay = parse_number(headers.get("x-ratelimit-delay"))
+        remaining = parse_number(headers.get("x-ratelimit-remaining"))
+        limit = parse_number(headers.get("x-ratelimit-limit"))
+        if retry_after:
+            self.block_for(retry_after)
+        if delay is not None and delay > 0:
+            #vsts is already slowing down our requests, ease off before we get a 429
+            self.metrics.add("server_delayed")
+            self._decrease()
+        elif remaining is not None and limit and remaining < limit / 10:
+            #close to the end of the window, hold steady
+            return
+        else:
+            self._increase()
+
+    def on_throttled(self, status, retry_after=None):
+        """
+        Called on a 429 or 503 response.
+        """
+        if status == 429:
+            self.metrics.add("throttled")
+        else:
+            self.metrics.add("server_busy")
+        self._decrease()
+        if retry_after:
+            self.block_for(retry_after)
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Exponential backoff with full jitter, never shorter than what the server asked for.
+        :returns: seconds to sleep before retrying
+        """
+        ceiling = min(self.backoff_cap, self.backoff_base * (2 ** attempt))
+        wait = random.uniform(0, ceiling)
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        self.metrics.add("backoffs")
+        self.metrics.add("backoff_seconds", wait)
+        return wait
+
+    def summary(self):
+        """
+        :returns: string suitable for printing at the end of a crawl
+        """
+        return self.metrics.summary(self.rate)
+
+class PageSizer(object):
+    """
+    Picks the $top for paginated VSTS requests.
+    Starts large, halves when a page times out or comes back too big,
+    doubles while pages come back quickly.
+
+    :param int size:
+        page size to start with
+    :param float fast_latency:
+        pages faster than this many seconds let the size grow
+    :param int max_bytes:
+        pages bigger than this many decoded bytes make the size shrink
+    """
+
+    def __init__(self, size=100, min_size=10, max_size=1000,
+                 fast_latency=2.0, max_bytes=4 * 1024 * 1024):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min(max_size, max(min_size, size))
+        self.fast_latency = fast_latency
+        self.max_bytes = max_bytes
+        self.sizes = []
+        self.requests = 0
+
+    def record(self, pages, latency, size_bytes):
+        """
+        Called after fetching pages at the current size.
+
+        :param int pages:
+            number of requests that went out
+        :param float latency:
+            average seconds per request, None when the pages came from the cache
+        :param int size_bytes:
+            average decoded bytes per page
+        """
+        self.requests += pages
+        self.sizes.extend([self.size] * pages)
+        if latency is None:
+            return
+        if size_bytes > self.max_bytes:
+            self.size = max(self.min_size, self.size // 2)
+        elif latency < self.fast_latency:
+            self.size = min(self.max_size, self.size * 2)
+
+    def cap(self, size):
+        """
+        Called when the server returned fewer items than asked for although there were more,
+        asking for more than it hands out only costs extra requests.
+        """
+        self.max_size = max(self.min_size, min(self.max_size, size))
+        self.size = min(self.size, self.max_size)
+
+    def shrink(self):
+        """
+        Called when a page timed out.
+        :returns: False when the size is already as small as it goes
+        """
+        if self.size <= self.min_size:
+            return False
+        self.size = max(self.min_size, self.size // 2)
+        return True
+
+    def summary(self):
+        """
+        :returns: string suitable for printing at the end of a repository
+        """
+        return "requests: {0} page sizes: {1}".format(self.requests,
+                                                      ",".join(str(size) for size in self.sizes))
+
+class CrawlEngine(object):
+    """
+    Runs a blocking fetch function over many items with a bounded number in flight.
+    The fetch runs on a thread pool driven by an asyncio event loop,
+    the blocking http and cache code does not need to know about asyncio.
+
+    :param function fetch:
+        called once per item, usually VstsInfo.make_request
+    :param int concurrency:
+        max number of fetches in flight
+    """
+
+    def __init__(self, fetch, concurrency=8):
+        self.fetch = fetch
+        self.concurrency = max(1, concurrency)
+
+    def run(self, items):
+        """
+        fetches every item and returns the results in the same order as items.
+        If a fetch raises, the exception is returned in its place instead of stopping the others.
+        """
+        items = list(items)
+        if not items:
+            return []
+        return asyncio.run(self._run(items))
+
+    async def _run(self, items):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+
+            async def fetch_one(item):
+                async with semaphore:
+                    return await loop.run_in_executor(pool, self.fetch, item)
+
+            tasks = [fetch_one(item) for item in items]
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+def get_rate_limiter(rate, burst=1, max_rate=None, min_rate=None):
+    """
+    One limiter per process so every worker and engine thread shares the same budget.
+    The settings are only used when the limiter is first created.
+    """
+    pid = os.getpid()
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(pid)
+        if limiter is None:
+            limiter = AdaptiveRateLimiter(rate, burst, max_rate, min_rate)
+            _LIMITERS.clear()
+            _LIMITERS[pid] = limiter
+    return limiter
@@ -0,0 +1,54 @@
+"""
+Small durable key/value store for crawl bookkeeping such as watermarks.
+Each key is its own json file, written atomically, so processes crawling
+different repositories or projects never step on each other.
+"""
+import os
+import re
+import json
+import tempfile
+
+class CrawlState(object):
+    """
+    :param string folder:
+        where the state files are kept, usually a folder inside the cache_folder
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path_for(self, name):
+        """
+        :returns: file path for a key, anything but letters, digits, dot, dash and underscore is replaced
+        """
+        safe_name = re.sub(r'[^A-Za-z0-9._-]', '_', name)
+        return os.path.join(self.folder, safe_name + ".json")
+
+    def get(self, name, default=None):
+        """
+        :returns: the stored value or the default
+        """
+        try:
+            with open(self.path_for(name), 'r') as state_file:
+                return json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            return default
+
+    def set(self, name, value):
+        """
+        stores a json serializable value
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=self.folder)
+        with os.fdopen(handle, 'w') as state_file:
+            json.dump(value, state_file)
+        os.replace(tmp_path, self.path_for(name))
+
+    def delete(self, name):
+        """
+        removes a key, no error if it is not there
+        """
+        try:
+            os.remove(self.path_for(name))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,125 @@
+"""
+Content fingerprints of what was last written to Neo4j, kept in a sqlite file next to the cache.
+On a warm cache most pull requests, comments, work items and links come back exactly as they were,
+a record whose fingerprint matches is not written again.
+Fingerprints are recorded only after the write committed.
+
+    python Fingerprints.py           counts what is recorded
+    python Fingerprints.py clear     forgets everything, do this after emptying or restoring Neo4j
+"""
+import os
+import sys
+import json
+import hashlib
+import sqlite3
+import threading
+
+def fingerprint(value):
+    """
+    :param value: json serializable, dictionaries are hashed with sorted keys
+    :returns: hex digest
+    """
+    text = json.dumps(value, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class FingerprintStore(object):
+    """
+    Last written fingerprint by kind and entity id, safe to share between processes.
+
+    :param string path:
+        sqlite file, usually in the state folder inside the cache_folder
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.checked = 0
+        self.unchanged_count = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS fingerprints (
+                                  kind TEXT NOT NULL,
+                                  id TEXT NOT NULL,
+                                  digest TEXT NOT NULL,
+                                  PRIMARY KEY (kind, id)) WITHOUT ROWID""")
+        self._conn.commit()
+
+    def unchanged(self, kind, entity_id, digest):
+        """
+        True when the entity was last written with the same fingerprint
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT digest FROM fingerprints WHERE kind = ? AND id = ?",
+                                     (kind, str(entity_id))).fetchone()
+            self.checked += 1
+            same = row is not None and row[0] == digest
+            if same:
+                self.unchanged_count += 1
+        return same
+
+    def record(self, kind, entries):
+        """
+        :param list entries: (entity id, digest) pairs whose writes have committed
+        """
+        if not entries:
+            return
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO fingerprints (kind, id, digest) VALUES (?, ?, ?)",
+                                   [(kind, str(entity_id), digest) for entity_id, digest in entries])
+            self._conn.commit()
+            self.recorded += len(entries)
+
+    def clear(self, kind=None):
+        """
+        forgets one kind or everything, the next crawl writes it all again
+        """
+        with self._lock:
+            if kind is None:
+                self._conn.execute("DELETE FROM fingerprints")
+            else:
+                self._conn.execute("DELETE FROM fingerprints WHERE kind = ?", (kind,))
+            self._conn.commit()
+
+    def counts(self):
+        """
+        :returns: list of (kind, fingerprints recorded)
+        """
+        with self._lock:
+            return self._conn.execute("SELECT kind, count(*) FROM fingerprints "
+                                      "GROUP BY kind ORDER BY kind").fetchall()
+
+    def summary(self):
+        """
+        :returns: string suitable for printing at the end of a crawl
+        """
+        return "Fingerprints checked: {0} unchanged (writes avoided): {1} recorded: {2}".format(
+            self.checked, self.unchanged_count, self.recorded)
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+def get_fingerprint_store(path):
+    """
+    One store per file per process, sqlite connections can't be shared across a fork.
+    """
+    key = (os.getpid(), path)
+    with _STORES_LOCK:
+        store = _STORES.get(key)
+        if store is None:
+            store = FingerprintStore(path)
+            _STORES[key] = store
+    return store
+
+if __name__ == '__main__':
+    from VSTSInfo import VstsInfo
+    STORE = get_fingerprint_store(VstsInfo(None, None).fingerprints_path)
+    if "clear" in sys.argv[1:]:
+        STORE.clear()
+        print("Cleared the fingerprints, the next crawl writes everything")
+    else:
+        for KIND, COUNT in STORE.counts():
+            print("{0}: {1}".format(KIND, COUNT))
@@ -0,0 +1,221 @@
+"""
+Pooled keep-alive HTTP transport used by VstsInfo to talk to VSTS.
+Connections are kept open per host so we only pay for the TCP and TLS handshake once.
+"""
+import os
+import time
+import zlib
+import threading
+import http.client
+import urllib.parse
+
+class HttpResponse(object):
+    """
+    Minimal response returned by HttpSession.get
+    """
+
+    def __init__(self, url, status, reason, headers, body, latency=0.0):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.latency = latency
+
+    def header(self, name, default=None):
+        """
+        case insensitive header lookup
+        """
+        return self.headers.get(name.lower(), default)
+
+class HttpStats(object):
+    """
+    Counters so we can see how much the connection pool is saving us.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.connections_opened = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self.total_latency = 0.0
+
+    def record(self, wire_bytes, decoded_bytes, latency, status=200):
+        """
+        records a single completed request
+        """
+        with self._lock:
+            self.requests += 1
+            if status == 304:
+                self.not_modified += 1
+            self.bytes_received += wire_bytes
+            self.bytes_decoded += decoded_bytes
+            self.total_latency += latency
+
+    def record_connection(self):
+        """
+        records that a new TCP/TLS connection had to be opened
+        """
+        with self._lock:
+            self.connections_opened += 1
+
+    @property
+    def average_latency(self):
+        """
+        average seconds per request
+        """
+        if self.requests == 0:
+            return 0.0
+        return self.total_latency / self.requests
+
+    def summary(self):
+        """
+        :returns: string suitable for printing at the end of a crawl
+        """
+        return ("HTTP requests: {0} not modified: {1} connections opened: {2} bytes received: {3} "
+                "bytes decoded: {4} average latency: {5:.3f}s").format(self.requests,
+                                                                     self.not_modified,
+                                                                     self.connections_opened,
+                                                                     self.bytes_received,
+                                                                     self.bytes_decoded,
+                                                                     self.average_latency)
+
+class HttpSession(object):
+    """
+    Keeps a pool of persistent connections per host and decodes gzip/deflate responses.
+    Thread safe, each request checks a connection out of the pool and returns it when done.
+
+    :param int max_per_host:
+        number of idle connections to keep around for each host
+    :param float timeout:
+        socket timeout in seconds
+    """
+
+    def __init__(self, max_per_host=8, timeout=60):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.stats = HttpStats()
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _new_connection(self, scheme, host):
+        self.stats.record_connection()
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout)
+        return http.client.HTTPConnection(host, timeout=self.timeout)
+
+    def _checkout(self, scheme, host):
+        with self._lock:
+            idle = self._idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(scheme, host), False
+
+    def _checkin(self, scheme, host, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self.max_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """
+        closes all idle connections
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+    def get(self, url, headers=None):
+        """
+        Makes a GET request over a pooled connection.
+        Non 2xx responses are returned, not raised, so the caller can decide what to do.
+        :returns: HttpResponse
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = path + "?" + parts.query
+        req_headers = {}
+        if headers:
+            req_headers.update(headers)
+        req_headers["Accept-Encoding"] = "gzip, deflate"
+        req_headers["Connection"] = "keep-alive"
+
+        start = time.time()
+        conn, reused = self._checkout(parts.scheme, parts.netloc)
+        try:
+            conn.request("GET", path, headers=req_headers)
+            response = conn.getresponse()
+            raw = response.read()
+        except (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+            #the server closed an idle keep-alive connection, try once more on a fresh one
+            conn = self._new_connection(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", path, headers=req_headers)
+                response = conn.getresponse()
+                raw = response.read()
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        resp_headers = {}
+        for key, value in response.getheaders():
+            resp_headers[key.lower()] = value
+        body = self.decode_body(raw, resp_headers.get("content-encoding"))
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(parts.scheme, parts.netloc, conn)
+
+        latency = time.time() - start
+        self.stats.record(len(raw), len(body), latency, response.status)
+        return HttpResponse(url, response.status, response.reason, resp_headers, body, latency)
+
+    def decode_body(self, raw, encoding):
+        """
+        undo gzip or deflate content encoding
+        """
+        if not encoding or not raw:
+            return raw
+        encoding = encoding.lower()
+        if encoding == "gzip":
+            return zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+        if encoding == "deflate":
+            try:
+                return zlib.decompress(raw)
+            except zlib.error:
+                #some servers send raw deflate without the zlib header
+                return zlib.decompress(raw, -zlib.MAX_WBITS)
+        return raw
+
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+def get_session(max_per_host=8, timeout=60):
+    """
+    One session per process, sessions can't be shared across a fork
+    so multiprocessing.Pool workers each get their own.
+    The settings are only used when the session is first created.
+    """
+    pid = os.getpid()
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(pid)
+        if session is None:
+            session = HttpSession(max_per_host, timeout)
+            _SESSIONS.clear()
+            _SESSIONS[pid] = session
+    return session
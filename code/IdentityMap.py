@@ -0,0 +1,255 @@
+"""
+In-process identity map for nodes that are looked up over and over,
+people, repositories and projects. Resolved nodes are kept in a bounded LRU
+so a person who wrote thousands of comments is only queried once.
+People named in work item fields are resolved through a name index instead of regex queries.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+class IdentityMap(object):
+    """
+    Bounded LRU of py2neo models keyed by label, key property and value.
+
+    :param int capacity:
+        max number of nodes kept, the least recently used are dropped first
+    """
+
+    def __init__(self, capacity=50000):
+        self.capacity = max(1, capacity)
+        self._nodes = OrderedDict()
+        self._lock = threading.Lock()
+        self.preloaded = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model, value, key=None):
+        """
+        :returns: (label, property, value), the property defaults to the model primary key
+        """
+        return (model.__primarylabel__, key or model.__primarykey__, value)
+
+    def put(self, graph_object, key=None):
+        """
+        remembers a node, for example one that was just created
+        """
+        model = type(graph_object)
+        value = getattr(graph_object, key or model.__primarykey__)
+        if value is None:
+            return
+        with self._lock:
+            self._put(self.make_key(model, value, key), graph_object)
+
+    def _put(self, cache_key, graph_object):
+        self._nodes[cache_key] = graph_object
+        self._nodes.move_to_end(cache_key)
+        while len(self._nodes) > self.capacity:
+            self._nodes.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, graph, model, value, key=None):
+        """
+        Resolves a node from memory, falling back to Neo4j on a miss.
+        Nodes that are not in Neo4j are not remembered, they may be created later.
+
+        :param model:
+            py2neo GraphObject class such as Person
+        :param string key:
+            property to match on, the primary key when None
+        :returns: the model or None
+        """
+        if value is None:
+            return None
+        cache_key = self.make_key(model, value, key)
+        with self._lock:
+            graph_object = self._nodes.get(cache_key)
+            if graph_object is not None:
+                self._nodes.move_to_end(cache_key)
+                self.hits += 1
+                return graph_object
+            self.misses += 1
+        if key is None or key == model.__primarykey__:
+            graph_object = model.select(graph, value).first()
+        else:
+            graph_object = model.select(graph).where(**{key: value}).first()
+        if graph_object is not None:
+            with self._lock:
+                self._put(cache_key, graph_object)
+        return graph_object
+
+    def preload(self, graph, model, key=None):
+        """
+        Loads every node of a model once per process, up to the capacity.
+        """
+        preload_key = self.make_key(model, None, key)
+        if preload_key in self.preloaded:
+            return
+        count = 0
+        for graph_object in model.select(graph).limit(self.capacity):
+            self.put(graph_object, key)
+            count += 1
+        self.preloaded.add(preload_key)
+        print("Identity map preloaded {0} {1} nodes".format(count, model.__primarylabel__))
+
+    def summary(self):
+        """
+        :returns: string suitable for printing at the end of a crawl
+        """
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        return "Identity map: {0} nodes hits: {1} misses: {2} hit ratio: {3:.1%} evictions: {4}".format(
+            len(self._nodes), self.hits, self.misses, ratio, self.evictions)
+
+class PersonNameIndex(object):
+    """
+    Resolves people by unique name or display name, as VSTS writes them in
+    work item fields like "John Doe <john_doe@example.com>".
+    Built from a single query, names not found are looked up once with a
+    parameterized exact match and then remembered as missing.
+    """
+
+    QUERY = """MATCH (p:Person)
+               RETURN p.Id AS Id, p.Name AS Name, p.UniqueName AS UniqueName"""
+    LOOKUP_QUERY = """MATCH (p:Person)
+                      WHERE p.UniqueName = $unique_name OR p.Name = $name
+                      RETURN p.Id AS Id, p.Name AS Name, p.UniqueName AS UniqueName
+                      LIMIT 1"""
+
+    def __init__(self):
+        self._ids = {}
+        self._missing = set()
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+
+    @staticmethod
+    def normalize(name):
+        """
+        case and white space insensitive form of a name
+        """
+        if not name:
+            return None
+        return " ".join(name.split()).casefold()
+
+    @staticmethod
+    def split_identity(raw):
+        """
+        :param raw:
+            "Display Name <unique name>" or an identity dictionary
+        :returns: (display name, unique name) either can be None
+        """
+        if isinstance(raw, dict):
+            return raw.get("displayName"), raw.get("uniqueName")
+        raw = raw.strip()
+        if raw.endswith(">") and "<" in raw:
+            name, _, unique_name = raw[:-1].rpartition("<")
+            return name.strip() or None, unique_name.strip() or None
+        return raw, None
+
+    def keys_for(self, name, unique_name):
+        """
+        normalized names to try, unique name first
+        """
+        return [key for key in (self.normalize(unique_name), self.normalize(name)) if key]
+
+    def find(self, raw):
+        """
+        looks a name up in what is already indexed, never queries Neo4j
+        :returns: Id of the person or None
+        """
+        if not raw:
+            return None
+        for key in self.keys_for(*self.split_identity(raw)):
+            if key in self._ids:
+                return self._ids[key]
+        return None
+
+    def add(self, person_id, name=None, unique_name=None):
+        """
+        indexes a person by both of its names
+        """
+        with self._lock:
+            for key in (self.normalize(unique_name), self.normalize(name)):
+                if key is not None:
+                    self._ids[key] = person_id
+
+    def load(self, graph):
+        """
+        indexes every person in Neo4j, once per process
+        """
+        if self.loaded:
+            return
+        for row in graph.run(self.QUERY):
+            self.add(row["Id"], row["Name"], row["UniqueName"])
+        self.loaded = True
+        print("Person name index loaded {0} names".format(len(self._ids)))
+
+    def lookup(self, graph, raw):
+        """
+        :returns: Id of the person or None
+        """
+        if not raw:
+            return None
+        name, unique_name = self.split_identity(raw)
+        keys = self.keys_for(name, unique_name)
+        with self._lock:
+            for key in keys:
+                if key in self._ids:
+                    self.hits += 1
+                    return self._ids[key]
+            self.misses += 1
+            if tuple(keys) in self._missing:
+                return None
+        self.queries += 1
+        rows = list(graph.run(self.LOOKUP_QUERY, name=name, unique_name=unique_name))
+        if not rows:
+            with self._lock:
+                self._missing.add(tuple(keys))
+            return None
+        row = rows[0]
+        self.add(row["Id"], row["Name"], row["UniqueName"])
+        return row["Id"]
+
+    def summary(self):
+        """
+        :returns: string suitable for printing at the end of a crawl
+        """
+        return "Person names: {0} indexed hits: {1} misses: {2} queries: {3} not found: {4}".format(
+            len(self._ids), self.hits, self.misses, self.queries, len(self._missing))
+
+_MAPS = {}
+_MAPS_LOCK = threading.Lock()
+
+def get_identity_map(capacity=50000):
+    """
+    One identity map per process so every worker in the process shares it.
+    The capacity is only used when the map is first created.
+    """
+    pid = os.getpid()
+    with _MAPS_LOCK:
+        identity_map = _MAPS.get(pid)
+        if identity_map is None:
+            identity_map = IdentityMap(capacity)
+            _MAPS.clear()
+            _MAPS[pid] = identity_map
+    return identity_map
+
+_NAME_INDEXES = {}
+
+def get_person_name_index():
+    """
+    One person name index per process.
+    """
+    pid = os.getpid()
+    with _MAPS_LOCK:
+        index = _NAME_INDEXES.get(pid)
+        if index is None:
+            index = PersonNameIndex()
+            _NAME_INDEXES.clear()
+            _NAME_INDEXES[pid] = index
+    return index
@@ -0,0 +1,151 @@
+"""
+Progress journal so a crashed crawl picks up where it stopped.
+Crawlers record each unit of work once it is safely in Neo4j, a repository of pull requests
+or a pull request of comments or work items, and skip recorded units on the next run.
+A scope, usually a project, is cleared once the stage finished it so the next run crawls it again.
+
+    python Journal.py           lists what is recorded
+    python Journal.py clear     forgets everything so the next run starts over
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+
+class Journal(object):
+    """
+    Completed units by stage and scope in a sqlite file, safe to share between processes.
+
+    :param string path:
+        sqlite file, usually in the state folder inside the cache_folder
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.skipped = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS units (
+                                  stage TEXT NOT NULL,
+                                  scope TEXT NOT NULL,
+                                  unit TEXT NOT NULL,
+                                  finished REAL NOT NULL,
+                                  result TEXT,
+                                  PRIMARY KEY (stage, scope, unit)) WITHOUT ROWID""")
+        self._conn.commit()
+
+    def done(self, stage, scope):
+        """
+        :returns: dictionary of the units already done to what was recorded with them
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT unit, result FROM units WHERE stage = ? AND scope = ?",
+                                      (stage, str(scope))).fetchall()
+        return {unit: None if result is None else json.loads(result) for unit, result in rows}
+
+    def is_done(self, stage, scope, unit):
+        """
+        True when a single unit was already done, counted as skipped
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM units WHERE stage = ? AND scope = ? AND unit = ?",
+                                     (stage, str(scope), str(unit))).fetchone()
+            if row is not None:
+                self.skipped += 1
+        return row is not None
+
+    def remaining(self, stage, scope, units, key=str):
+        """
+        :param function key:
+            turns a unit into the string it is recorded under
+        :returns: the units not done yet, in their original order
+        """
+        units = list(units)
+        done = self.done(stage, scope)
+        if not done:
+            return units
+        left = [unit for unit in units if key(unit) not in done]
+        with self._lock:
+            self.skipped += len(units) - len(left)
+        print("Journal: skipping {0} {1} units already done for {2}".format(len(units) - len(left),
+                                                                          stage, scope))
+        return left
+
+    def record(self, stage, scope, units, result=None):
+        """
+        records units as done, call it only once their writes are committed
+        :param result: json serializable value kept with every unit, such as ids a later stage needs
+        """
+        units = [str(unit) for unit in units]
+        if not units:
+            return
+        payload = None if result is None else json.dumps(result)
+        finished = time.time()
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO units (stage, scope, unit, finished, result) "
+                                   "VALUES (?, ?, ?, ?, ?)",
+                                   [(stage, str(scope), unit, finished, payload) for unit in units])
+            self._conn.commit()
+            self.recorded += len(units)
+
+    def clear(self, stage=None, scope=None):
+        """
+        forgets a finished scope, every scope of a stage, or everything
+        """
+        qry = "DELETE FROM units"
+        params = []
+        if stage is not None:
+            qry += " WHERE stage = ?"
+            params.append(stage)
+            if scope is not None:
+                qry += " AND scope = ?"
+                params.append(str(scope))
+        with self._lock:
+            self._conn.execute(qry, params)
+            self._conn.commit()
+
+    def scopes(self):
+        """
+        :returns: list of (stage, scope, units done)
+        """
+        with self._lock:
+            return self._conn.execute("SELECT stage, scope, count(*) FROM units "
+                                      "GROUP BY stage, scope ORDER BY stage, scope").fetchall()
+
+    def summary(self):
+        """
+        :returns: string suitable for printing at the end of a crawl
+        """
+        return "Journal units recorded: {0} skipped as already done: {1}".format(self.recorded, self.skipped)
+
+_JOURNALS = {}
+_JOURNALS_LOCK = threading.Lock()
+
+def get_journal(path):
+    """
+    One journal per file per process, sqlite connections can't be shared across a fork.
+    """
+    key = (os.getpid(), path)
+    with _JOURNALS_LOCK:
+        journal = _JOURNALS.get(key)
+        if journal is None:
+            journal = Journal(path)
+            _JOURNALS[key] = journal
+    return journal
+
+if __name__ == '__main__':
+    from VSTSInfo import VstsInfo
+    JOURNAL = VstsInfo(None, None).journal
+    if "clear" in sys.argv[1:]:
+        JOURNAL.clear()
+        print("Cleared the journal, the next crawl starts over")
+    else:
+        for STAGE, SCOPE, COUNT in JOURNAL.scopes():
+            print("{0} {1}: {2} units done".format(STAGE, SCOPE, COUNT))
@@ -0,0 +1,257 @@
+"""
+Orchestrator.py
+Runs the whole crawl in one process instead of the seven scripts one after another.
+Stages form a dependency graph, a stage starts as soon as the stages it needs are done
+and gets their results in memory, so ids just written are not read back from Neo4j.
+
+    python Orchestrator.py
+
+Projects, teams and users come first, then repositories and pull requests.
+Comments and work items both only need the pull requests so they run at the same time,
+work item links follow the work items and post processing runs last.
+"""
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class Stage(object):
+    """
+    :param string name:
+    :param function run:
+        called with a dictionary of the results of the stages it requires, by stage name
+    :param list requires:
+        names of the stages that must finish first
+    """
+
+    def __init__(self, name, run, requires=()):
+        self.name = name
+        self.run = run
+        self.requires = tuple(requires)
+        self.status = "waiting"
+        self.seconds = 0.0
+        self.error = None
+
+class Orchestrator(object):
+    """
+    Runs stages as a dependency graph, independent stages run concurrently on threads
+    so they share the process wide VSTS session, identity map and Neo4j connection pool.
+    A stage that fails skips everything that depends on it, the rest carry on.
+    """
+
+    def __init__(self, stages, max_workers=None):
+        self.stages = order_stages(stages)
+        self.max_workers = max_workers or len(self.stages)
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def _run_stage(self, stage):
+        inputs = {name: self.results.get(name) for name in stage.requires}
+        print("Starting stage " + stage.name)
+        start = time.time()
+        try:
+            result = stage.run(inputs)
+        finally:
+            stage.seconds = time.time() - start
+        with self._lock:
+            self.results[stage.name] = result
+        print("Finished stage {0} in {1:.1f}s".format(stage.name, stage.seconds))
+        return result
+
+    def ready(self):
+        """
+        :returns: waiting stages whose requirements are all done
+        """
+        return [stage for stage in self.stages.values() if stage.status == "waiting" and
+                all(self.stages[name].status == "done" for name in stage.requires)]
+
+    def skip_dependents(self, failed):
+        """
+        marks every stage that needs a failed stage, directly or not, as skipped
+        """
+        changed = True
+        while changed:
+            changed = False
+            for stage in self.stages.values():
+                if stage.status == "waiting" and \
+                   any(self.stages[name].status in ("failed", "skipped") for name in stage.requires):
+                    stage.status = "skipped"
+                    stage.error = "needs " + failed.name
+                    changed = True
+
+    def run(self):
+        """
+        runs every stage, then prints the timing summary
+        :returns: results by stage name
+        """
+        start = time.time()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                for stage in self.ready():
+                    stage.status = "running"
+                    running[executor.submit(self._run_stage, stage)] = stage
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        stage.status = "done"
+                        continue
+                    stage.status = "failed"
+                    stage.error = repr(error)
+                    print("Stage {0} failed".format(stage.name))
+                    traceback.print_exception(type(error), error, error.__traceback__)
+                    self.skip_dependents(stage)
+        self.print_summary(time.time() - start)
+        return self.results
+
+    def print_summary(self, total_seconds):
+        """
+        one line per stage with how long it took
+        """
+        print("Stage timings:")
+        for stage in self.stages.values():
+            line = "     {0:<16} {1:<8} {2:>8.1f}s".format(stage.name, stage.status, stage.seconds)
+            if stage.error is not None:
+                line += "  " + stage.error
+            print(line)
+        print("     {0:<16} {1:<8} {2:>8.1f}s".format("total", "", total_seconds))
+
+def order_stages(stages):
+    """
+    Stages by name, each after the stages it requires.
+    Unknown requirements and cycles are reported up front rather than leaving stages waiting forever.
+    """
+    by_name = {}
+    for stage in stages:
+        if stage.name in by_name:
+            raise ValueError("stage {0} is defined twice".format(stage.name))
+        by_name[stage.name] = stage
+    for stage in stages:
+        for name in stage.requires:
+            if name not in by_name:
+                raise ValueError("stage {0} requires unknown stage {1}".format(stage.name, name))
+    ordered = {}
+    visiting = set()
+
+    def visit(stage):
+        if stage.name in ordered:
+            return
+        if stage.name in visiting:
+            raise ValueError("stages have a cycle through " + stage.name)
+        visiting.add(stage.name)
+        for name in stage.requires:
+            visit(by_name[name])
+        ordered[stage.name] = stage
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+def per_project(projects, crawl):
+    """
+    :returns: the results of crawl by project name
+    """
+    return {project_name: crawl(project_name) for project_name in projects}
+
+def merge_keys(crawled, stored):
+    """
+    (repository id, pull request id) pairs by project, those crawled this run first
+    then the stored ones that were not
+    """
+    merged = {}
+    for project_name in list(crawled) + [name for name in stored if name not in crawled]:
+        keys = []
+        seen = set()
+        for key in list(crawled.get(project_name, [])) + list(stored.get(project_name, [])):
+            if tuple(key) not in seen:
+                seen.add(tuple(key))
+                keys.append(key)
+        merged[project_name] = keys
+    return merged
+
+def build_stages(vsts, pull_request_status="Completed"):
+    """
+    The crawl as stages, each stage hands the next what it saved:
+    project names, repository ids by project, then (repository id, pull request id) pairs by project.
+    """
+    from models import GraphBuilder
+    from ProjectsTeamsUsers import ProjectsTeamsUsersWorker
+    from Repositories import RepositoriesWorker
+    from PullRequests import PullRequestsWorker
+    from Comments import CommentsWorker
+    from WorkItems import PullReqeustWorkItemsWorker
+    from WorkItemLinks import WorkItemLinksWorker
+    from PostProcessingCmds import PostProcessingCommands
+    from Scheduler import Scheduler, get_pull_request_keys
+
+    #pull requests, comments and work items are spread over processes when there is more than one,
+    #comments and work items run their pools at the same time so they split the request budget
+    scheduler = None
+    if vsts.crawl_processes > 1:
+        scheduler = Scheduler(vsts.crawl_processes, pull_request_status, vsts.journal, pools_at_once=2)
+
+    def projects(_):
+        GraphBuilder().create_unique_constraints()
+        worker = ProjectsTeamsUsersWorker(vsts.get_request_settings(), vsts.project_whitelist, vsts)
+        raw = vsts.make_request(worker.get_vsts_projects_url())
+        names = [worker.crawl(raw_project) for raw_project in raw["value"]]
+        return [name for name in names if name is not None]
+
+    def repositories(results):
+        worker = RepositoriesWorker(vsts.get_request_settings(), vsts)
+        return per_project(results["projects"], worker.crawl)
+
+    def pull_requests(results):
+        repo_ids = results["repositories"]
+        if scheduler is not None:
+            saved = scheduler.crawl_pull_requests(repo_ids)
+        else:
+            worker = PullRequestsWorker(pull_request_status, vsts, vsts.pull_request_page_size,
+                                        incremental=vsts.incremental_crawl)
+            saved = per_project(repo_ids, lambda name: worker.crawl(name, repo_ids[name]))
+        if vsts.incremental_crawl:
+            #only recent pull requests were paged, the older ones in neo4j still get their comments and work items
+            saved = merge_keys(saved, get_pull_request_keys(repo_ids))
+        return saved
+
+    def comments(results):
+        keys = results["pull_requests"]
+        if scheduler is not None:
+            return scheduler.crawl_comments(keys, vsts.comment_batch_size)
+        worker = CommentsWorker(vsts)
+        return per_project(keys, lambda name: worker.crawl_by_project(name, keys[name]))
+
+    def work_items(results):
+        keys = results["pull_requests"]
+        if scheduler is not None:
+            return scheduler.crawl_work_items(keys)
+        worker = PullReqeustWorkItemsWorker(vsts.get_request_settings(), vsts)
+        return per_project(keys, lambda name: worker.add_pull_request_work_items(name, keys[name]))
+
+    def work_item_links(results):
+        worker = WorkItemLinksWorker(vsts)
+        return per_project(results["projects"], worker.crawl)
+
+    def post_processing(_):
+        PostProcessingCommands().run_all_commands()
+
+    return [
+        Stage("projects", projects),
+        Stage("repositories", repositories, ["projects"]),
+        Stage("pull_requests", pull_requests, ["repositories"]),
+        Stage("comments", comments, ["pull_requests"]),
+        Stage("work_items", work_items, ["pull_requests"]),
+        Stage("work_item_links", work_item_links, ["projects", "work_items"]),
+        Stage("post_processing", post_processing, ["comments", "work_items", "work_item_links"]),
+    ]
+
+if __name__ == '__main__':
+    from VSTSInfo import VstsInfo
+    print("starting the crawl")
+    VSTS = VstsInfo(None, None)
+    Orchestrator(build_stages(VSTS)).run()
+    VSTS.print_stats()
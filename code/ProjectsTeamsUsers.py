@@ -68,9 +68,8 @@ class ProjectsTeamsUsersWorker(object):
             user.UniqueName = item.get("uniqueName")
             user.MemberOf.add(team)
             print("Adding User")
-            transaction = graph.begin()
-            transaction.merge(user)
-            transaction.graph.push(user)
+            graph.merge(user)
+            graph.push(user)
 
     def add_teams_to_repo(self, project, graph):
         """
@@ -88,9 +87,8 @@ class ProjectsTeamsUsersWorker(object):
             #team.Description = item["description"]
             team.PartOf.add(project)
             print("Adding Team")
-            transaction = graph.begin()
-            transaction.merge(team)
-            transaction.graph.push(team)
+            graph.merge(team)
+            graph.push(team)
             self.add_users_to_repo(project, team, graph)
 
     def map_and_save_project(self, raw_data, graph):
@@ -123,12 +121,14 @@ class ProjectsTeamsUsersWorker(object):
     def crawl(self, raw_data):
         """
         starts doing the crawling work
+        :returns: the project name or None when it is not in the whitelist
         """
         graph = GraphBuilder().GetNewGraph()
         proj = self.map_and_save_project(raw_data, graph)
         if proj is not None:
             self.add_teams_to_repo(proj, graph)
         print("Finished Adding Projects Teams and Users")
+        return None if proj is None else proj.Name
 
 if __name__ == '__main__':
     print("starting Projects Teams and Users")
@@ -138,7 +138,8 @@ if __name__ == '__main__':
     GRAPH = GraphBuilder()
     GRAPH.create_unique_constraints()
 
-    VSTS = VstsInfo(None, None, ignore_cache=True)
+    #lists are refreshed once older than cache_ttl_list_hours, and kept in the cache for BulkExport.py
+    VSTS = VstsInfo(None, None)
 
     #tod clean up this signature mess and just pass in VSTS
     WORKER = ProjectsTeamsUsersWorker(VSTS.get_request_settings(), VSTS.project_whitelist, VSTS)
@@ -152,3 +153,4 @@ if __name__ == '__main__':
     else:
         for PROJ in PROJECTS:
             WORKER.crawl(PROJ)
+    VSTS.print_stats()
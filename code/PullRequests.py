@@ -1,12 +1,23 @@
 """
 Copys VSTS PullRequests to Neo4J
-Todo: permanently cache the completed and abandoned pull requests
 Todo: have a flag to update non-completed. This can be helpful if recently crashed
 Todo: could have a flag to not use open pull requests are older than so may days
 """
-from multiprocessing import Pool
+import socket
+import urllib.error
+from datetime import datetime, timedelta
 from VSTSInfo import VstsInfo
-from models import GraphBuilder, Repository, PullRequest, Person, WorkItem
+from CrawlEngine import PageSizer
+from models import GraphBuilder, PullRequest, get_properties
+from BatchWriter import PullRequestBatchWriter
+from StagedPipeline import StagedPipeline
+from Scheduler import Scheduler, get_repo_ids
+
+def parse_vsts_date(value):
+    '''
+    VSTS dates look like 2018-01-31T16:21:38.1234567Z, the fraction varies in length
+    '''
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
 
 class PullRequestsWorker(object):
     '''
@@ -22,15 +33,22 @@ class PullRequestsWorker(object):
         stuff needed to connect to VSTS
 
     :param int num_per_request:
-        number of pull requests to get per request
-        we don't want to get too many it might take too long or fail in other ways
+        number of pull requests to start each repository with,
+        the page size then follows how quickly VSTS answers, see PageSizer
+
+    :param bool incremental:
+        only crawl completed or abandoned pull requests closed since the last crawl,
+        see crawl_repository for how the watermark is used
 
     '''
 
-    def __init__(self, pull_request_status, vsts, num_per_request=10):
+    IMMUTABLE_STATUSES = ("completed", "abandoned")
+
+    def __init__(self, pull_request_status, vsts, num_per_request=100, incremental=False):
         self.num_per_request = num_per_request
         self.vsts = vsts
         self.pull_request_status = pull_request_status
+        self.incremental = incremental
 
     def crawl_projects(self, projects):
         """
@@ -51,31 +69,208 @@ class PullRequestsWorker(object):
             repo_ids.append(raw_repo_id.get('n.Id'))
         return repo_ids
 
-    def crawl(self, project_name):
+    def crawl(self, project_name, repo_ids=None, clear_journal=True):
         '''
         For a single project, gets the pull requests
             from VSTS and saves them to a neo4j database instance
-        The list of repositories comes from neo4j, so that import must be done first.
+        The list of repositories comes from neo4j, so that import must be done first,
+        unless the repository ids are passed in.
 
         :param project_name:
+        :param bool clear_journal:
+            forget the repositories done once the project is finished, see Journal
+        :returns: (repository id, pull request id) of every pull request saved
         '''
 
         graph = GraphBuilder().GetNewGraph()
-        repo_ids = self.get_repo_ids(graph, project_name)
+        if repo_ids is None:
+            repo_ids = self.get_repo_ids(graph, project_name)
+        saved = []
         for repo_id in repo_ids:
-            skip = 0 #part of vsts pagination
-            while True:
-                url = self.get_vsts_pull_request_url(project_name, repo_id, skip)
-                raw_pulls = self.vsts.make_request(url)
-                if not self.has_data_to_parse(raw_pulls):
-                    break
-                skip = skip + self.num_per_request #increment pagination for vsts api call
-                for raw_pull_req in raw_pulls["value"]:
-                    self.map_and_save_pull_request(graph, raw_pull_req)
+            for pull_request_id in self.crawl_repository_once(graph, project_name, repo_id):
+                saved.append((repo_id, pull_request_id))
 
+        if clear_journal:
+            self.vsts.journal.clear(self.journal_stage, project_name)
         print("Ending PullRequest Crawl for Project " + project_name)
+        return saved
+
+    @property
+    def journal_stage(self):
+        '''
+        journal stage name, one per status
+        '''
+        return "pull_requests." + self.pull_request_status.lower()
+
+    def crawl_repository_once(self, graph, project_name, repo_id):
+        '''
+        crawl_repository unless the journal says an unfinished crawl already did it
+        :returns: ids of the pull requests saved, by this crawl or the one recorded in the journal
+        '''
+        journal = self.vsts.journal
+        if journal.is_done(self.journal_stage, project_name, repo_id):
+            print("Journal: repository {0} already done".format(repo_id))
+            return journal.done(self.journal_stage, project_name)[repo_id] or []
+        pull_request_ids = self.crawl_repository(graph, project_name, repo_id)
+        journal.record(self.journal_stage, project_name, [repo_id], pull_request_ids)
+        return pull_request_ids
+
+    def crawl_repository(self, graph, project_name, repo_id):
+        '''
+        Pages through the pull requests of one repository and saves them.
+
+        Page sizes adapt as we go and an empty page ends the repository.
+        VSTS may return fewer than $top pull requests, so paging carries on after the first short page
+        from where it left off, and when more come back the page size is capped to what VSTS returned.
+        Once the cap is known, or VSTS already served a bigger page in full, a short page is the last one.
+        In incremental mode paging stops once a whole page was closed before the
+        watermark minus the lookback window. The watermark is the newest closedDate saved,
+        so a pull request created long ago but completed since the last crawl is still picked up.
+        The lookback allows for pull requests that are not listed strictly by closedDate.
+        :returns: ids of the pull requests saved
+        '''
+        watermark = self.get_watermark(repo_id)
+        stop_before = None
+        if watermark is not None:
+            stop_before = parse_vsts_date(watermark) - timedelta(days=self.vsts.incremental_lookback_days)
+            print("Incremental crawl of repository {0} since {1}".format(repo_id, watermark))
+        newest = watermark
+        saved = []
+
+        writer = PullRequestBatchWriter(graph, self.vsts.neo4j_batch_size,
+                                        fingerprints=self.vsts.fingerprints)
+        pipeline = StagedPipeline(self.fetch_pull_request, self.map_pull_request, writer,
+                                  self.vsts.pipeline_fetch_workers, self.vsts.pipeline_map_workers,
+                                  self.vsts.pipeline_queue_size)
+        sizer = PageSizer(self.num_per_request, self.vsts.pull_request_min_page_size,
+                          self.vsts.pull_request_max_page_size)
+        #closing the pipeline waits for the last pull requests to be written
+        with pipeline:
+            window = 1 #pages fetched at once, grows while pages come back full
+            skip = 0 #part of vsts pagination
+            short_page = None #size of the last short page, until we know whether it was the end
+            cap = None #most pull requests vsts hands out per page, once a short page turned out not to be the last
+            served = 0 #biggest page vsts returned in full
+            finished = False
+            while not finished:
+                top = sizer.size
+                full = top if cap is None else min(top, cap) #pull requests on a page that is not the last
+                urls = []
+                for page in range(window):
+                    urls.append(self.get_vsts_pull_request_url(project_name, repo_id,
+                                                               skip + page * full, top))
+                try:
+                    pages = self.fetch_pages(urls, sizer)
+                except (socket.timeout, urllib.error.HTTPError) as error:
+                    if isinstance(error, urllib.error.HTTPError) and error.code < 500:
+                        raise
+                    if not sizer.shrink():
+                        raise
+                    print("Page of {0} pull requests failed, trying {1}".format(top, sizer.size))
+                    window = 1
+                    continue
+                restart = False
+                for raw_pulls in pages:
+                    if not self.has_data_to_parse(raw_pulls):
+                        finished = True
+                        break
+                    if short_page is not None:
+                        #more after a short page, vsts caps $top
+                        sizer.cap(short_page)
+                        cap = short_page
+                        full = min(top, cap)
+                        short_page = None
+                    skip = skip + len(raw_pulls["value"]) #increment pagination for vsts api call
+                    for raw_pull_req in raw_pulls["value"]:
+                        #details are fetched, mapped and written on the pipeline threads
+                        pipeline.put(raw_pull_req)
+                        saved.append(raw_pull_req.get("pullRequestId"))
+                        closed = self.watermark_date(raw_pull_req)
+                        if closed and (newest is None or closed > newest):
+                            newest = closed
+                    if stop_before is not None and self.is_before(raw_pulls, stop_before):
+                        print("Reached already crawled pull requests for repository " + repo_id)
+                        finished = True
+                        break
+                    count = len(raw_pulls["value"])
+                    if count >= full:
+                        served = max(served, count)
+                    elif cap is not None or count < served:
+                        finished = True
+                        break
+                    else:
+                        #the last page or a capped one, the rest of the window asked from the wrong $skip
+                        short_page = count
+                        restart = True
+                        break
+                window = 1 if restart else min(window * 2, self.vsts.crawl_concurrency)
+
+        print("Pull requests for repository {0} {1}".format(repo_id, sizer.summary()))
+        print(pipeline.summary())
+        print(writer.summary())
+        if self.uses_watermark and newest is not None:
+            self.vsts.crawl_state.set(self.watermark_name(repo_id), newest)
+        return saved
+
+    @property
+    def uses_watermark(self):
+        '''
+        active pull requests can still change so they are always crawled in full
+        '''
+        return self.incremental and self.pull_request_status.lower() in self.IMMUTABLE_STATUSES
+
+    def watermark_name(self, repo_id):
+        '''
+        crawl state key for a repository watermark
+        '''
+        return "pull_requests." + self.pull_request_status.lower() + "." + repo_id
+
+    def watermark_date(self, raw_pull_req):
+        '''
+        closedDate of a completed or abandoned pull request, creationDate if VSTS left it out
+        '''
+        return raw_pull_req.get("closedDate") or raw_pull_req.get("creationDate")
+
+    def get_watermark(self, repo_id):
+        '''
+        newest closedDate saved by the last incremental crawl of the repository
+        :returns: string or None when the repository should be crawled in full
+        '''
+        if not self.uses_watermark:
+            return None
+        return self.vsts.crawl_state.get(self.watermark_name(repo_id))
+
+    def is_before(self, raw_pulls, stop_before):
+        '''
+        True when every pull request on the page was closed before stop_before
+        '''
+        for raw_pull_req in raw_pulls["value"]:
+            closed = self.watermark_date(raw_pull_req)
+            if closed is None or parse_vsts_date(closed) >= stop_before:
+                return False
+        return True
 
-    def get_vsts_pull_request_url(self, project_name, repository_id, skip):
+    def fetch_pages(self, urls, sizer):
+        '''
+        Fetches a window of pages at once and tells the sizer how long they took and how big they were.
+        Only these page requests are timed, pull request details fetched at the same time
+        on the pipeline threads don't count.
+        :returns: list of raw pages in the same order as urls
+        '''
+        timings = {}
+        try:
+            self.vsts.prefetch(urls, timings=timings)
+            pages = [self.vsts.make_request(url, timings=timings) for url in urls]
+        finally:
+            self.vsts.discard_prefetched(urls)
+        if timings:
+            sizer.record(len(urls), sum(latency for latency, _ in timings.values()) / len(timings),
+                         sum(size for _, size in timings.values()) / len(timings))
+        else:
+            sizer.record(len(urls), None, 0)
+        return pages
+
+    def get_vsts_pull_request_url(self, project_name, repository_id, skip, top=None):
         '''
         returns a string
         '''
@@ -90,7 +285,7 @@ class PullRequestsWorker(object):
                              project_name,
                              repository_id,
                              self.vsts.api_version,
-                             self.num_per_request,
+                             top or self.num_per_request,
                              skip,
                              self.pull_request_status)
                            )
@@ -113,16 +308,13 @@ class PullRequestsWorker(object):
         pull_request.ClosedDate = item.get("closedDate")
         return pull_request
 
-    def link_repository(self, pull_request, vsts_info, graph):
+    def link_repository(self, writer, pull_request, vsts_info):
         '''
-        links a git repository to a pull request
+        links a git repository to a pull request,
+        a bare repository is added when it is not in Neo4j yet
         '''
         repo_id = vsts_info["repository"]["id"]
-        repo = Repository.select(graph, repo_id).first()
-        if repo is not None:
-            pull_request.ForRepository.add(repo)
-        else:
-            print("could not find repositry for pull request we have a problem.")
+        writer.add("repositories", {"Id": pull_request.Id, "RepositoryId": repo_id})
 
     def link_branches(self, pull_request, vsts_info):
         '''
@@ -155,35 +347,26 @@ class PullRequestsWorker(object):
 
         #    pull_request.TargetBranch.add(t_branch)
 
-    def link_reviewers(self, pull_request, vsts_info, graph):
+    def link_reviewers(self, writer, pull_request, vsts_info):
         '''
-        links reviewers to the pull request
+        links reviewers to the pull request,
+        a bare person is added for reviewers not in Neo4j yet
         '''
         for reviewer_info in vsts_info["reviewers"]:
-            rev_id = reviewer_info.get("id")
-            reviewer = Person.select(graph, rev_id).first()
-            if reviewer is not None:
-                pull_request.ReviewedBy.add(reviewer)
+            writer.add("reviewers", {"Id": pull_request.Id, "PersonId": reviewer_info.get("id")})
 
-    def link_created_by(self, pull_request, vsts_info, graph):
+    def link_created_by(self, writer, pull_request, vsts_info):
         '''
-        link the pull request to the person who created it
+        link the pull request to the person who created it,
+        a bare person is added when the user is not in Neo4j yet
         '''
         raw = vsts_info.get("createdBy")
-        user_id = raw.get("id")
-        created_by = Person.select(graph, user_id).first()
-        if created_by:
-            pull_request.CreatedBy.add(created_by)
-        else:
-            print("Pull Request CreatedBy User not in db")
-            user = Person()
-            user.Id = user_id
-            pull_request.CreatedBy.add(user)
+        writer.add("created_by", {"Id": pull_request.Id, "PersonId": raw.get("id")})
 
-    def link_work_items(self, pull_request, raw, graph):
+    def get_work_item_links(self, raw):
         """
-        if a pull request has links, this will crawl the links and link the work items.
-        If the work item does not exist a new one will be created and hopefully added.
+        if a pull request has links, this will crawl the links to its work items.
+        :returns: list of work item links, empty when there are none
         """
         real_url = raw.get("url")
         data = self.vsts.make_request(real_url)
@@ -191,39 +374,25 @@ class PullRequestsWorker(object):
         links = data.get("_links")
         if links is None:
             print("Could not find links")
-            return
+            return []
         work_items_url = links.get("workItems")
         if work_items_url is None:
             print("no work items")
-            return
+            return []
         href = work_items_url.get("href")
         if href is None:
-            print("no href found for " + str(pull_request.Id))
+            print("no href found for " + str(raw.get("pullRequestId")))
+            return []
         work_item_links = self.vsts.make_request(href)
-        for wi_link in work_item_links.get("value"):
-            work_item_id = wi_link.get("id")
-            work_item = WorkItem.select(graph, work_item_id).first()
-            if work_item is None:
-                work_item = WorkItem()
-                work_item.Id = work_item_id
-                graph.create(work_item)
-                print("new work item added " + str(work_item.Id))
-            work_item.LinkedTo.add(pull_request)
-            graph.push(work_item)
-
-    def get_pull_request_neo4j(self, graph, pull_req_id):
+        return work_item_links.get("value")
+
+    def link_work_items(self, writer, pull_request, work_item_links):
         """
-        loads an existing Neo4j pull request or creates a new bare minimum one in the database
-        :param graph: py2neo PullRequest
-        :returns: from Neo4j either a new or existing PullRequest
+        links the work items to the pull request.
+        If the work item does not exist a new one will be created and hopefully added.
         """
-        pull = PullRequest.select(graph, pull_req_id).first()
-        if pull is None:
-            pull = PullRequest()
-            pull.Id = pull_req_id
-            graph.create(pull)
-        return pull
-
+        for wi_link in work_item_links:
+            writer.add("work_items", {"Id": pull_request.Id, "WorkItemId": str(wi_link.get("id"))})
 
     def has_data_to_parse(self, raw_vsts_data):
         """
@@ -239,25 +408,43 @@ class PullRequestsWorker(object):
         else:
             return False
 
-    def map_and_save_pull_request(self, graph, raw_pull_req):
+    def fetch_pull_request(self, raw_pull_req):
+        """
+        pipeline fetch stage, the VSTS requests a pull request needs before it can be mapped
+        :returns: (raw pull request, work item links)
+        """
+        return raw_pull_req, self.get_work_item_links(raw_pull_req)
+
+    def map_pull_request(self, writer, fetched):
+        """
+        pipeline map stage
+        """
+        raw_pull_req, work_item_links = fetched
+        self.map_and_save_pull_request(writer, raw_pull_req, work_item_links)
+
+    def map_and_save_pull_request(self, writer, raw_pull_req, work_item_links=None):
         """
-        maps raw data from VSTS and saves to Neo4j database
+        maps raw data from VSTS and queues it on the batch writer,
+        it is saved to Neo4j when the writer flushes
 
-        :param graph: py2neo graph object
+        :param PullRequestBatchWriter writer:
         :param raw_pull_req: raw api result form VSTS for a single pulll request
+        :param list work_item_links: fetched here when not given
+        :returns: the pull request id
         """
-        pull_id = str(raw_pull_req.get("pullRequestId"))
-        print("working pull request " + pull_id)
-        pull = self.get_pull_request_neo4j(graph, pull_id)
+        if work_item_links is None:
+            work_item_links = self.get_work_item_links(raw_pull_req)
+        pull = PullRequest()
         self.map_pull_request_parameters(pull, raw_pull_req)
-        graph.merge(pull)
-        self.link_repository(pull, raw_pull_req, graph)
         self.link_branches(pull, raw_pull_req)
-        self.link_reviewers(pull, raw_pull_req, graph)
-        self.link_created_by(pull, raw_pull_req, graph)
-        self.link_work_items(pull, raw_pull_req, graph)
-        graph.push(pull)
-        print("saved pull request " + str(pull.Id))
+        writer.add("pull_requests", {"Id": pull.Id, "props": get_properties(pull)})
+        self.link_repository(writer, pull, raw_pull_req)
+        self.link_reviewers(writer, pull, raw_pull_req)
+        self.link_created_by(writer, pull, raw_pull_req)
+        self.link_work_items(writer, pull, work_item_links)
+        writer.record_done(pull.Id)
+        print("mapped pull request " + str(pull.Id))
+        return pull.Id
 
 if __name__ == '__main__':
     print("starting PullRequests")
@@ -269,10 +456,13 @@ if __name__ == '__main__':
 
     VSTS = VstsInfo(None, None)
     PULL_REQUEST_STATUS = "Completed"
-    WORKER = PullRequestsWorker(PULL_REQUEST_STATUS, VSTS)
+    WORKER = PullRequestsWorker(PULL_REQUEST_STATUS, VSTS, VSTS.pull_request_page_size,
+                                incremental=VSTS.incremental_crawl)
 
     if RUN_MULTITHREADED:
-        with Pool(5) as p:
-            p.map(WORKER.crawl, VSTS.project_whitelist)
+        SCHEDULER = Scheduler(VSTS.crawl_processes, PULL_REQUEST_STATUS, VSTS.journal)
+        SCHEDULER.crawl_pull_requests(get_repo_ids(VSTS.project_whitelist))
+        print(SCHEDULER.summary())
     else:
         WORKER.crawl_projects(VSTS.project_whitelist)
+    VSTS.print_stats()
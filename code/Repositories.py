@@ -24,12 +24,14 @@ class RepositoriesWorker(object):
     def crawl(self, project_name):
         """
         Gets Repositories for a given project
+        :returns: ids of the repositories saved
         """
         url = ("%s/DefaultCollection/%s/_apis/git/repositories?api-version=%s" % (self.instance, project_name, self.api_version))
         data = self.vsts.make_request(url)
 
+        graph = GraphBuilder().GetNewGraph()
+        repo_ids = []
         for r in data["value"]:
-            graph = GraphBuilder().GetNewGraph()
             #print(r["id"])
             repo = Repository()
             repo.Id = r.get("id")
@@ -52,10 +54,11 @@ class RepositoriesWorker(object):
             repo.BelongsTo.add(proj)
             print("Adding Repo: ")
             print(repo.Name)
-            transaction = graph.begin()
-            transaction.merge(repo)
-            transaction.graph.push(repo)
+            graph.merge(repo)
+            graph.push(repo)
+            repo_ids.append(repo.Id)
         print("Finished mapping repos")
+        return repo_ids
 
 
 if __name__ == '__main__':
@@ -66,8 +69,8 @@ if __name__ == '__main__':
     GRAPH = GraphBuilder()
     GRAPH.create_unique_constraints()
 
-    #If you feel your cache is up to date, then set ignore_cache to False.
-    VSTS = VstsInfo(None, None, ignore_cache=True)
+    #lists are refreshed once older than cache_ttl_list_hours, and kept in the cache for BulkExport.py
+    VSTS = VstsInfo(None, None)
     PULL_REQUEST_STATUS = "Completed"
     WORKER = RepositoriesWorker(VSTS.get_request_settings(), VSTS)
 
@@ -77,3 +80,4 @@ if __name__ == '__main__':
     else:
         for proj in VSTS.project_whitelist:
             WORKER.crawl(proj)
+    VSTS.print_stats()
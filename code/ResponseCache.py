@@ -0,0 +1,601 @@
+"""
+Content addressed cache for VSTS responses.
+Entries are keyed by a hash of the normalized url. Two backends are available:
+    files  - one json file per response spread over two levels of shard folders
+             so no single folder gets too big and long urls never hit path limits.
+    sqlite - a single file embedded database with batched writes.
+
+To import an old flat cache folder into the configured backend:
+    python ResponseCache.py migrate [--delete]
+To copy every entry from one backend to another:
+    python ResponseCache.py copy files sqlite
+To shrink the cache after lots of rewrites:
+    python ResponseCache.py compact
+To train a zstd dictionary on the cached responses (needs the zstandard package):
+    python ResponseCache.py train-dictionary [samples]
+To report compression ratios and read times on the existing cache:
+    python ResponseCache.py stats [samples]
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import sqlite3
+import hashlib
+import tempfile
+import itertools
+import threading
+import urllib.parse
+from CacheCodec import (PlainCodec, GzipCodec, ZstdCodec, EXTENSIONS,
+                        make_codec, decode_payload, load_file, zstandard)
+
+INDEX_FILE_NAME = "index.jsonl"
+SQLITE_FILE_NAME = "responses.sqlite"
+LEGACY_QUERY_MARKER = "(qm)"
+
+def normalize_url(url):
+    """
+    Lower cases the scheme and host, sorts the query string and drops any fragment
+    so the same request always maps to the same key.
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    query.sort()
+    return urllib.parse.urlunsplit((parts.scheme.lower(),
+                                    parts.netloc.lower(),
+                                    parts.path,
+                                    urllib.parse.urlencode(query),
+                                    ''))
+
+def cache_key(url):
+    """
+    :returns: sha1 hex digest of the normalized url
+    """
+    return hashlib.sha1(normalize_url(url).encode('utf-8')).hexdigest()
+
+class CacheEntry(object):
+    """
+    A cached VSTS response and the metadata kept about it.
+    """
+
+    def __init__(self, url, data, fetched, status=200, size=0, etag=None, last_modified=None):
+        self.url = url
+        self.data = data
+        self.fetched = fetched
+        self.status = status
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def age(self):
+        """
+        seconds since the response was fetched from VSTS
+        """
+        return time.time() - self.fetched
+
+class CacheBackend(object):
+    """
+    Interface every cache backend implements so VstsInfo does not care where responses live.
+    """
+
+    def get(self, url):
+        """
+        :returns: CacheEntry or None when the url is not cached
+        """
+        raise NotImplementedError()
+
+    def put(self, url, data, status=200, fetched=None, etag=None, last_modified=None):
+        """
+        saves a response, with the validators needed for a conditional refresh
+        :returns: the cache key
+        """
+        raise NotImplementedError()
+
+    def touch(self, url, fetched=None):
+        """
+        marks a cached response as just fetched without rewriting it,
+        used when VSTS answers a conditional request with 304 Not Modified
+        """
+        raise NotImplementedError()
+
+    def entries(self):
+        """
+        iterates every CacheEntry in the cache
+        """
+        raise NotImplementedError()
+
+    def flush(self):
+        """
+        writes out anything still buffered
+        """
+        pass
+
+    def compact(self):
+        """
+        reclaims space left behind by rewritten entries
+        """
+        pass
+
+class ShardedFileCache(CacheBackend):
+    """
+    Stores each response in folder/ab/cd/<sha1>.json, .json.gz or .json.zst
+    An append only index file maps keys to url, fetch time, status, size and codec.
+
+    :param string folder:
+        root of the cache, usually the cache_folder from the config file
+    :param codec:
+        CacheCodec used for new entries, entries written by other codecs can still be read
+    """
+
+    def __init__(self, folder, codec=None):
+        self.folder = folder
+        self.codec = codec if codec is not None else PlainCodec()
+        self.index_path = os.path.join(folder, INDEX_FILE_NAME)
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def index(self):
+        """
+        key -> metadata dictionary, loaded from the index file on first use
+        """
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._load_index()
+        return self._index
+
+    def _load_index(self):
+        index = {}
+        if not os.path.isfile(self.index_path):
+            return index
+        with open(self.index_path, 'r') as index_file:
+            for line in index_file:
+                try:
+                    meta = json.loads(line)
+                except ValueError:
+                    #a crash can leave a half written last line
+                    continue
+                index[meta["key"]] = meta
+        return index
+
+    def path_for(self, key, extension=".json"):
+        """
+        :returns: full path of the file for a cache key
+        """
+        return os.path.join(self.folder, key[0:2], key[2:4], key + extension)
+
+    def _find_file(self, key):
+        meta = self.index.get(key)
+        if meta is not None:
+            extensions = [meta.get("extension", ".json")]
+        else:
+            #written by another process since we loaded the index
+            extensions = EXTENSIONS
+        for extension in extensions:
+            path = self.path_for(key, extension)
+            try:
+                return open(path, 'rb'), path, meta
+            except FileNotFoundError:
+                continue
+        return None, None, None
+
+    def get(self, url):
+        """
+        :returns: CacheEntry or None when the url is not cached
+        """
+        key = cache_key(url)
+        data_file, path, meta = self._find_file(key)
+        if data_file is None:
+            return None
+        with data_file:
+            data = load_file(data_file, self.folder)
+        if meta is None:
+            meta = {"url": url, "fetched": os.path.getmtime(path), "status": 200,
+                    "size": os.path.getsize(path)}
+        return CacheEntry(url, data, meta["fetched"], meta.get("status", 200), meta.get("size", 0),
+                          meta.get("etag"), meta.get("last_modified"))
+
+    def put(self, url, data, status=200, fetched=None, etag=None, last_modified=None):
+        """
+        saves a response and records it in the index
+        """
+        key = cache_key(url)
+        path = self.path_for(key, self.codec.extension)
+        payload = self.codec.encode(data)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #write then rename so a reader never sees half a file
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(handle, 'wb') as data_file:
+            data_file.write(payload)
+        os.replace(tmp_path, path)
+
+        old_meta = self.index.get(key)
+        if old_meta is not None and old_meta.get("extension", ".json") != self.codec.extension:
+            #the codec changed since this entry was last written
+            try:
+                os.remove(self.path_for(key, old_meta.get("extension", ".json")))
+            except FileNotFoundError:
+                pass
+
+        meta = {"key": key,
+                "url": url,
+                "fetched": fetched if fetched is not None else time.time(),
+                "status": status,
+                "size": len(payload),
+                "extension": self.codec.extension,
+                "etag": etag,
+                "last_modified": last_modified}
+        self._append_index(meta)
+        return key
+
+    def touch(self, url, fetched=None):
+        """
+        appends a new index line with a fresh fetch time, the file is left alone.
+        Entries written by another process since we loaded the index are described from their file.
+        """
+        key = cache_key(url)
+        meta = self.index.get(key)
+        if meta is None:
+            data_file, path, _ = self._find_file(key)
+            if data_file is None:
+                return
+            data_file.close()
+            meta = {"key": key, "url": url, "status": 200, "size": os.path.getsize(path),
+                    "extension": path[len(self.path_for(key, "")):]}
+        meta = dict(meta)
+        meta["fetched"] = fetched if fetched is not None else time.time()
+        self._append_index(meta)
+
+    def _append_index(self, meta):
+        line = json.dumps(meta) + '\n'
+        with self._lock:
+            if self._index is not None:
+                self._index[meta["key"]] = meta
+            with open(self.index_path, 'a') as index_file:
+                index_file.write(line)
+
+    def entries(self):
+        """
+        iterates every CacheEntry listed in the index
+        """
+        for meta in list(self.index.values()):
+            entry = self.get(meta["url"])
+            if entry is not None:
+                yield entry
+
+    def compact(self):
+        """
+        rewrites the index with one line per key
+        """
+        self.compact_index()
+
+    def compact_index(self):
+        """
+        rewrites the index with one line per key, later lines win
+        """
+        index = self._load_index()
+        handle, tmp_path = tempfile.mkstemp(dir=self.folder)
+        with os.fdopen(handle, 'w') as index_file:
+            for meta in index.values():
+                index_file.write(json.dumps(meta) + '\n')
+        os.replace(tmp_path, self.index_path)
+        with self._lock:
+            self._index = index
+
+class SqliteCache(CacheBackend):
+    """
+    Keeps every response in one SQLite file.
+    Writes are buffered and committed in batches, reads check the buffer first.
+
+    :param string path:
+        sqlite database file
+    :param int batch_size:
+        number of puts to buffer before committing
+    :param float flush_interval:
+        seconds after which a partial batch is committed by the next put,
+        multiprocessing.Pool workers never run atexit handlers so Scheduler flushes after every task
+    :param codec:
+        CacheCodec used for new entries, entries written by other codecs can still be read
+    """
+
+    COLUMNS = "key, url, fetched, status, size, body, etag, last_modified"
+
+    def __init__(self, path, batch_size=100, flush_interval=5.0, codec=None):
+        self.path = path
+        self.codec = codec if codec is not None else PlainCodec()
+        self.dictionary_folder = os.path.dirname(path)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._last_flush = time.time()
+        self._lock = threading.RLock()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                  key TEXT PRIMARY KEY,
+                                  url TEXT NOT NULL,
+                                  fetched REAL NOT NULL,
+                                  status INTEGER NOT NULL,
+                                  size INTEGER NOT NULL,
+                                  body BLOB NOT NULL,
+                                  etag TEXT,
+                                  last_modified TEXT) WITHOUT ROWID""")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(responses)")]
+        for column in ("etag", "last_modified"):
+            if column not in columns:
+                #databases made before conditional requests were supported
+                self._conn.execute("ALTER TABLE responses ADD COLUMN " + column + " TEXT")
+        self._conn.commit()
+        atexit.register(self.flush)
+
+    def get(self, url):
+        """
+        :returns: CacheEntry or None when the url is not cached
+        """
+        key = cache_key(url)
+        with self._lock:
+            row = self._pending.get(key)
+            if row is None:
+                row = self._conn.execute("SELECT " + self.COLUMNS +
+                                         " FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return self._to_entry(row)
+
+    def _to_entry(self, row):
+        _, url, fetched, status, size, body, etag, last_modified = row
+        return CacheEntry(url, decode_payload(bytes(body), self.dictionary_folder),
+                          fetched, status, size, etag, last_modified)
+
+    def put(self, url, data, status=200, fetched=None, etag=None, last_modified=None):
+        """
+        buffers a response, committed once the batch is full
+        """
+        key = cache_key(url)
+        body = self.codec.encode(data)
+        row = (key, url, fetched if fetched is not None else time.time(), status, len(body), body,
+               etag, last_modified)
+        with self._lock:
+            self._pending[key] = row
+            if (len(self._pending) >= self.batch_size or
+                    time.time() - self._last_flush >= self.flush_interval):
+                self.flush()
+        return key
+
+    def touch(self, url, fetched=None):
+        """
+        updates the fetch time without rewriting the body
+        """
+        key = cache_key(url)
+        fetched = fetched if fetched is not None else time.time()
+        with self._lock:
+            row = self._pending.get(key)
+            if row is not None:
+                self._pending[key] = row[:2] + (fetched,) + row[3:]
+                return
+            self._conn.execute("UPDATE responses SET fetched = ? WHERE key = ?", (fetched, key))
+            self._conn.commit()
+
+    def flush(self):
+        """
+        commits every buffered put in one transaction
+        """
+        with self._lock:
+            self._last_flush = time.time()
+            if not self._pending:
+                return
+            rows = list(self._pending.values())
+            self._conn.executemany("INSERT OR REPLACE INTO responses (" + self.COLUMNS + ") "
+                                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+            self._pending = {}
+
+    def entries(self):
+        """
+        iterates every CacheEntry in the database
+        """
+        self.flush()
+        cursor = self._conn.execute("SELECT " + self.COLUMNS + " FROM responses")
+        for row in cursor:
+            yield self._to_entry(row)
+
+    def compact(self):
+        """
+        vacuums the database file
+        """
+        self.flush()
+        with self._lock:
+            self._conn.execute("VACUUM")
+
+def make_backend(backend, folder, batch_size=100, compression="none"):
+    """
+    :param string backend:
+        files or sqlite
+    :param string compression:
+        auto, zstd, gzip or none
+    :returns: CacheBackend
+    """
+    codec = make_codec(compression, folder)
+    if backend == "files":
+        return ShardedFileCache(folder, codec)
+    if backend == "sqlite":
+        return SqliteCache(os.path.join(folder, SQLITE_FILE_NAME), batch_size, codec=codec)
+    raise ValueError("Unknown cache_backend " + str(backend) + " expected files or sqlite")
+
+def copy_cache(source, target):
+    """
+    copies every entry from one backend to another, keeping the fetch times
+    :returns: number of entries copied
+    """
+    copied = 0
+    for entry in source.entries():
+        target.put(entry.url, entry.data, entry.status, entry.fetched,
+                   entry.etag, entry.last_modified)
+        copied += 1
+    target.flush()
+    return copied
+
+def train_dictionary(cache, sample_size=2000):
+    """
+    Trains a zstd dictionary on cached responses and saves it next to the cache,
+    new entries written with cache_compression zstd will use it.
+    :returns: dictionary id
+    """
+    if zstandard is None:
+        raise ValueError("training a dictionary needs the zstandard package")
+    plain = PlainCodec()
+    samples = [plain.encode(entry.data) for entry in itertools.islice(cache.entries(), sample_size)]
+    codec = ZstdCodec(dictionary_folder=getattr(cache, "folder", None) or cache.dictionary_folder)
+    return codec.save_dictionary(samples)
+
+def compression_report(cache, sample_size=500):
+    """
+    Re-encodes a sample of the cache with every available codec,
+    then times reading each version back from disk and decoding it.
+    :returns: list of (codec name, bytes, ratio, read seconds)
+    """
+    entries = list(itertools.islice(cache.entries(), sample_size))
+    folder = getattr(cache, "folder", None) or cache.dictionary_folder
+    codecs = [PlainCodec(), GzipCodec()]
+    if zstandard is not None:
+        codecs.append(ZstdCodec(dictionary_folder=folder))
+    results = []
+    raw_bytes = None
+    work_folder = tempfile.mkdtemp()
+    try:
+        for codec in codecs:
+            paths = []
+            total = 0
+            for number, entry in enumerate(entries):
+                payload = codec.encode(entry.data)
+                total += len(payload)
+                path = os.path.join(work_folder, str(number) + codec.extension)
+                with open(path, 'wb') as data_file:
+                    data_file.write(payload)
+                paths.append(path)
+            if raw_bytes is None:
+                raw_bytes = total
+            start = time.time()
+            for path in paths:
+                with open(path, 'rb') as data_file:
+                    load_file(data_file, folder)
+            elapsed = time.time() - start
+            ratio = float(raw_bytes) / total if total else 0.0
+            results.append((codec.name, total, ratio, elapsed))
+            for path in paths:
+                os.remove(path)
+    finally:
+        os.rmdir(work_folder)
+    return results
+
+def legacy_file_name_to_url(file_name, instance_base, cache_prefix):
+    """
+    Reverses VstsInfo.build_file_name for an old flat cache file.
+    Slashes in the query string can't be recovered, VSTS urls don't have them.
+    Slashes and dots in the path both became dots, so a dot in a project name can't be told apart.
+    Before _apis there is at most DefaultCollection and a project, or a project id on its own,
+    names with more than that are reported and skipped rather than migrated to the wrong url.
+    :returns: url string or None if the name was not made by build_file_name or is ambiguous
+    """
+    name = os.path.basename(file_name)
+    if not name.endswith(".json"):
+        return None
+    name = name[:-len(".json")]
+    path, _, query = name.partition(LEGACY_QUERY_MARKER)
+    if not path.startswith(cache_prefix + "."):
+        return None
+    segments = path[len(cache_prefix) + 1:].split(".")
+    before_apis = segments.index("_apis") if "_apis" in segments else len(segments)
+    if before_apis > 2 or (before_apis == 2 and segments[0].lower() != "defaultcollection"):
+        print("ambiguous legacy cache file name, a name in the url has a dot, skipped: " + name)
+        return None
+    url = "https://" + instance_base + "/" + "/".join(segments)
+    if query:
+        url = url + "?" + query
+    return url
+
+def migrate_legacy_cache(cache, folder, instance_base, cache_prefix, delete=False):
+    """
+    Imports the flat files of the old cache folder into a cache backend.
+    The original fetch time is taken from the file modified time.
+    :returns: (files imported, files skipped)
+    """
+    imported = 0
+    skipped = 0
+    for entry in os.scandir(folder):
+        if not entry.is_file() or not entry.name.endswith(".json"):
+            continue
+        url = legacy_file_name_to_url(entry.name, instance_base, cache_prefix)
+        if url is None:
+            skipped += 1
+            continue
+        try:
+            with open(entry.path, 'r') as data_file:
+                data = json.loads(data_file.read())
+        except ValueError:
+            print("could not read " + entry.name)
+            skipped += 1
+            continue
+        cache.put(url, data, fetched=entry.stat().st_mtime)
+        imported += 1
+        if delete:
+            os.remove(entry.path)
+    cache.flush()
+    cache.compact()
+    return imported, skipped
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+def get_response_cache(backend, folder, batch_size=100, compression="none"):
+    """
+    One cache object per backend and folder per process,
+    sqlite connections can't be shared across a fork.
+    """
+    key = (os.getpid(), backend, folder)
+    with _CACHES_LOCK:
+        cache = _CACHES.get(key)
+        if cache is None:
+            cache = make_backend(backend, folder, batch_size, compression)
+            _CACHES[key] = cache
+    return cache
+
+if __name__ == '__main__':
+    from VSTSInfo import VstsInfo
+    VSTS = VstsInfo(None, None)
+    COMMAND = sys.argv[1] if len(sys.argv) > 1 else None
+    if COMMAND == "migrate":
+        DELETE = "--delete" in sys.argv
+        IMPORTED, SKIPPED = migrate_legacy_cache(VSTS.response_cache, VSTS.cache_folder,
+                                                 VSTS.instance_base, VSTS.cache_prefix, DELETE)
+        print("Imported {0} cached responses, skipped {1} files".format(IMPORTED, SKIPPED))
+    elif COMMAND == "copy" and len(sys.argv) > 3:
+        SOURCE = make_backend(sys.argv[2], VSTS.cache_folder, VSTS.cache_batch_size,
+                              VSTS.cache_compression)
+        TARGET = make_backend(sys.argv[3], VSTS.cache_folder, VSTS.cache_batch_size,
+                              VSTS.cache_compression)
+        print("Copied {0} cached responses".format(copy_cache(SOURCE, TARGET)))
+    elif COMMAND == "compact":
+        VSTS.response_cache.compact()
+        print("Compacted the " + VSTS.cache_backend + " cache")
+    elif COMMAND == "train-dictionary":
+        SAMPLES = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        DICT_ID = train_dictionary(VSTS.response_cache, SAMPLES)
+        print("Trained zstd dictionary {0}".format(DICT_ID))
+    elif COMMAND == "stats":
+        SAMPLES = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+        RESULTS = compression_report(VSTS.response_cache, SAMPLES)
+        BASE_TIME = RESULTS[0][3]
+        for NAME, SIZE, RATIO, ELAPSED in RESULTS:
+            SAVED = (1 - ELAPSED / BASE_TIME) * 100 if BASE_TIME else 0.0
+            print("{0:>5}: {1} bytes ratio {2:.2f}x read+decode {3:.3f}s ({4:+.0f}% time saved)".format(
+                NAME, SIZE, RATIO, ELAPSED, SAVED))
+    else:
+        print(__doc__)
@@ -0,0 +1,231 @@
+"""
+Spreads the crawl over processes one repository or pull request at a time.
+The old Pool(5).map over projects could use at most one process per project
+and left the others idle while the biggest project finished.
+
+Each process builds its own VstsInfo, workers and Neo4j connection pool when it starts,
+only ids and plain results go between processes so nothing holding a config or socket is pickled.
+Tasks are handed out one at a time with imap_unordered, a process that finishes early takes the next one.
+Processes are spawned rather than forked, the Orchestrator starts pools from threads
+and a fork could copy a lock some other thread was holding.
+
+Every process has its own rate limiter so each gets an equal share of crawl_rate and crawl_burst,
+all the processes that can be running at once together stay within the configured budget.
+"""
+import time
+import traceback
+import multiprocessing
+
+#built once per process by init_process
+_PROCESS = {}
+
+def init_process(pull_request_status, rate_share=1):
+    """
+    pool initializer, runs once in every process
+    :param int rate_share:
+        number of processes splitting the request budget
+    """
+    from VSTSInfo import VstsInfo
+    _PROCESS.clear()
+    _PROCESS["vsts"] = VstsInfo(None, None)
+    _PROCESS["vsts"].rate_share = rate_share
+    _PROCESS["pull_request_status"] = pull_request_status
+
+def _worker(name):
+    """
+    The worker for a kind of task, built the first time this process needs it.
+    """
+    worker = _PROCESS.get(name)
+    if worker is not None:
+        return worker
+    vsts = _PROCESS["vsts"]
+    if name == "pull_requests":
+        from PullRequests import PullRequestsWorker
+        worker = PullRequestsWorker(_PROCESS["pull_request_status"], vsts, vsts.pull_request_page_size,
+                                    incremental=vsts.incremental_crawl)
+    elif name == "comments":
+        from Comments import CommentsWorker
+        worker = CommentsWorker(vsts)
+    elif name == "work_items":
+        from models import GraphBuilder, Project
+        from WorkItems import PullReqeustWorkItemsWorker
+        worker = PullReqeustWorkItemsWorker(vsts.get_request_settings(), vsts)
+        graph = GraphBuilder().GetNewGraph()
+        vsts.identity_map.preload(graph, Project, key="Name")
+        vsts.person_names.load(graph)
+    _PROCESS[name] = worker
+    return worker
+
+def crawl_repository_task(task):
+    """
+    :param tuple task: (project name, repository id)
+    :returns: (project name, [(repository id, pull request id)])
+    """
+    from models import GraphBuilder
+    project_name, repo_id = task
+    worker = _worker("pull_requests")
+    pull_request_ids = worker.crawl_repository_once(GraphBuilder().GetNewGraph(), project_name, repo_id)
+    return project_name, [(repo_id, pull_request_id) for pull_request_id in pull_request_ids]
+
+def crawl_comments_task(task):
+    """
+    :param tuple task: (project name, [(repository id, pull request id)])
+    """
+    project_name, keys = task
+    _worker("comments").crawl_by_project(project_name, keys, clear_journal=False)
+    return project_name, keys
+
+def crawl_work_items_task(task):
+    """
+    :param tuple task: (project name, repository id, pull request id)
+    """
+    project_name, repo_id, pull_request_id = task
+    _worker("work_items").crawl_once(project_name, repo_id, pull_request_id)
+    return project_name, [(repo_id, pull_request_id)]
+
+def run_task(task_and_item):
+    """
+    Runs one task, a failure is handed back instead of stopping every other task.
+    The process's response cache is flushed after every task.
+    :returns: (project name, keys, error or None)
+    """
+    task, item = task_and_item
+    try:
+        project_name, keys = task(item)
+        return project_name, keys, None
+    except Exception as error:
+        traceback.print_exc()
+        return item[0], [], "{0}: {1!r}".format(item, error)
+    finally:
+        #the pool terminates its processes without running atexit, buffered cache writes would be lost
+        vsts = _PROCESS.get("vsts")
+        if vsts is not None:
+            vsts.response_cache.flush()
+
+def chunks(items, size):
+    """
+    :returns: list of lists of at most size items
+    """
+    items = list(items)
+    size = max(1, size)
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+class Scheduler(object):
+    """
+    :param int processes:
+        number of crawl processes, see crawl_processes in the config
+    :param string pull_request_status:
+        pull request status usually Active, Abandoned, Completed
+    :param Journal journal:
+        projects finished without a failed task are cleared from it
+    :param int pools_at_once:
+        how many pools can run at the same time, the Orchestrator runs comments and work items together
+    """
+
+    initializer = staticmethod(init_process)
+
+    def __init__(self, processes, pull_request_status="Completed", journal=None, pools_at_once=1):
+        self.processes = max(1, processes)
+        self.pull_request_status = pull_request_status
+        self.journal = journal
+        self.pools_at_once = max(1, pools_at_once)
+        self.tasks = {}
+        self.seconds = {}
+        self.failed = []
+
+    def run(self, name, task, items, journal_stage=None):
+        """
+        Runs task over items across the processes, one item per hand out.
+        The first part of every item is the project name.
+        :returns: results by project name, each a list of (repository id, pull request id)
+        """
+        items = list(items)
+        results = {}
+        failed_projects = set()
+        start = time.time()
+        if items:
+            processes = min(self.processes, len(items))
+            print("Scheduling {0} {1} tasks over {2} processes".format(len(items), name, processes))
+            rate_share = self.processes * self.pools_at_once
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(processes, initializer=self.initializer,
+                              initargs=(self.pull_request_status, rate_share)) as pool:
+                tasks = [(task, item) for item in items]
+                for done, (project_name, keys, error) in enumerate(pool.imap_unordered(run_task, tasks,
+                                                                                       chunksize=1), 1):
+                    if error is not None:
+                        self.failed.append((name, error))
+                        failed_projects.add(project_name)
+                    else:
+                        results.setdefault(project_name, []).extend(keys)
+                    print("{0} tasks done: {1}/{2}".format(name, done, len(items)))
+        if self.journal is not None and journal_stage is not None:
+            for project_name in set(item[0] for item in items) - failed_projects:
+                self.journal.clear(journal_stage, project_name)
+        self.tasks[name] = len(items)
+        self.seconds[name] = time.time() - start
+        return results
+
+    def crawl_pull_requests(self, repo_ids):
+        """
+        :param dict repo_ids: repository ids by project name
+        """
+        return self.run("pull_requests", crawl_repository_task,
+                        [(project_name, repo_id) for project_name, ids in repo_ids.items() for repo_id in ids],
+                        "pull_requests." + self.pull_request_status.lower())
+
+    def crawl_comments(self, keys, pull_requests_per_task):
+        """
+        Comments are handed out a few pull requests at a time so each task still writes
+        its comments in one transaction.
+        :param dict keys: (repository id, pull request id) pairs by project name
+        """
+        return self.run("comments", crawl_comments_task,
+                        [(project_name, chunk) for project_name, project_keys in keys.items()
+                         for chunk in chunks(project_keys, pull_requests_per_task)], "comments")
+
+    def crawl_work_items(self, keys):
+        """
+        :param dict keys: (repository id, pull request id) pairs by project name
+        """
+        return self.run("work_items", crawl_work_items_task,
+                        [(project_name, repo_id, pull_request_id) for project_name, project_keys in keys.items()
+                         for repo_id, pull_request_id in project_keys], "work_items")
+
+    def summary(self):
+        """
+        :returns: string suitable for printing at the end of a crawl
+        """
+        lines = ["Scheduler processes: {0} ".format(self.processes) + " ".join(
+            "{0}: {1} tasks {2:.1f}s".format(name, self.tasks[name], self.seconds[name]) for name in self.tasks)]
+        lines.extend("     FAILED {0} {1}".format(name, error) for name, error in self.failed)
+        return "\n".join(lines)
+
+def get_repo_ids(projects):
+    """
+    repository ids stored in Neo4j by project name
+    """
+    from models import GraphBuilder
+    graph = GraphBuilder().GetNewGraph()
+    qry = "MATCH (n:Repository)-[]-(:Project{Name:$name}) RETURN n.Id as Id"
+    return {name: [row["Id"] for row in graph.run(qry, name=name)] for name in projects}
+
+def get_pull_request_keys(projects):
+    """
+    (repository id, pull request id) pairs stored in Neo4j by project name
+    """
+    from models import GraphBuilder
+    from Comments import CommentsWorker
+    graph = GraphBuilder().GetNewGraph()
+    return {name: CommentsWorker(None).get_repository_pull_request_ids(name, graph) for name in projects}
+
+if __name__ == '__main__':
+    from VSTSInfo import VstsInfo
+    print("starting the scheduled crawl of pull requests, comments and work items")
+    VSTS = VstsInfo(None, None)
+    SCHEDULER = Scheduler(VSTS.crawl_processes, journal=VSTS.journal)
+    SCHEDULER.crawl_pull_requests(get_repo_ids(VSTS.project_whitelist))
+    KEYS = get_pull_request_keys(VSTS.project_whitelist)
+    SCHEDULER.crawl_comments(KEYS, VSTS.comment_batch_size)
+    SCHEDULER.crawl_work_items(KEYS)
+    print(SCHEDULER.summary())
@@ -0,0 +1,155 @@
+"""
+Constraints and indexes for every property the crawlers, post processing and readme queries match on.
+Safe to run as often as you like, only what is missing gets created.
+
+    python Schema.py            creates what is missing and reports what was there
+    python Schema.py explain    also prints the query plans of the hot crawler queries
+"""
+import sys
+from IdentityMap import PersonNameIndex
+
+#(label, property) pairs, a uniqueness constraint also gives us an index
+CONSTRAINTS = [
+    ("Repository", "Id"),
+    ("Project", "Id"),
+    ("Project", "Name"),
+    ("PullRequest", "Id"),
+    ("Person", "Id"),
+    ("Person", "UniqueName"),
+    ("Branch", "Id"),
+    ("Comment", "Id"),
+    ("PullRequestThread", "Id"),
+    ("Team", "Id"),
+    ("WorkItem", "Id"),
+    ("Iteration", "Id"),
+]
+
+INDEXES = [
+    ("Person", "Name"),
+    ("Team", "Name"),
+    ("Repository", "Name"),
+    ("Iteration", "Name"),
+    ("WorkItem", "WorkItemType"),
+    ("WorkItem", "State"),
+    ("WorkItem", "CreatedTimestamp"),
+    ("WorkItem", "ClosedTimestamp"),
+    ("PullRequest", "Status"),
+    ("PullRequest", "CreatedTimestamp"),
+    ("PullRequest", "ClosedTimestamp"),
+    ("Comment", "PublishedTimestamp"),
+]
+
+#queries run for nearly every record crawled, with sample parameters
+HOT_QUERIES = [
+    ("pull request by id", "MATCH (pr:PullRequest {Id: $id}) RETURN pr", {"id": 1}),
+    ("repository by id", "MATCH (repo:Repository {Id: $id}) RETURN repo", {"id": ""}),
+    ("person by id", "MATCH (person:Person {Id: $id}) RETURN person", {"id": ""}),
+    ("person by name", PersonNameIndex.LOOKUP_QUERY, {"name": "", "unique_name": ""}),
+    ("project by name", "MATCH (proj:Project) WHERE proj.Name = $name RETURN proj", {"name": ""}),
+    ("work item by id", "MATCH (wi:WorkItem {Id: $id}) RETURN wi", {"id": ""}),
+    ("comment by id", "MATCH (c:Comment {Id: $id}) RETURN c", {"id": ""}),
+    ("work items by type", "MATCH (wi:WorkItem {WorkItemType: $type}) RETURN count(wi)", {"type": "Bug"}),
+    ("pull requests since",
+     "MATCH (pr:PullRequest) WHERE pr.CreatedTimestamp > $since RETURN count(pr)", {"since": 0}),
+]
+
+INDEX_OPERATORS = ("NodeIndexSeek", "NodeUniqueIndexSeek", "NodeIndexSeekByRange",
+                   "NodeIndexScan", "NodeIndexContainsScan", "MultiNodeIndexSeek")
+SCAN_OPERATORS = ("NodeByLabelScan", "AllNodesScan")
+
+class SchemaManager(object):
+    """
+    Creates the constraints and indexes that are missing.
+
+    :param Graph graph:
+        py2neo graph
+    """
+
+    def __init__(self, graph, constraints=None, indexes=None):
+        self.graph = graph
+        self.constraints = CONSTRAINTS if constraints is None else constraints
+        self.indexes = INDEXES if indexes is None else indexes
+        self.existing = []
+        self.created = []
+        self.failed = []
+
+    def _ensure(self, kind, label, property_key, get_existing, create):
+        name = "{0} :{1}({2})".format(kind, label, property_key)
+        try:
+            if property_key in get_existing(label):
+                self.existing.append(name)
+                return
+            create(label, property_key)
+            self.created.append(name)
+        except Exception as error:
+            self.failed.append((name, str(error)))
+
+    def apply(self):
+        """
+        creates every missing constraint, then every missing index
+        :returns: self so the report can be printed
+        """
+        schema = self.graph.schema
+        for label, property_key in self.constraints:
+            self._ensure("constraint", label, property_key,
+                         schema.get_uniqueness_constraints, schema.create_uniqueness_constraint)
+        for label, property_key in self.indexes:
+            self._ensure("index", label, property_key,
+                         schema.get_indexes, schema.create_index)
+        return self
+
+    def report(self):
+        """
+        prints what existed, what was created and what failed
+        """
+        print("Schema: {0} existing {1} created {2} failed".format(len(self.existing),
+                                                                  len(self.created),
+                                                                  len(self.failed)))
+        for name in self.created:
+            print("     created " + name)
+        for name, error in self.failed:
+            print("     FAILED " + name + ": " + error)
+
+    def explain(self, queries=None):
+        """
+        Prints the operators neo4j plans for the hot queries.
+        :returns: names of the queries that scan instead of using an index
+        """
+        scanning = []
+        for name, query, parameters in (HOT_QUERIES if queries is None else queries):
+            plan = self.graph.run("EXPLAIN " + query, parameters).plan()
+            operators = plan_operators(plan)
+            uses_index = any(op.startswith(INDEX_OPERATORS) for op in operators)
+            scans = [op for op in operators if op.startswith(SCAN_OPERATORS)]
+            if scans or not uses_index:
+                scanning.append(name)
+            print("{0:<6} {1}: {2}".format("index" if uses_index and not scans else "SCAN",
+                                           name, " <- ".join(operators) or "no plan returned"))
+        return scanning
+
+def plan_operators(plan):
+    """
+    Flattens a query plan to its operator names, root first.
+    Handles both plan objects and plain dictionaries.
+    """
+    if plan is None:
+        return []
+    if isinstance(plan, dict):
+        operator = plan.get("operatorType") or plan.get("operator_type")
+        children = plan.get("children", [])
+    else:
+        operator = getattr(plan, "operator_type", None)
+        children = getattr(plan, "children", [])
+    operators = [operator.split("@")[0]] if operator else []
+    for child in children:
+        operators.extend(plan_operators(child))
+    return operators
+
+if __name__ == '__main__':
+    from models import GraphBuilder
+    MANAGER = SchemaManager(GraphBuilder().GetNewGraph())
+    MANAGER.apply().report()
+    if "explain" in sys.argv[1:]:
+        SCANNING = MANAGER.explain()
+        if SCANNING:
+            print("Queries not using an index: " + ", ".join(SCANNING))
@@ -0,0 +1,224 @@
+"""
+Fetch, map and write on their own threads joined by bounded queues,
+so VSTS requests and Neo4j transactions overlap instead of taking turns.
+
+    items -> fetch (fetch_workers threads) -> map (map_workers threads) -> write (one thread)
+
+A full queue blocks the stage feeding it, queue_size is how far fetching can run ahead of writing.
+Only the write thread touches the batch writer, mappers queue their rows on a RecordRows.
+"""
+import time
+import queue
+import threading
+
+_DONE = object()
+
+class RecordRows(object):
+    """
+    Stands in for a BatchWriter while mapping one record,
+    the write thread replays the rows on the real writer.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.unit = None
+
+    def add(self, name, row):
+        """
+        same as BatchWriter.add
+        """
+        self.rows.append((name, row))
+
+    def record_done(self, unit=None):
+        """
+        the write thread ends the record on the real writer, with this unit
+        """
+        self.unit = unit
+
+class QueueStats(object):
+    """
+    Depth of a queue sampled each time something is put on it,
+    and how often the put had to wait because the queue was full.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.puts = 0
+        self.blocked = 0
+        self.max_depth = 0
+        self._total_depth = 0
+
+    def sample(self, depth, full):
+        self.puts += 1
+        self._total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+        if full:
+            self.blocked += 1
+
+    def summary(self):
+        average = self._total_depth / self.puts if self.puts else 0.0
+        return "{0} queue avg: {1:.1f} max: {2} full: {3}/{4}".format(self.name, average, self.max_depth,
+                                                                    self.blocked, self.puts)
+
+class StagedPipeline(object):
+    """
+    :param function fetch:
+        called with each item, returns what map needs. None when the items are already fetched
+    :param function mapper:
+        called with a RecordRows and a fetched item, queues the rows of one record
+    :param BatchWriter writer:
+        flushed once everything has been written
+    :param int fetch_workers:
+    :param int map_workers:
+    :param int queue_size:
+        max items waiting between two stages
+    """
+
+    def __init__(self, fetch, mapper, writer, fetch_workers=4, map_workers=1, queue_size=100):
+        self.fetch = fetch
+        self.mapper = mapper
+        self.writer = writer
+        self.fetch_workers = max(1, fetch_workers) if fetch is not None else 0
+        self.map_workers = max(1, map_workers)
+        self.queue_size = max(1, queue_size)
+        self.error = None
+        self.seconds = {"fetch": 0.0, "map": 0.0, "write": 0.0}
+        self._lock = threading.Lock()
+        self._queues = []
+        self._stats = []
+        self._threads = []
+        self._input = None
+        self._started = None
+
+    def _add_queue(self, name):
+        self._queues.append(queue.Queue(self.queue_size))
+        self._stats.append(QueueStats(name))
+        return len(self._queues) - 1
+
+    def _put(self, index, item):
+        work_queue = self._queues[index]
+        self._stats[index].sample(work_queue.qsize(), work_queue.full())
+        work_queue.put(item)
+
+    def _time(self, name, start):
+        with self._lock:
+            self.seconds[name] += time.time() - start
+
+    def _stage(self, name, source, target, work, next_workers, remaining):
+        """
+        Runs work on every item from the source queue and puts the results on the target queue.
+        The last worker of a stage to finish tells the next stage it is done.
+        Once anything failed, items are drained but not worked so no stage blocks forever.
+        """
+        while True:
+            item = self._queues[source].get()
+            if item is _DONE:
+                break
+            if self.error is not None:
+                continue
+            start = time.time()
+            try:
+                result = work(item)
+            except Exception as error:
+                self.error = self.error or error
+                continue
+            finally:
+                self._time(name, start)
+            if target is not None:
+                self._put(target, result)
+        with self._lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and target is not None:
+            for _ in range(next_workers):
+                self._queues[target].put(_DONE)
+
+    def _map(self, item):
+        rows = RecordRows()
+        self.mapper(rows, item)
+        return rows
+
+    def _write(self, rows):
+        for name, row in rows.rows:
+            self.writer.add(name, row)
+        self.writer.record_done(rows.unit)
+
+    def _start_stage(self, name, source, target, work, workers, next_workers):
+        remaining = [workers]
+        for number in range(workers):
+            thread = threading.Thread(target=self._stage, name="{0}-{1}".format(name, number),
+                                      args=(name, source, target, work, next_workers, remaining))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def start(self):
+        """
+        starts the stage threads, then feed it with put and finish with close
+        """
+        self._started = time.time()
+        if self.fetch is not None:
+            fetch_queue = self._add_queue("fetch")
+            map_queue = self._add_queue("map")
+            self._start_stage("fetch", fetch_queue, map_queue, self.fetch, self.fetch_workers, self.map_workers)
+        else:
+            map_queue = self._add_queue("map")
+        write_queue = self._add_queue("write")
+        self._start_stage("map", map_queue, write_queue, self._map, self.map_workers, 1)
+        self._start_stage("write", write_queue, None, self._write, 1, 0)
+        self._input = 0
+        return self
+
+    def put(self, item):
+        """
+        Feeds one item, blocks while the first queue is full.
+        Raises the first error any stage hit so the producer stops early.
+        """
+        if self.error is not None:
+            raise self.error
+        self._put(self._input, item)
+
+    def close(self):
+        """
+        Waits for every stage to finish, then flushes the writer.
+        Raises the first error any stage hit, in which case nothing more is flushed.
+        """
+        for _ in range(self.fetch_workers or self.map_workers):
+            self._queues[self._input].put(_DONE)
+        for thread in self._threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+        start = time.time()
+        self.writer.flush()
+        self._time("write", start)
+
+    def run(self, items):
+        """
+        start, put every item, close
+        """
+        with self:
+            for item in items:
+                self.put(item)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, error_type, error, trace):
+        try:
+            self.close()
+        except Exception:
+            #the error that stopped the producer is the one worth seeing
+            if error_type is None:
+                raise
+        return False
+
+    def summary(self):
+        """
+        :returns: string suitable for printing at the end of a crawl
+        """
+        elapsed = time.time() - self._started if self._started else 0.0
+        busy = " ".join("{0}: {1:.1f}s".format(name, self.seconds[name]) for name in ("fetch", "map", "write"))
+        lines = ["Pipeline {0:.1f}s busy {1}".format(elapsed, busy)]
+        lines.extend("     " + stats.summary() for stats in self._stats)
+        return "\n".join(lines)
@@ -4,9 +4,20 @@ Helps build out information to make general VSTS HTTP requests
 import time
 import base64
 import json
-import urllib.request
+import urllib.error
 import os
 import configparser
+from HttpSession import get_session
+from CrawlEngine import CrawlEngine, get_rate_limiter, parse_retry_after
+from ResponseCache import get_response_cache, CacheEntry
+from CachePolicy import CachePolicy
+from CrawlState import CrawlState
+from IdentityMap import get_identity_map, get_person_name_index
+from Journal import get_journal
+from Fingerprints import get_fingerprint_store
+
+_NOT_PREFETCHED = object()
+RETRY_STATUS_CODES = (429, 503)
 
 class VstsInfo(object):
     """
@@ -23,6 +34,10 @@ class VstsInfo(object):
               let each module build their own url with help from this class.'''
         self.project_name = project_name
         self._load_from_source = ignore_cache
+        self._prefetched = {}
+        self._cache_policy = None
+        #crawl processes running at once split the request budget, set by the Scheduler
+        self.rate_share = 1
 
     @property
     def crawl_throttle(self):
@@ -31,6 +46,100 @@ class VstsInfo(object):
         """
         return float(self.config['DEFAULT']['crawl_throttle'])
 
+    @property
+    def crawl_rate(self):
+        """
+        Average requests per second allowed to VSTS.
+        Falls back to 1/crawl_throttle so old config files behave the same.
+        """
+        rate = self.config['DEFAULT'].get('crawl_rate')
+        if rate is not None:
+            return float(rate)
+        if self.crawl_throttle <= 0:
+            return 0.0
+        return 1.0 / self.crawl_throttle
+
+    @property
+    def crawl_burst(self):
+        """
+        Number of requests allowed back to back before the crawl_rate kicks in.
+        """
+        return int(self.config['DEFAULT'].get('crawl_burst', str(self.crawl_concurrency)))
+
+    @property
+    def crawl_concurrency(self):
+        """
+        Max number of VSTS requests in flight at once when prefetching.
+        """
+        return int(self.config['DEFAULT'].get('crawl_concurrency', '8'))
+
+    @property
+    def crawl_processes(self):
+        """
+        Processes the crawl is spread over, one repository or pull request at a time, see Scheduler.py
+        """
+        return int(self.config['DEFAULT'].get('crawl_processes', '5'))
+
+    @property
+    def crawl_max_rate(self):
+        """
+        Ceiling the rate limiter ramps up to while VSTS is healthy.
+        """
+        return float(self.config['DEFAULT'].get('crawl_max_rate', str(self.crawl_rate * 4)))
+
+    @property
+    def crawl_min_rate(self):
+        """
+        Floor the rate limiter backs down to while VSTS is throttling us.
+        """
+        return float(self.config['DEFAULT'].get('crawl_min_rate', str(self.crawl_rate / 10)))
+
+    @property
+    def crawl_max_retries(self):
+        """
+        How many times to retry a throttled (429) or busy (503) request before giving up.
+        """
+        return int(self.config['DEFAULT'].get('crawl_max_retries', '6'))
+
+    @property
+    def rate_limiter(self):
+        """
+        Adaptive token bucket shared by every request made in this process.
+        When the crawl is spread over processes each one gets 1/rate_share of the budget,
+        so crawl_rate, crawl_burst and the rate bounds hold for the whole crawl.
+        """
+        share = max(1, self.rate_share)
+        return get_rate_limiter(self.crawl_rate / share, max(1, self.crawl_burst // share),
+                                self.crawl_max_rate / share, self.crawl_min_rate / share)
+
+    @property
+    def http_pool_size(self):
+        """
+        Number of keep-alive connections to hold open to the VSTS server.
+        """
+        return int(self.config['DEFAULT'].get('http_pool_size', '8'))
+
+    @property
+    def http_timeout(self):
+        """
+        Seconds to wait on the VSTS server before giving up on a request.
+        """
+        return float(self.config['DEFAULT'].get('http_timeout', '60'))
+
+    @property
+    def session(self):
+        """
+        Pooled keep-alive http session, shared by every worker in this process.
+        """
+        return get_session(self.http_pool_size, self.http_timeout)
+
+    @property
+    def http_stats(self):
+        """
+        request, byte and latency counters for this process
+        """
+        return self.session.stats
+
     @property
     def project_whitelist(self):
         """
@@ -55,6 +164,213 @@ class VstsInfo(object):
         """
         return self.config['DEFAULT']['cache_folder']
 
+    @property
+    def cache_backend(self):
+        """
+        Where cached responses are kept, files or sqlite.
+        """
+        return self.config['DEFAULT'].get('cache_backend', 'files').strip().lower()
+
+    @property
+    def cache_batch_size(self):
+        """
+        Number of cache writes to buffer before committing, only used by the sqlite backend.
+        """
+        return int(self.config['DEFAULT'].get('cache_batch_size', '100'))
+
+    @property
+    def cache_compression(self):
+        """
+        How new cache entries are compressed: auto, zstd, gzip or none.
+        auto uses zstd when the zstandard package is installed and gzip otherwise.
+        """
+        return self.config['DEFAULT'].get('cache_compression', 'auto')
+
+    @property
+    def response_cache(self):
+        """
+        Content addressed cache of VSTS responses kept in the cache_folder.
+        """
+        return get_response_cache(self.cache_backend, self.cache_folder,
+                                  self.cache_batch_size, self.cache_compression)
+
+    @property
+    def read_legacy_cache(self):
+        """
+        On a cache miss also look for the file the old flat cache would have written.
+        Turn off once the old cache has been migrated with ResponseCache.py migrate.
+        """
+        return self.config['DEFAULT'].get('read_legacy_cache', 'true').lower() == 'true'
+
+    def _hours_setting(self, name, default):
+        value = self.config['DEFAULT'].get(name, default).strip().lower()
+        if value == 'forever':
+            return None
+        return float(value) * 3600
+
+    @property
+    def cache_policy(self):
+        """
+        Decides which cached responses are too old to use.
+        Completed/abandoned pull requests and closed work items are kept forever.
+        """
+        if self._cache_policy is None:
+            closed_states = self.config['DEFAULT'].get('cache_closed_states', 'Closed,Done,Removed')
+            self._cache_policy = CachePolicy(self._hours_setting('cache_ttl_active_hours', '24'),
+                                             self._hours_setting('cache_ttl_list_hours', '1'),
+                                             [state.strip() for state in closed_states.split(",")])
+        return self._cache_policy
+
+    @property
+    def crawl_state(self):
+        """
+        Durable bookkeeping such as watermarks, kept in a state folder inside the cache_folder.
+        """
+        return CrawlState(os.path.join(self.cache_folder, "state"))
+
+    @property
+    def incremental_crawl(self):
+        """
+        Only crawl what changed since the last run where the crawler supports it.
+        """
+        return self.config['DEFAULT'].get('incremental_crawl', 'false').lower() == 'true'
+
+    @property
+    def incremental_lookback_days(self):
+        """
+        How far before the closedDate watermark an incremental crawl keeps looking,
+        allows for pull requests that VSTS does not list strictly in the order they were closed.
+        """
+        return float(self.config['DEFAULT'].get('incremental_lookback_days', '30'))
+
+    @property
+    def identity_map_size(self):
+        """
+        Max number of people, repositories and projects kept in memory per process.
+        """
+        return int(self.config['DEFAULT'].get('identity_map_size', '50000'))
+
+    @property
+    def journal(self):
+        """
+        Units of work already done by an unfinished crawl, kept in the state folder inside the cache_folder.
+        """
+        return get_journal(os.path.join(self.cache_folder, "state", "journal.sqlite"))
+
+    @property
+    def skip_unchanged_writes(self):
+        """
+        Skip writing records whose content fingerprint matches what was last written, see Fingerprints.py
+        """
+        return self.config['DEFAULT'].get('skip_unchanged_writes', 'true').lower() == 'true'
+
+    @property
+    def fingerprints_path(self):
+        """
+        sqlite file the fingerprints are kept in, in the state folder inside the cache_folder
+        """
+        return os.path.join(self.cache_folder, "state", "fingerprints.sqlite")
+
+    @property
+    def fingerprints(self):
+        """
+        FingerprintStore or None when skip_unchanged_writes is off
+        """
+        if not self.skip_unchanged_writes:
+            return None
+        return get_fingerprint_store(self.fingerprints_path)
+
+    @property
+    def identity_map(self):
+        """
+        shared per process node lookups, see IdentityMap
+        """
+        return get_identity_map(self.identity_map_size)
+
+    @property
+    def person_names(self):
+        """
+        shared per process lookup of people by name, see PersonNameIndex
+        """
+        return get_person_name_index()
+
+    @property
+    def neo4j_batch_size(self):
+        """
+        Records written to Neo4j per transaction by the batch writers.
+        """
+        return int(self.config['DEFAULT'].get('neo4j_batch_size', '500'))
+
+    @property
+    def comment_batch_size(self):
+        """
+        Pull requests whose threads and comments are written to Neo4j per transaction.
+        """
+        return int(self.config['DEFAULT'].get('comment_batch_size', '50'))
+
+    @property
+    def bulk_export_folder(self):
+        """
+        Where BulkExport.py writes its csv files, defaults to a folder inside the cache_folder.
+        """
+        return self.config['DEFAULT'].get('bulk_export_folder', os.path.join(self.cache_folder, "bulk"))
+
+    @property
+    def bulk_import_url(self):
+        """
+        Prefix LOAD CSV uses to find the csv files, by default the neo4j import folder.
+        """
+        return self.config['DEFAULT'].get('bulk_import_url', 'file:///')
+
+    @property
+    def bulk_periodic_commit(self):
+        """
+        Rows per transaction while running LOAD CSV.
+        """
+        return int(self.config['DEFAULT'].get('bulk_periodic_commit', '10000'))
+
+    @property
+    def pull_request_page_size(self):
+        """
+        Pull requests asked for in the first page of each repository.
+        """
+        return int(self.config['DEFAULT'].get('pull_request_page_size', '100'))
+
+    @property
+    def pull_request_min_page_size(self):
+        """
+        Smallest page the pull request crawl shrinks to after timeouts.
+        """
+        return int(self.config['DEFAULT'].get('pull_request_min_page_size', '10'))
+
+    @property
+    def pull_request_max_page_size(self):
+        """
+        Largest page the pull request crawl grows to while VSTS answers quickly.
+        """
+        return int(self.config['DEFAULT'].get('pull_request_max_page_size', '1000'))
+
+    @property
+    def pipeline_queue_size(self):
+        """
+        Items allowed to wait between two pipeline stages before the stage feeding them blocks.
+        """
+        return int(self.config['DEFAULT'].get('pipeline_queue_size', '100'))
+
+    @property
+    def pipeline_fetch_workers(self):
+        """
+        Pipeline threads making VSTS requests, defaults to crawl_concurrency.
+        """
+        return int(self.config['DEFAULT'].get('pipeline_fetch_workers', str(self.crawl_concurrency)))
+
+    @property
+    def pipeline_map_workers(self):
+        """
+        Pipeline threads mapping VSTS data to Neo4j rows.
+        """
+        return int(self.config['DEFAULT'].get('pipeline_map_workers', '1'))
+
     @property
     def instance_base(self):
         """
@@ -137,45 +453,180 @@ class VstsInfo(object):
         request_info["headers"] = self.get_request_headers()
         return request_info
 
-    def make_request(self, url, write_to_file=True):
+    def make_request(self, url, write_to_file=True, timings=None):
         '''
         Make the VSTS call or gets data from cache, then convert results to a dictionary.
+
+        :param dict timings:
+            when given, filled with url -> (seconds, decoded bytes) for responses that came from VSTS
         '''
+        prefetched = self._prefetched.pop(url, _NOT_PREFETCHED)
+        if prefetched is not _NOT_PREFETCHED:
+            return prefetched
         print(url)
-        file_name = self.build_file_name(url)
-        data = {}
         if self._load_from_source:
-            data = self.get_data_from_vsts(url, self.crawl_throttle)
-        else:
-            data = self.get_data_from_file(file_name)
-
-        #if we loaded from source and data is none hitting again does nothing
-        if (data is None) and (not self._load_from_source):
-            print("     Source: VSTS")
-            data = self.get_data_from_vsts(url, self.crawl_throttle)
-            #only write to file if we get data from vsts
-            if write_to_file:
-                self.write_data(url, data)
+            return self.get_data_from_vsts(url, timings)
+
+        entry = self.get_cache_entry(url)
+        if (entry is not None) and self.cache_policy.is_fresh(entry):
+            print("     source: cache")
+            return entry.data
+
+        print("     Source: VSTS")
+        response = self.fetch_from_vsts(url, entry, timings)
+        if response.status == 304:
+            #nothing changed since we cached it, start its time to live over
+            print("     not modified")
+            self.response_cache.touch(url)
+            return entry.data
+        data = self.read_response(url, response)
+        #only write to file if we get data from vsts
+        if write_to_file:
+            self.write_data(url, data, response.headers)
         return data
 
-    def get_data_from_vsts(self, url, throttle):
+    def get_fresh_data(self, url):
+        '''
+        cached data for a url while it is still fresh, None when it has to be fetched
+        '''
+        if self._load_from_source:
+            return None
+        entry = self.get_cache_entry(url)
+        if (entry is not None) and self.cache_policy.is_fresh(entry):
+            return entry.data
+        return None
+
+    def prefetch(self, urls, write_to_file=True, timings=None):
+        '''
+        Fetches many urls at once, up to crawl_concurrency in flight.
+        The results are held until make_request asks for the same url,
+        so callers can keep processing in their original order.
+        Failed urls are left out and will be retried by make_request.
+        '''
+        urls = [url for url in dict.fromkeys(urls) if url and url not in self._prefetched]
+        if len(urls) < 2:
+            return
+        engine = CrawlEngine(lambda url: self.make_request(url, write_to_file, timings),
+                             self.crawl_concurrency)
+        results = engine.run(urls)
+        for url, data in zip(urls, results):
+            if not isinstance(data, Exception):
+                self._prefetched[url] = data
+
+    def discard_prefetched(self, urls):
+        '''
+        Drops prefetched results that were never asked for, such as pages past the end.
+        '''
+        for url in urls:
+            self._prefetched.pop(url, None)
+
+    def get_data_from_vsts(self, url, timings=None):
         """
         gets data from vsts using provided url
         """
-        time.sleep(throttle)
-        request = urllib.request.Request(url, headers=self.get_request_headers())
-        opener = urllib.request.build_opener()
-        try:
-            response = opener.open(request)
-            data = json.loads(response.read())
-        except urllib.error.HTTPError as err:
-            if err.code == 404:
-                data = None
-        return data
+        return self.read_response(url, self.fetch_from_vsts(url, None, timings))
+
+    def get_conditional_headers(self, entry):
+        """
+        If-None-Match/If-Modified-Since headers for refreshing a cached entry
+        :returns: dictionary of extra headers
+        """
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def fetch_from_vsts(self, url, entry=None, timings=None):
+        """
+        Makes the http request, a conditional one when a stale cache entry is passed in.
+        Throttled and busy responses are retried with backoff.
+        :param dict timings:
+            when given, the latency and size of the final response are kept in it by url
+        :returns: HttpResponse
+        """
+        headers = self.get_request_headers()
+        headers.update(self.get_conditional_headers(entry))
+        limiter = self.rate_limiter
+        attempt = 0
+        while True:
+            limiter.acquire()
+            response = self.session.get(url, headers=headers)
+            if response.status not in RETRY_STATUS_CODES:
+                break
+            retry_after = parse_retry_after(response.header("retry-after"))
+            limiter.on_throttled(response.status, retry_after)
+            if attempt >= self.crawl_max_retries:
+                break
+            wait = limiter.backoff(attempt, retry_after)
+            print("     VSTS returned {0}, retrying in {1:.1f}s".format(response.status, wait))
+            time.sleep(wait)
+            attempt += 1
+        if response.status < 400:
+            limiter.on_response(response.headers)
+        if timings is not None:
+            timings[url] = (response.latency, len(response.body or b""))
+        return response
+
+    def read_response(self, url, response):
+        """
+        converts the response body to a dictionary, None for a 404, other errors are raised.
+        """
+        if response.status == 404:
+            return None
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+        return json.loads(response.body.decode('utf-8'))
+
+    def print_stats(self):
+        """
+        prints the http, rate limit, identity map, name index, journal and fingerprint counters for this process
+        """
+        print(self.http_stats.summary())
+        print(self.rate_limiter.summary())
+        identity_map = self.identity_map
+        if identity_map.hits or identity_map.misses:
+            print(identity_map.summary())
+        person_names = self.person_names
+        if person_names.hits or person_names.misses:
+            print(person_names.summary())
+        journal = self.journal
+        if journal.recorded or journal.skipped:
+            print(journal.summary())
+        fingerprints = self.fingerprints
+        if fingerprints is not None and fingerprints.checked:
+            print(fingerprints.summary())
+
+    def get_cache_entry(self, url):
+        """
+        looks the url up in the response cache, fresh or not
+        :returns: CacheEntry or None
+        """
+        entry = self.response_cache.get(url)
+        if (entry is None) and self.read_legacy_cache:
+            entry = self.import_legacy_file(url)
+        return entry
+
+    def import_legacy_file(self, url):
+        """
+        moves a response from the old flat file cache into the response cache
+        so next time it is a single lookup
+        :returns: CacheEntry or None
+        """
+        file_name = self.build_file_name(url)
+        data = self.get_data_from_file(file_name)
+        if data is None:
+            return None
+        fetched = os.path.getmtime(file_name)
+        self.response_cache.put(url, data, fetched=fetched)
+        return CacheEntry(url, data, fetched)
 
     def get_data_from_file(self, file_name):
         """
-        if data is in a file don't hit vsts
+        reads a file from the old flat file cache
         """
         try:
             if os.path.isfile(file_name):
@@ -190,7 +641,8 @@ class VstsInfo(object):
 
     def build_file_name(self, url):
         """
-        make savable filenames, for local cache
+        filenames used by the old flat file cache,
+        only needed to read caches written before ResponseCache
         :returns: string
         """
         file_name = url.replace("https://", '')
@@ -200,16 +652,15 @@ class VstsInfo(object):
         result = os.path.join(self.cache_folder, file_name + ".json")
         return result
 
-    def write_data(self, url, data):
+    def write_data(self, url, data, headers=None):
         """
-        Writes the http results to a file so we don't have to hit sever to re-run later
+        Writes the http results to the cache so we don't have to hit sever to re-run later
+        The ETag and Last-Modified headers are kept for conditional refreshes.
         """
         if data is not None:
-            file_name = self.build_file_name(url)
-            str_json = json.dumps(data)
-            print("     Writing File " + file_name)
-
-            with open(file_name, 'w') as file:
-                file.write(str_json + '\n')
+            headers = headers or {}
+            key = self.response_cache.put(url, data, etag=headers.get('etag'),
+                                          last_modified=headers.get('last-modified'))
+            print("     Writing Cache " + key)
         else:
             print("    No data to write")
@@ -4,9 +4,9 @@ From a Pull Request Id, gets related work items and saves them
 import logging
 from multiprocessing import Pool
 from VSTSInfo import VstsInfo
-from models import GraphBuilder, WorkItem
-from py2neo import Relationship, PropertyDict
+from models import GraphBuilder, WorkItem, Project, get_properties
 from WorkItems import PullReqeustWorkItemsWorker
+from BatchWriter import WorkItemBatchWriter
 
 class WorkItemLinksWorker(object):
     """
@@ -20,6 +20,8 @@ class WorkItemLinksWorker(object):
         self.headers = vsts.headers
         self.vsts = vsts
         self.vsts_work_item_repo = PullReqeustWorkItemsWorker(request_info, vsts)
+        #work items already queued this crawl
+        self._queued_work_items = set()
 
     def get_url(self, project_name, work_item_ids=None):
         """
@@ -45,57 +47,118 @@ class WorkItemLinksWorker(object):
 
     def crawl(self, project_name, url=None):
         """
-        This method will be recursive since we have to follow a url at the end of each request.
-
+        Streams the link batches of a project, each batch is written and released before the next is fetched.
+        Work items and links are queued on one batch writer for the whole project,
+        each work item is mapped once per crawl however many links it has.
+        The nextLink is saved after every batch so an interrupted crawl picks up where it stopped.
         """
         if project_name is None:
             print("ProjectId is needed to link work items")
             return
 
+        state_name = self.continuation_name(project_name)
+        if url is None:
+            url = self.vsts.crawl_state.get(state_name)
+            if url is not None:
+                print("resuming work item links for project " + project_name)
+        self._queued_work_items = set()
+        graph = GraphBuilder().GetNewGraph()
+        self.vsts.identity_map.preload(graph, Project, key="Name")
+        self.vsts.person_names.load(graph)
+        writer = WorkItemBatchWriter(graph, self.vsts.neo4j_batch_size, fingerprints=self.vsts.fingerprints)
+
+        for raw_links, next_url in self.link_batches(project_name, url):
+            #one batched fetch for every work item this batch of links touches
+            self.vsts_work_item_repo.hydrate(_id for raw in raw_links
+                                             for _id in (raw.get("sourceId"), raw.get("targetId")))
+            for raw in raw_links:
+                self.queue_link(writer, raw)
+            if next_url is not None:
+                #only move the checkpoint once everything before it is in neo4j
+                writer.flush()
+                self.vsts.crawl_state.set(state_name, next_url)
+
+        writer.flush()
+        self.vsts.crawl_state.delete(state_name)
+        print(writer.summary())
+
+    def link_batches(self, project_name, url=None):
+        """
+        Follows nextLink until the last batch.
+        :returns: generator of (links, url of the next batch or None)
+        """
         if url is None:
             url = self.get_url(project_name)
-
-        data = self.vsts.make_request(url)
-        if data is None:
-            return
-        if "values" not in data:
-            logging.info("no work items linked")
-            return
-        for raw in data["values"]:
-            graph = GraphBuilder().GetNewGraph()
-            r = self.build_relationship(graph, raw)
-            print("adding workitem and relationships")
-            graph.create(r)
-
-        if data.get("nextLink"):
+        while url is not None:
+            data = self.vsts.make_request(url)
+            if data is None:
+                return
+            if "values" not in data:
+                logging.info("no work items linked")
+                return
+            next_url = data.get("nextLink")
             if data.get("isLastBatch"):
                 print("reached the end of linked work items for project " + project_name)
-                return
-            next_url = data["nextLink"]
-            self.crawl(project_name, next_url)
+                next_url = None
+            yield data["values"], next_url
+            url = next_url
 
-    def get_work_item(self, work_item_id, graph):
+    def continuation_name(self, project_name):
+        """
+        crawl state key for the nextLink of an unfinished crawl
         """
-        Updates workitem data regardless now
-        :param string work_item_id:
+        return "work_item_links." + project_name
 
+    def queue_work_item(self, writer, work_item_id):
         """
-        if work_item_id is None:
+        Maps a work item and queues it with its project and people, once per crawl.
+        Work items vsts no longer has are still queued with just their Id so links can be made.
+        :returns: the work item Id as stored in Neo4j
+        """
+        work_item_id = str(work_item_id)
+        if work_item_id in self._queued_work_items:
+            return work_item_id
+        self._queued_work_items.add(work_item_id)
+        repo = self.vsts_work_item_repo
+        work_item = WorkItem()
+        work_item.Id = work_item_id
+        raw = repo.get_raw_work_item(work_item_id)
+        if raw is None:
+            #Not sure why this happens could be old work items or possibly artifact links
+            print("could not get work item from vsts: " + work_item_id)
+            writer.add("work_items", {"Id": work_item_id, "props": {}})
+            writer.work_item_done(work_item_id)
+            return work_item_id
+        repo.map_work_item_fields(work_item, raw)
+        writer.add("work_items", {"Id": work_item_id, "props": get_properties(work_item)})
+
+        graph = writer.graph
+        fields = raw.get("fields")
+        if fields.get("System.TeamProject") is not None:
+            proj = self.vsts.identity_map.get(graph, Project, fields.get("System.TeamProject"), key="Name")
+            if proj is not None:
+                writer.add("projects", {"Id": work_item_id, "ProjectId": proj.Id})
+        for field, statement in (("System.CreatedBy", "created_by"), ("System.AssignedTo", "assigned_to")):
+            person_id = self.vsts.person_names.lookup(graph, fields.get(field))
+            if person_id is not None:
+                writer.add(statement, {"Id": work_item_id, "PersonId": person_id})
+        writer.work_item_done(work_item_id)
+        return work_item_id
+
+    def queue_link(self, writer, raw_link):
+        """
+        queues both work items and the link between them, each as a record of its own
+        so unchanged ones are skipped when fingerprints are on
+        """
+        if raw_link.get("sourceId") is None or raw_link.get("targetId") is None:
             print("workitem id cannot be none")
             return
-        work_item = WorkItem.select(graph, work_item_id).first()
-        if work_item is None:
-            work_item = WorkItem()
-            work_item.Id = str(work_item_id)
-            graph.merge(work_item)
-        try:
-            self.vsts_work_item_repo.fill_in_the_rest(work_item, graph)
-        except:
-            #Not sure why this happens could be old work items or possibly artifact links
-            print("could not get work item from vsts: " + str(work_item.Id))
-
-        graph.push(work_item)
-        return work_item
+        source_id = self.queue_work_item(writer, raw_link["sourceId"])
+        target_id = self.queue_work_item(writer, raw_link["targetId"])
+        link_type = self.parse_link_type(raw_link.get("linkType"))
+        properties = {}
+        self.set_link_props(properties, raw_link)
+        writer.add_link(link_type, source_id, target_id, properties)
 
     def parse_link_type(self, full_link_type):
         """
@@ -123,17 +186,6 @@ class WorkItemLinksWorker(object):
         if raw_link["linkType"] is not None:
             link["fullLinkType"] = raw_link["linkType"]
 
-    def build_relationship(self, graph, raw_link):
-        """
-        finds the source and target work items and links them together
-        """
-        source = self.get_work_item(raw_link.get("sourceId"), graph)
-        target = self.get_work_item(raw_link.get("targetId"), graph)
-        link_type = self.parse_link_type(raw_link.get("linkType"))
-        link = Relationship(source.__ogm__.node, link_type, target.__ogm__.node)
-        self.set_link_props(link, raw_link)
-        return link
-
 if __name__ == '__main__':
     print("starting WorkItemLinks")
     #set to false for easier debugging, but it is slower
@@ -150,3 +202,4 @@ if __name__ == '__main__':
             p.map(WORKER.crawl, VSTS.project_whitelist)
     else:
         WORKER.crawl_projects(VSTS.project_whitelist)
+    VSTS.print_stats()
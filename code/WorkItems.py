@@ -2,9 +2,11 @@
 From a Pull Request Id, gets related work items and saves them.
 """
 import logging
-from multiprocessing import Pool
+import urllib.error
 from VSTSInfo import VstsInfo
-from models import GraphBuilder, Project, WorkItem, Person, PullRequest
+from models import GraphBuilder, Project, WorkItem, Person, PullRequest, get_properties
+from Scheduler import Scheduler, get_pull_request_keys
+from Fingerprints import fingerprint
 
 class PullReqeustWorkItemsWorker(object):
     """
@@ -13,12 +15,21 @@ class PullReqeustWorkItemsWorker(object):
     :todo $expand=relations will get the relations so we can link them up
     """
 
+    #most ids the workitems?ids= endpoint accepts
+    BATCH_SIZE = 200
+    #vsts fails a whole batch with these when one of its ids is gone or not a work item
+    MISSING_STATUS_CODES = (400, 404)
+    JOURNAL_STAGE = "work_items"
+    FINGERPRINT_KIND = "pull_request_work_item"
+
     def __init__(self, request_info, vsts, space_out_requests=1):
         self.instance = request_info["instance"]
         self.api_version = request_info["api_version"]
         self.headers = request_info["headers"]
         self.space_out_requests = space_out_requests
         self.vsts = vsts
+        #raw work items fetched this run by id, see hydrate
+        self._raw_work_items = {}
 
     def crawl(self, repository_id, pull_request_id):
         """
@@ -42,14 +53,30 @@ class PullReqeustWorkItemsWorker(object):
         if "value" not in data:
             logging.info("no work items linked")
             return
+        self.hydrate(raw.get("id") for raw in data["value"])
+        fingerprints = self.vsts.fingerprints
         for raw in data["value"]:
             work_item = self.make_work_item(raw)
             if work_item is not None:
                 self.link_to_pull_request(work_item, pull_request)
                 self.fill_in_the_rest(work_item, graph)
-                transaction = graph.begin()
-                transaction.merge(work_item)
-                transaction.graph.push(work_item)
+                key = "{0}:{1}".format(pull_request.Id, work_item.Id)
+                digest = self.fingerprint(work_item, pull_request)
+                if fingerprints is not None and fingerprints.unchanged(self.FINGERPRINT_KIND, key, digest):
+                    continue
+                graph.merge(work_item)
+                graph.push(work_item)
+                if fingerprints is not None:
+                    fingerprints.record(self.FINGERPRINT_KIND, [(key, digest)])
+
+    def fingerprint(self, work_item, pull_request):
+        """
+        hash of the mapped work item and the ids it is linked to
+        """
+        return fingerprint([get_properties(work_item), pull_request.Id,
+                            sorted(person.Id for person in work_item.CreatedBy),
+                            sorted(person.Id for person in work_item.AssignedTo),
+                            sorted(proj.Id for proj in work_item.ForProject)])
 
     def link_to_pull_request(self, work_item, pull_request):
         """
@@ -82,13 +109,119 @@ class PullReqeustWorkItemsWorker(object):
                (self.instance, work_item_id, self.api_version))
         return url
 
+    def get_work_items_url(self, work_item_ids):
+        """
+        url to get up to BATCH_SIZE work items in one call
+        """
+        url = ("%s/DefaultCollection/_apis/wit/workitems?ids=%s&api-version=%s" %
+               (self.instance, ",".join(str(_id) for _id in work_item_ids), self.api_version))
+        return url
+
+    def hydrate(self, work_item_ids):
+        """
+        Makes sure every work item is in this run's memo, fetching each at most once.
+        Fresh single work item cache entries are used as they are, the rest are
+        fetched BATCH_SIZE at a time and cached one by one so later runs can use them.
+        A batch VSTS rejects because of a missing id is fetched one at a time,
+        other errors such as throttling or a server error are raised.
+        """
+        missing = []
+        for work_item_id in dict.fromkeys(str(_id) for _id in work_item_ids if _id is not None):
+            if work_item_id in self._raw_work_items:
+                continue
+            cached = self.vsts.get_fresh_data(self.get_work_item_url(work_item_id))
+            if cached is not None:
+                self._raw_work_items[work_item_id] = cached
+            else:
+                missing.append(work_item_id)
+        if not missing:
+            return
+        chunks = [missing[start:start + self.BATCH_SIZE]
+                  for start in range(0, len(missing), self.BATCH_SIZE)]
+        urls = [self.get_work_items_url(chunk) for chunk in chunks]
+        self.vsts.prefetch(urls, write_to_file=False)
+        for chunk, url in zip(chunks, urls):
+            try:
+                data = self.vsts.make_request(url, write_to_file=False)
+            except urllib.error.HTTPError as error:
+                if error.code not in self.MISSING_STATUS_CODES:
+                    raise
+                print("work item batch failed: " + str(error))
+                data = None
+            if data is None:
+                #vsts fails the whole batch when one id is gone, get those one at a time
+                data = {"value": self.fetch_one_by_one(chunk)}
+            for raw in data.get("value", []):
+                work_item_id = str(raw.get("id"))
+                self._raw_work_items[work_item_id] = raw
+                if not self.vsts.load_from_source:
+                    self.vsts.write_data(self.get_work_item_url(work_item_id), raw)
+            for work_item_id in chunk:
+                #remember the ones vsts does not have so they are not asked for again
+                self._raw_work_items.setdefault(work_item_id, None)
+
+    def fetch_one_by_one(self, work_item_ids):
+        """
+        fallback for a failed batch, work items that can't be fetched are left out
+        """
+        urls = [self.get_work_item_url(_id) for _id in work_item_ids]
+        self.vsts.prefetch(urls, write_to_file=False)
+        found = []
+        for url in urls:
+            try:
+                raw = self.vsts.make_request(url, write_to_file=False)
+            except urllib.error.HTTPError as error:
+                if error.code not in self.MISSING_STATUS_CODES:
+                    raise
+                print("could not get work item {0}: {1}".format(url, error))
+                continue
+            if raw is not None:
+                found.append(raw)
+        return found
+
+    def get_raw_work_item(self, work_item_id):
+        """
+        raw VSTS work item from this run's memo, fetched if it is not there yet
+        :returns: dictionary or None
+        """
+        work_item_id = str(work_item_id)
+        if work_item_id not in self._raw_work_items:
+            self.hydrate([work_item_id])
+        return self._raw_work_items.get(work_item_id)
+
     def fill_in_the_rest(self, work_item, graph):
         """
         Query VSTS for the given url, then save the results
         """
-        if work_item.Url is None:
-            work_item.Url = self.get_work_item_url(work_item.Id)
-        raw = self.get_data(work_item.Url)
+        raw = self.get_raw_work_item(work_item.Id)
+        if raw is None:
+            print("could not get work item from vsts: " + str(work_item.Id))
+            return
+        fields = raw.get("fields")
+        self.map_work_item_fields(work_item, raw)
+
+        name_raw = fields.get("System.CreatedBy")
+        if name_raw is not None:
+            creator = self.find_person(graph, name_raw)
+            if creator is not None:
+                work_item.CreatedBy.add(creator)
+
+        assigned_to = fields.get("System.AssignedTo")
+        if assigned_to is not None:
+            person = self.find_person(graph, assigned_to)
+            if person is not None:
+                work_item.AssignedTo.add(person)
+
+        _proj_name = fields.get("System.TeamProject")
+        if _proj_name is not None:
+            proj = self.vsts.identity_map.get(graph, Project, _proj_name, key="Name")
+            if proj is not None:
+                work_item.ForProject.add(proj)
+
+    def map_work_item_fields(self, work_item, raw):
+        """
+        copies the VSTS work item fields onto the model, no linking
+        """
         fields = raw.get("fields")
         work_item.WorkItemType = fields.get("System.WorkItemType")
         work_item.Title = fields.get("System.Title")
@@ -127,32 +260,23 @@ class PullReqeustWorkItemsWorker(object):
         #Issue
         #work_item.IssueSource = fields.get("")
 
-        name_raw = fields.get("System.CreatedBy")
-        if name_raw is not None:
-            name = self.clean_up_user_name(name_raw)
-            work_item.Creator = name #just in case the relationship link fails
-            stmt = "_.Name =~ '" + name + "' "
-            creator = Person.select(graph).where(stmt).first()
-            if creator is not None:
-                work_item.CreatedBy.add(creator)
-
-        assigned_to = fields.get("System.AssignedTo")
-        if assigned_to is not None:
-            name = self.clean_up_user_name(name_raw)
-            work_item.Creator = name #just in case the relationship link fails
-            stmt = "_.Name =~ '" + name + "' "
-            person = Person.select(graph).where(stmt).first()
-            if person is not None:
-                work_item.AssignedTo.add(person)
+        #names are kept just in case the relationship links fail
+        if fields.get("System.CreatedBy") is not None:
+            work_item.Creator = self.clean_up_user_name(fields.get("System.CreatedBy"))
+        if fields.get("System.TeamProject") is not None:
+            work_item.ProjectName = fields.get("System.TeamProject")
+        return work_item
 
-        _proj_name = fields.get("System.TeamProject")
-        if _proj_name is not None:
-            work_item.ProjectName = _proj_name #just in case the relationship link fails
-            where_stmt = "_.Name = '" + _proj_name + "'"
-            proj_qry = Project.select(graph).where(where_stmt)
-            proj = proj_qry.first()
-            if proj is not None:
-                work_item.ForProject.add(proj)
+    def find_person(self, graph, name_raw):
+        """
+        Resolves a person from a work item field such as System.CreatedBy
+        through the per process name index, no regex scan of every person.
+        :returns: Person or None
+        """
+        person_id = self.vsts.person_names.lookup(graph, name_raw)
+        if person_id is None:
+            return None
+        return self.vsts.identity_map.get(graph, Person, person_id)
 
     def make_work_item(self, raw):
         """
@@ -209,16 +333,40 @@ class PullReqeustWorkItemsWorker(object):
         pull_reqs = None
         return ids
 
-    def add_pull_request_work_items(self, project_name):
+    def add_pull_request_work_items(self, project_name, keys=None, clear_journal=True):
         """
-        Helper method to call crawl
+        Helper method to call crawl, pull requests already in the journal are skipped
+
+        :param list keys:
+            (repository id, pull request id) pairs, queried from neo4j when not given
+        :param bool clear_journal:
+            forget the pull requests done once the project is finished
         """
         print("Getting work items for project " + project_name)
-        repo_ids = self.get_repository_ids(project_name)
-        for repo_id in repo_ids:
-            pull_reqs = self.get_pull_request_ids(repo_id)
-            for pull_request_id in pull_reqs:
-                self.crawl(repo_id, pull_request_id)
+        graph = GraphBuilder().GetNewGraph()
+        self.vsts.identity_map.preload(graph, Project, key="Name")
+        self.vsts.person_names.load(graph)
+        if keys is None:
+            keys = [(repo_id, pull_request_id)
+                    for repo_id in self.get_repository_ids(project_name)
+                    for pull_request_id in self.get_pull_request_ids(repo_id)]
+        journal = self.vsts.journal
+        keys = journal.remaining(self.JOURNAL_STAGE, project_name, keys, key=lambda key: str(key[1]))
+        for repo_id, pull_request_id in keys:
+            self.crawl(repo_id, pull_request_id)
+            journal.record(self.JOURNAL_STAGE, project_name, [pull_request_id])
+        if clear_journal:
+            journal.clear(self.JOURNAL_STAGE, project_name)
+
+    def crawl_once(self, project_name, repo_id, pull_request_id):
+        """
+        crawl unless the journal says an unfinished crawl already did it
+        """
+        journal = self.vsts.journal
+        if journal.is_done(self.JOURNAL_STAGE, project_name, pull_request_id):
+            return
+        self.crawl(repo_id, pull_request_id)
+        journal.record(self.JOURNAL_STAGE, project_name, [pull_request_id])
 
 if __name__ == '__main__':
     print("starting Work Items linked to Pull Requests")
@@ -228,9 +376,10 @@ if __name__ == '__main__':
     VSTS = VstsInfo(None, None, ignore_cache=False)
     WORKER = PullReqeustWorkItemsWorker(VSTS.get_request_settings(), VSTS)
     if RUN_MULTITHREADED:
-        with Pool(5) as p:
-            p.map(WORKER.add_pull_request_work_items, VSTS.project_whitelist)
+        SCHEDULER = Scheduler(VSTS.crawl_processes, journal=VSTS.journal)
+        SCHEDULER.crawl_work_items(get_pull_request_keys(VSTS.project_whitelist))
+        print(SCHEDULER.summary())
     else:
         for proj_name in VSTS.project_whitelist:
-
             WORKER.add_pull_request_work_items(proj_name)
+    VSTS.print_stats()
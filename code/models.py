@@ -2,9 +2,28 @@
 Strongly typed models suitable for Neo4J database
 '''
 import os
+import threading
 import configparser
+import py2neo
 from py2neo import Graph, Node, Relationship, authenticate, watch
 from py2neo.ogm import GraphObject, Property, RelatedTo, RelatedFrom
+from Schema import SchemaManager
+
+_GRAPHS = {}
+_GRAPHS_LOCK = threading.Lock()
+
+def _forget_inherited_graphs():
+    '''
+    A forked child must not share the parent's sockets, it builds its own pool on first use.
+    py2neo also caches databases by uri, GraphDatabase.forget_all drops that cache too.
+    '''
+    _GRAPHS.clear()
+    database_class = getattr(py2neo, "GraphDatabase", None)
+    if hasattr(database_class, "forget_all"):
+        database_class.forget_all()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_inherited_graphs)
 
 class GraphBuilder(object):
     '''
@@ -31,68 +50,61 @@ class GraphBuilder(object):
     @property
     def neo4j_url(self):
         """
+        host:http port, eg: localhost:7474
         """
         return self.config['DEFAULT']['neo4j_url']
 
+    @property
+    def neo4j_bolt(self):
+        """
+        use the bolt protocol for cypher, the http url is still used for schema calls
+        """
+        return self.config['DEFAULT'].get('neo4j_bolt', 'true').lower() == 'true'
+
+    @property
+    def neo4j_bolt_port(self):
+        """
+        """
+        return int(self.config['DEFAULT'].get('neo4j_bolt_port', '7687'))
+
     def GetNewGraph(self):
         '''
-        Class to new up a graph object so we can makes calls to the database
+        Hands out the graph for this process. It is built and authenticated once,
+        after that every caller shares its pooled bolt connections.
+        Each multiprocessing worker gets its own after the fork.
         '''
-        authenticate(self.neo4j_url, self.neo4j_user, self.neo4j_password)
-        graph = Graph("http://" + self.neo4j_url)
+        pid = os.getpid()
+        with _GRAPHS_LOCK:
+            graph = _GRAPHS.get(pid)
+            if graph is None:
+                graph = self._connect()
+                _GRAPHS.clear()
+                _GRAPHS[pid] = graph
         return graph
 
+    def _connect(self):
+        host, _, http_port = self.neo4j_url.partition(":")
+        authenticate(self.neo4j_url, self.neo4j_user, self.neo4j_password)
+        return Graph(host=host, http_port=int(http_port or 7474),
+                     bolt=self.neo4j_bolt, bolt_port=self.neo4j_bolt_port,
+                     user=self.neo4j_user, password=self.neo4j_password)
+
     def create_unique_constraints(self):
         '''
-        Half baked helper scrit to generate unique constraints to help
-        prevent duplicate items in the Neo4J model
+        Creates the missing constraints and indexes, see Schema.py for the full list
         '''
+        SchemaManager(self.GetNewGraph()).apply().report()
 
-        graph = self.GetNewGraph()
-        try:
-            graph.schema.create_uniqueness_constraint("Repository", "Id")
-        except:
-            print("db constraint already addad")
-        try:
-            graph.schema.create_uniqueness_constraint("Project", "Id")
-        except:
-            print("db constraint already addad")
-        try:
-            graph.schema.create_uniqueness_constraint("Project", "Name")
-        except:
-            print("db constraint already addad")
-        try:
-            graph.schema.create_uniqueness_constraint("PullRequest", "Id")
-        except:
-            print("db constraint already addad")
-        try:
-            graph.schema.create_uniqueness_constraint("Person", "Id")
-        except:
-            print("db constraint already addad")
-        try:
-            graph.schema.create_uniqueness_constraint("Person", "UniqueName")
-        except:
-            print("db constraint already addad")
-        try:
-            graph.schema.create_uniqueness_constraint("Branch", "Id")
-        except:
-            print("db constraint already addad")
-        try:
-            graph.schema.create_uniqueness_constraint("Comment", "Id")
-        except:
-            print("db constraint already addad")
-        try:
-            graph.schema.create_uniqueness_constraint("PullRequestThread", "Id")
-        except:
-            print("db constraint already addad")
-        try:
-            graph.schema.create_uniqueness_constraint("Team", "Id")
-        except:
-            print("db constraint already addad")
-        try:
-            graph.schema.create_uniqueness_constraint("WorkItem", "Id")
-        except:
-            print("db constraint already addad")
+def get_properties(graph_object):
+    '''
+    Property values of a model as a plain dictionary, handy as parameters for batched cypher
+    '''
+    properties = {}
+    for klass in type(graph_object).__mro__:
+        for name, attribute in vars(klass).items():
+            if isinstance(attribute, Property) and name not in properties:
+                properties[name] = getattr(graph_object, name)
+    return properties
 
 class PullRequest(GraphObject):
     '''
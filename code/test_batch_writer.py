@@ -0,0 +1,134 @@
+import unittest
+from BatchWriter import BatchWriter, CommentBatchWriter, PullRequestBatchWriter, WorkItemBatchWriter
+
+class RecordingTransaction(object):
+
+    def __init__(self, log, fail=False):
+        self.log = log
+        self.fail = fail
+
+    def run(self, cypher, **parameters):
+        if self.fail:
+            raise RuntimeError("neo4j is down")
+        self.log.append((cypher, list(parameters["rows"])))
+
+    def commit(self):
+        self.log.append("commit")
+
+    def rollback(self):
+        self.log.append("rollback")
+
+class RecordingGraph(object):
+
+    def __init__(self, fail=False):
+        self.log = []
+        self.fail = fail
+
+    def begin(self):
+        return RecordingTransaction(self.log, self.fail)
+
+class TestBatchWriter(unittest.TestCase):
+
+    def make_writer(self, graph, batch_size):
+        writer = BatchWriter(graph, batch_size)
+        writer.add_statement("nodes", "UNWIND $rows AS row MERGE (n:Node {Id: row.Id})")
+        writer.add_statement("links", "UNWIND $rows AS row MATCH (n:Node {Id: row.Id})")
+        return writer
+
+    def test_flushes_once_batch_is_full(self):
+        graph = RecordingGraph()
+        writer = self.make_writer(graph, 2)
+        writer.add("links", {"Id": 1})
+        writer.add("nodes", {"Id": 1})
+        writer.record_done()
+        self.assertEqual(graph.log, [])
+        writer.add("nodes", {"Id": 2})
+        writer.record_done()
+        self.assertEqual(len(graph.log), 3)
+        #nodes run before links whatever order the rows were added in
+        self.assertIn("MERGE", graph.log[0][0])
+        self.assertEqual(graph.log[0][1], [{"Id": 1}, {"Id": 2}])
+        self.assertEqual(graph.log[1][1], [{"Id": 1}])
+        self.assertEqual(graph.log[2], "commit")
+        self.assertEqual(writer.records, 2)
+        self.assertEqual(writer.rows_written, 3)
+
+    def test_empty_flush_does_nothing(self):
+        graph = RecordingGraph()
+        self.make_writer(graph, 10).flush()
+        self.assertEqual(graph.log, [])
+
+    def test_failed_flush_rolls_back_and_keeps_rows(self):
+        graph = RecordingGraph(fail=True)
+        writer = self.make_writer(graph, 10)
+        writer.add("nodes", {"Id": 1})
+        with self.assertRaises(RuntimeError):
+            writer.flush()
+        self.assertEqual(graph.log, ["rollback"])
+        graph.fail = False
+        writer.flush()
+        self.assertEqual(graph.log[1][1], [{"Id": 1}])
+
+    def test_units_are_handed_over_after_commit(self):
+        graph = RecordingGraph(fail=True)
+        flushed = []
+        writer = BatchWriter(graph, 2, on_flush=flushed.extend)
+        writer.add_statement("nodes", "UNWIND $rows AS row MERGE (n:Node {Id: row.Id})")
+        writer.add("nodes", {"Id": 1})
+        writer.record_done(1)
+        writer.add("nodes", {"Id": 2})
+        with self.assertRaises(RuntimeError):
+            writer.record_done(2)
+        self.assertEqual(flushed, [])
+        graph.fail = False
+        writer.flush()
+        self.assertEqual(flushed, [1, 2])
+
+class TestPullRequestBatchWriter(unittest.TestCase):
+
+    def test_missing_endpoints_are_merged(self):
+        graph = RecordingGraph()
+        writer = PullRequestBatchWriter(graph, 10)
+        writer.add("pull_requests", {"Id": 7, "props": {}})
+        writer.add("repositories", {"Id": 7, "RepositoryId": "repo"})
+        writer.add("reviewers", {"Id": 7, "PersonId": "p"})
+        writer.record_done()
+        writer.flush()
+        statements = [entry[0] for entry in graph.log[:-1]]
+        #an unchanged pull request is never written again, a MATCH that finds nothing loses the edge
+        self.assertIn("MERGE (repo:Repository", statements[1])
+        self.assertIn("MERGE (person:Person", statements[2])
+
+class TestCommentBatchWriter(unittest.TestCase):
+
+    def test_threads_are_written_before_comments(self):
+        graph = RecordingGraph()
+        writer = CommentBatchWriter(graph, 1)
+        writer.add("authors", {"Id": "1_1", "PersonId": "p"})
+        writer.add("comments", {"Id": "1_1", "ThreadId": 1, "props": {}})
+        writer.add("threads", {"Id": 1, "PullRequestId": 7, "props": {}})
+        writer.record_done()
+        statements = [entry[0] for entry in graph.log[:-1]]
+        self.assertIn("PullRequestThread", statements[0])
+        self.assertIn("MERGE (comment:Comment", statements[1])
+        self.assertIn(":AUTHOR", statements[2])
+
+class TestWorkItemBatchWriter(unittest.TestCase):
+
+    def test_one_statement_per_link_type_after_work_items(self):
+        graph = RecordingGraph()
+        writer = WorkItemBatchWriter(graph, 10)
+        writer.add_link("Related", "1", "2", {})
+        writer.add_link("Related", "2", "3", {})
+        writer.add_link("Odd`Type", "1", "3", {})
+        writer.add("work_items", {"Id": "1", "props": {}})
+        writer.flush()
+        statements = [entry[0] for entry in graph.log[:-1]]
+        self.assertEqual(len(statements), 3)
+        self.assertIn("MERGE (work_item:WorkItem", statements[0])
+        self.assertIn("[link:`Related`]", statements[1])
+        self.assertEqual(len(graph.log[1][1]), 2)
+        self.assertIn("[link:`Odd``Type`]", statements[2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+from ResponseCache import ShardedFileCache
+from BulkExport import BulkExporter
+
+BASE = "https://company.visualstudio.com/DefaultCollection"
+PROJECT_ID = "p-1"
+REPO_ID = "r-1"
+PERSON_ID = "u-1"
+
+class FakeVsts(object):
+    """
+    just what the crawler mappers read from VstsInfo
+    """
+    instance = "company.visualstudio.com"
+    api_version = "3.0"
+    headers = {}
+    project_whitelist = ["Proj"]
+
+    def get_request_settings(self):
+        return {"instance": self.instance, "api_version": self.api_version,
+                "project_name": "None", "headers": self.headers}
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8") as csv_file:
+        return list(csv.reader(csv_file))
+
+class TestBulkExport(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = ShardedFileCache(os.path.join(self.folder, "cache"))
+        self.out = os.path.join(self.folder, "bulk")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def fill_cache(self, lists=True):
+        if lists:
+            self.cache.put(BASE + "/_apis/projects?api-version=3.0",
+                           {"value": [{"id": PROJECT_ID, "name": "Proj", "revision": 7},
+                                      {"id": "p-2", "name": "NotWhitelisted"}]})
+            self.cache.put(BASE + "/Proj/_apis/git/repositories?api-version=3.0",
+                           {"value": [{"id": REPO_ID, "name": "repo", "url": "u",
+                                       "project": {"id": PROJECT_ID}}]})
+            self.cache.put(BASE + "/_apis/projects/" + PROJECT_ID + "/teams/t-1/members?api-version=3.0",
+                           {"value": [{"id": PERSON_ID, "displayName": "Ann Lee",
+                                       "uniqueName": "ann@company.com", "url": "x"}]})
+        self.cache.put(BASE + "/_apis/git/repositories/" + REPO_ID + "/pullRequests/12?api-version=3.0",
+                       {"pullRequestId": 12, "status": "completed", "title": "fix",
+                        "creationDate": "2017-01-01T00:00:00Z", "repository": {"id": REPO_ID, "name": "repo"},
+                        "createdBy": {"id": PERSON_ID}, "reviewers": [{"id": PERSON_ID}]})
+        self.cache.put(BASE + "/_apis/git/repositories/" + REPO_ID + "/pullRequests/12/threads?api-version=3.0",
+                       {"value": [{"id": 3, "status": "active",
+                                   "comments": [{"id": 1, "commentType": "text", "content": "looks good",
+                                                 "author": {"id": PERSON_ID}},
+                                                {"id": 2, "commentType": "system", "content": "voted"}]}]})
+        self.cache.put(BASE + "/_apis/git/repositories/" + REPO_ID + "/pullRequests/12/workitems?api-version=3.0",
+                       {"value": [{"id": 40, "url": "w"}]})
+        self.cache.put(BASE + "/_apis/wit/workitems?ids=40&api-version=3.0",
+                       {"value": [{"id": 40, "rev": 2, "url": "w",
+                                   "fields": {"System.TeamProject": "Proj", "System.Title": "bug",
+                                              "System.WorkItemType": "Bug",
+                                              "System.CreatedBy": "Ann Lee <ann@company.com>"}}]})
+
+    def export(self):
+        exporter = BulkExporter(FakeVsts())
+        exporter.export(self.cache)
+        statements = exporter.write(self.out, "file:///", 1000)
+        return exporter, statements
+
+    def test_nodes(self):
+        self.fill_cache()
+        self.export()
+        self.assertEqual([row[0] for row in read_csv(os.path.join(self.out, "project.csv"))], [PROJECT_ID])
+        self.assertEqual([row[0] for row in read_csv(os.path.join(self.out, "repository.csv"))], [REPO_ID])
+        self.assertEqual([row[0] for row in read_csv(os.path.join(self.out, "pullrequest.csv"))], ["12"])
+        self.assertEqual([row[0] for row in read_csv(os.path.join(self.out, "workitem.csv"))], ["40"])
+        comments = read_csv(os.path.join(self.out, "comment.csv"))
+        self.assertEqual(len(comments), 1)
+        self.assertIn("looks good", comments[0])
+        header = read_csv(os.path.join(self.out, "pullrequest_header.csv"))[0]
+        self.assertEqual(header[0:2], [":ID(PullRequest)", "Id:long"])
+
+    def test_relationships(self):
+        self.fill_cache()
+        self.export()
+
+        def rel(name):
+            return [row[0:3] for row in read_csv(os.path.join(self.out, name + ".csv"))]
+
+        self.assertEqual(rel("rel_repository_belongs_to_project"), [[REPO_ID, PROJECT_ID, "BELONGS_TO"]])
+        self.assertEqual(rel("rel_pullrequest_for_repository_repository"), [["12", REPO_ID, "FOR_REPOSITORY"]])
+        self.assertEqual(rel("rel_workitem_linked_to_pullrequest"), [["40", "12", "LINKED_TO"]])
+        self.assertEqual(rel("rel_workitem_for_project_project"), [["40", PROJECT_ID, "FOR_PROJECT"]])
+        self.assertEqual(rel("rel_workitem_created_by_person"), [["40", PERSON_ID, "CREATED_BY"]])
+        self.assertEqual(rel("rel_pullrequestthread_part_of_pullrequest"), [["3", "12", "PART_OF"]])
+
+    def test_cypher(self):
+        self.fill_cache()
+        _, statements = self.export()
+        with open(os.path.join(self.out, "load.cypher")) as cypher_file:
+            cypher = cypher_file.read()
+        self.assertIn("LOAD CSV FROM 'file:///pullrequest.csv' AS row\nMERGE (n:PullRequest {Id: toInteger(row[1])})",
+                      cypher)
+        self.assertIn("MATCH (a:WorkItem {Id: row[0]})\nMATCH (b:PullRequest {Id: toInteger(row[1])})\n"
+                      "MERGE (a)-[r:`LINKED_TO`]->(b)", cypher)
+        self.assertTrue(all(statement.startswith("USING PERIODIC COMMIT 1000") for statement in statements))
+
+    def test_missing_lists_fail_loudly(self):
+        self.fill_cache(lists=False)
+        with self.assertRaises(ValueError):
+            BulkExporter(FakeVsts()).export(self.cache)
+
+if __name__ == '__main__':
+    unittest.main()
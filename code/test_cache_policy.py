@@ -0,0 +1,44 @@
+import time
+import unittest
+from CachePolicy import CachePolicy
+from ResponseCache import CacheEntry
+
+DAY = 24 * 3600
+
+class TestCachePolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = CachePolicy(active_ttl=DAY, list_ttl=3600)
+
+    def entry(self, data, age):
+        return CacheEntry("https://company.visualstudio.com/x", data, time.time() - age)
+
+    def test_completed_pull_request_is_kept_forever(self):
+        data = {"pullRequestId": 1, "status": "completed"}
+        self.assertTrue(self.policy.is_fresh(self.entry(data, 365 * DAY)))
+
+    def test_active_pull_request_expires(self):
+        data = {"pullRequestId": 1, "status": "active"}
+        self.assertTrue(self.policy.is_fresh(self.entry(data, 60)))
+        self.assertFalse(self.policy.is_fresh(self.entry(data, 2 * DAY)))
+
+    def test_closed_work_item_is_kept_forever(self):
+        data = {"id": 1, "fields": {"System.State": "Closed"}}
+        self.assertTrue(self.policy.is_fresh(self.entry(data, 365 * DAY)))
+
+    def test_open_work_item_expires(self):
+        data = {"id": 1, "fields": {"System.State": "Active"}}
+        self.assertFalse(self.policy.is_fresh(self.entry(data, 2 * DAY)))
+
+    def test_lists_have_short_ttl(self):
+        data = {"count": 1, "value": [{"pullRequestId": 1, "status": "completed"}]}
+        self.assertTrue(self.policy.is_fresh(self.entry(data, 60)))
+        self.assertFalse(self.policy.is_fresh(self.entry(data, 2 * 3600)))
+
+    def test_forever_ttl_never_expires(self):
+        policy = CachePolicy(active_ttl=None, list_ttl=None)
+        data = {"value": []}
+        self.assertTrue(policy.is_fresh(self.entry(data, 365 * DAY)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import time
+import unittest
+from CrawlEngine import TokenBucket, CrawlEngine, AdaptiveRateLimiter, PageSizer, parse_retry_after
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_goes_out_without_waiting(self):
+        bucket = TokenBucket(1, burst=3)
+        waits = [bucket.reserve() for _ in range(3)]
+        self.assertEqual(waits, [0.0, 0.0, 0.0])
+
+    def test_waits_once_burst_is_used(self):
+        bucket = TokenBucket(10, burst=1)
+        bucket.reserve()
+        self.assertGreater(bucket.reserve(), 0.0)
+
+    def test_no_rate_means_no_limit(self):
+        bucket = TokenBucket(0)
+        self.assertEqual(bucket.reserve(), 0.0)
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+
+    def test_throttle_halves_rate(self):
+        limiter = AdaptiveRateLimiter(8, max_rate=16, min_rate=1)
+        limiter.on_throttled(429)
+        self.assertEqual(limiter.rate, 4)
+        self.assertEqual(limiter.metrics.throttled, 1)
+
+    def test_rate_never_drops_below_floor(self):
+        limiter = AdaptiveRateLimiter(2, max_rate=16, min_rate=1)
+        for _ in range(5):
+            limiter.on_throttled(503)
+        self.assertEqual(limiter.rate, 1)
+        self.assertEqual(limiter.metrics.server_busy, 5)
+
+    def test_healthy_responses_ramp_up_to_ceiling(self):
+        limiter = AdaptiveRateLimiter(1, max_rate=4, min_rate=0.5)
+        for _ in range(100):
+            limiter.on_response({})
+        self.assertEqual(limiter.rate, 4)
+
+    def test_server_delay_header_slows_down(self):
+        limiter = AdaptiveRateLimiter(8, max_rate=16, min_rate=1)
+        limiter.on_response({"x-ratelimit-delay": "0.5"})
+        self.assertEqual(limiter.rate, 4)
+
+    def test_unlimited_rate_recovers_after_throttle(self):
+        limiter = AdaptiveRateLimiter(0, max_rate=0, min_rate=0)
+        limiter.on_throttled(429)
+        self.assertEqual(limiter.rate, limiter.UNLIMITED_MAX_RATE / 2)
+        for _ in range(100):
+            limiter.on_response({})
+        self.assertEqual(limiter.rate, 0)
+        self.assertEqual(limiter.reserve(), 0.0)
+
+    def test_unlimited_rate_never_drops_to_zero(self):
+        limiter = AdaptiveRateLimiter(0, max_rate=0, min_rate=0)
+        for _ in range(50):
+            limiter.on_throttled(503)
+        self.assertGreater(limiter.rate, 0)
+
+    def test_bad_rate_limit_headers_are_ignored(self):
+        limiter = AdaptiveRateLimiter(8, max_rate=16, min_rate=1)
+        limiter.on_response({"x-ratelimit-delay": "soon", "x-ratelimit-remaining": "",
+                             "x-ratelimit-limit": "lots"})
+        self.assertGreater(limiter.rate, 8)
+
+    def test_backoff_respects_retry_after(self):
+        limiter = AdaptiveRateLimiter(8)
+        self.assertGreaterEqual(limiter.backoff(0, retry_after=3), 3)
+        self.assertLessEqual(limiter.backoff(2), 4)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("5"), 5.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("not a date"))
+
+class TestCrawlEngine(unittest.TestCase):
+
+    def test_results_keep_order(self):
+        engine = CrawlEngine(lambda x: x * 2, concurrency=4)
+        self.assertEqual(engine.run([1, 2, 3, 4, 5]), [2, 4, 6, 8, 10])
+
+    def test_runs_in_parallel(self):
+        engine = CrawlEngine(lambda x: time.sleep(0.2), concurrency=5)
+        start = time.time()
+        engine.run(range(5))
+        self.assertLess(time.time() - start, 0.9)
+
+    def test_exceptions_are_returned(self):
+        def fetch(item):
+            if item == 2:
+                raise ValueError("bad")
+            return item
+        results = CrawlEngine(fetch).run([1, 2, 3])
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], 3)
+
+class TestPageSizer(unittest.TestCase):
+
+    def test_grows_while_fast(self):
+        sizer = PageSizer(100, max_size=300)
+        sizer.record(1, 0.5, 1000)
+        self.assertEqual(sizer.size, 200)
+        sizer.record(2, 0.5, 1000)
+        self.assertEqual(sizer.size, 300)
+        self.assertEqual(sizer.requests, 3)
+        self.assertEqual(sizer.sizes, [100, 200, 200])
+
+    def test_holds_when_slow_or_cached(self):
+        sizer = PageSizer(100)
+        sizer.record(1, 5.0, 1000)
+        sizer.record(1, None, 0)
+        self.assertEqual(sizer.size, 100)
+
+    def test_shrinks_on_big_pages_and_timeouts(self):
+        sizer = PageSizer(100, min_size=30, max_bytes=10)
+        sizer.record(1, 0.1, 100)
+        self.assertEqual(sizer.size, 50)
+        self.assertTrue(sizer.shrink())
+        self.assertEqual(sizer.size, 30)
+        self.assertFalse(sizer.shrink())
+
+    def test_cap_stops_growing_past_what_the_server_hands_out(self):
+        sizer = PageSizer(100, min_size=10)
+        sizer.cap(40)
+        self.assertEqual(sizer.size, 40)
+        sizer.record(1, 0.1, 100)
+        self.assertEqual(sizer.size, 40)
+
+if __name__ == '__main__':
+    unittest.main()
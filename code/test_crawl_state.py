@@ -0,0 +1,34 @@
+import shutil
+import tempfile
+import unittest
+from CrawlState import CrawlState
+
+class TestCrawlState(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_missing_key_returns_default(self):
+        self.assertEqual(CrawlState(self.folder).get("nope", 5), 5)
+
+    def test_set_then_get_from_new_instance(self):
+        CrawlState(self.folder).set("pull_requests.completed.abc", "2018-01-01T00:00:00Z")
+        value = CrawlState(self.folder).get("pull_requests.completed.abc")
+        self.assertEqual(value, "2018-01-01T00:00:00Z")
+
+    def test_unsafe_names_stay_in_folder(self):
+        state = CrawlState(self.folder)
+        self.assertTrue(state.path_for("../a/b?c").startswith(self.folder))
+
+    def test_delete(self):
+        state = CrawlState(self.folder)
+        state.set("a", 1)
+        state.delete("a")
+        state.delete("a")
+        self.assertIsNone(state.get("a"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import shutil
+import tempfile
+import unittest
+from Fingerprints import FingerprintStore, fingerprint
+from BatchWriter import PullRequestBatchWriter, WorkItemBatchWriter
+from test_batch_writer import RecordingGraph
+
+class TestFingerprints(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = FingerprintStore(self.folder + "/state/fingerprints.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_fingerprint_ignores_key_order(self):
+        self.assertEqual(fingerprint({"a": 1, "b": [1, 2]}), fingerprint({"b": [1, 2], "a": 1}))
+        self.assertNotEqual(fingerprint({"a": 1}), fingerprint({"a": 2}))
+
+    def test_store_remembers_last_digest(self):
+        self.assertFalse(self.store.unchanged("pull_request", 1, "abc"))
+        self.store.record("pull_request", [(1, "abc")])
+        self.assertTrue(self.store.unchanged("pull_request", 1, "abc"))
+        self.assertFalse(self.store.unchanged("pull_request", 1, "def"))
+        self.assertFalse(self.store.unchanged("pull_request_comments", 1, "abc"))
+        self.assertEqual(self.store.unchanged_count, 1)
+        self.store.clear()
+        self.assertEqual(self.store.counts(), [])
+
+    def write_pull_request(self, graph, title, fail=False):
+        writer = PullRequestBatchWriter(graph, 10, fingerprints=self.store)
+        writer.add("pull_requests", {"Id": 1, "props": {"Title": title}})
+        writer.add("reviewers", {"Id": 1, "PersonId": "p"})
+        writer.record_done(1)
+        writer.add("pull_requests", {"Id": 2, "props": {"Title": "other"}})
+        writer.record_done(2)
+        graph.fail = fail
+        writer.flush()
+        return writer
+
+    def test_unchanged_records_are_not_written(self):
+        graph = RecordingGraph()
+        self.write_pull_request(graph, "first")
+        del graph.log[:]
+        writer = self.write_pull_request(graph, "first")
+        self.assertEqual(graph.log, [])
+        self.assertEqual(writer.unchanged, 2)
+        writer = self.write_pull_request(graph, "changed")
+        self.assertEqual(graph.log[0][1], [{"Id": 1, "props": {"Title": "changed"}}])
+        self.assertEqual(writer.unchanged, 1)
+
+    def write_links(self, graph, link_type):
+        writer = WorkItemBatchWriter(graph, 10, fingerprints=self.store)
+        for work_item_id in ("1", "2"):
+            writer.add("work_items", {"Id": work_item_id, "props": {"Title": "t" + work_item_id}})
+            writer.work_item_done(work_item_id)
+        writer.add_link(link_type, "1", "2", {})
+        writer.flush()
+        return writer
+
+    def test_unchanged_work_items_and_links_are_not_written(self):
+        graph = RecordingGraph()
+        self.write_links(graph, "Related")
+        del graph.log[:]
+        writer = self.write_links(graph, "Related")
+        self.assertEqual(graph.log, [])
+        self.assertEqual(writer.unchanged, 3)
+        writer = self.write_links(graph, "Parent")
+        self.assertEqual(writer.unchanged, 2)
+        self.assertEqual(len(graph.log), 2)
+        self.assertIn("[link:`Parent`]", graph.log[0][0])
+
+    def test_fingerprints_wait_for_the_commit(self):
+        graph = RecordingGraph()
+        with self.assertRaises(RuntimeError):
+            self.write_pull_request(graph, "first", fail=True)
+        self.assertEqual(self.store.recorded, 0)
+        writer = self.write_pull_request(graph, "first")
+        self.assertEqual(writer.unchanged, 0)
+        self.assertEqual(self.store.recorded, 2)
+
+if __name__ == '__main__':
+    unittest.main()
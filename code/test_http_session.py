@@ -0,0 +1,26 @@
+import gzip
+import zlib
+import unittest
+from HttpSession import HttpSession, get_session
+
+class TestHttpSession(unittest.TestCase):
+
+    def test_decodes_gzip(self):
+        session = HttpSession()
+        raw = gzip.compress(b'{"value": []}')
+        self.assertEqual(session.decode_body(raw, "gzip"), b'{"value": []}')
+
+    def test_decodes_deflate(self):
+        session = HttpSession()
+        raw = zlib.compress(b'{"value": []}')
+        self.assertEqual(session.decode_body(raw, "deflate"), b'{"value": []}')
+
+    def test_plain_body_untouched(self):
+        session = HttpSession()
+        self.assertEqual(session.decode_body(b'{}', None), b'{}')
+
+    def test_session_is_shared_in_process(self):
+        self.assertIs(get_session(), get_session())
+
+if __name__ == '__main__':
+    unittest.main()
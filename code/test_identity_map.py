@@ -0,0 +1,125 @@
+import unittest
+from IdentityMap import IdentityMap, PersonNameIndex
+
+class FakeSelection(object):
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def where(self, **properties):
+        return FakeSelection([node for node in self.nodes
+                              if all(getattr(node, k) == v for k, v in properties.items())])
+
+    def limit(self, amount):
+        return FakeSelection(self.nodes[:amount])
+
+    def first(self):
+        return self.nodes[0] if self.nodes else None
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+class FakePerson(object):
+    __primarykey__ = "Id"
+    __primarylabel__ = "Person"
+    queries = 0
+
+    def __init__(self, person_id=None, name=None):
+        self.Id = person_id
+        self.Name = name
+
+    @classmethod
+    def select(cls, graph, primary_value=None):
+        cls.queries += 1
+        nodes = list(graph)
+        if primary_value is not None:
+            nodes = [node for node in nodes if node.Id == primary_value]
+        return FakeSelection(nodes)
+
+class TestIdentityMap(unittest.TestCase):
+
+    def setUp(self):
+        FakePerson.queries = 0
+        self.graph = [FakePerson("1", "Ann"), FakePerson("2", "Bob"), FakePerson("3", "Cy")]
+
+    def test_second_lookup_is_a_hit(self):
+        identity_map = IdentityMap()
+        first = identity_map.get(self.graph, FakePerson, "2")
+        second = identity_map.get(self.graph, FakePerson, "2")
+        self.assertIs(first, second)
+        self.assertEqual(FakePerson.queries, 1)
+        self.assertEqual((identity_map.hits, identity_map.misses), (1, 1))
+
+    def test_missing_nodes_are_not_remembered(self):
+        identity_map = IdentityMap()
+        self.assertIsNone(identity_map.get(self.graph, FakePerson, "9"))
+        self.graph.append(FakePerson("9"))
+        self.assertIsNotNone(identity_map.get(self.graph, FakePerson, "9"))
+
+    def test_lookup_by_other_property(self):
+        identity_map = IdentityMap()
+        self.assertEqual(identity_map.get(self.graph, FakePerson, "Cy", key="Name").Id, "3")
+        self.assertIsNone(identity_map.get(self.graph, FakePerson, "3", key="Name"))
+
+    def test_preload_and_eviction(self):
+        identity_map = IdentityMap(capacity=2)
+        identity_map.preload(self.graph, FakePerson)
+        identity_map.preload(self.graph, FakePerson)
+        self.assertEqual(FakePerson.queries, 1)
+        identity_map.get(self.graph, FakePerson, "2")
+        self.assertEqual((identity_map.hits, identity_map.misses), (1, 0))
+        #loading 3 pushes out 1, the least recently used
+        identity_map.get(self.graph, FakePerson, "3")
+        identity_map.get(self.graph, FakePerson, "1")
+        self.assertEqual((identity_map.hits, identity_map.misses), (1, 2))
+        self.assertEqual(identity_map.evictions, 2)
+
+class FakeGraph(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.runs = []
+
+    def run(self, query, **parameters):
+        self.runs.append(parameters)
+        if not parameters:
+            return iter(self.rows)
+        return iter([row for row in self.rows
+                     if row["Name"] == parameters["name"] or
+                     row["UniqueName"] == parameters["unique_name"]])
+
+class TestPersonNameIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = FakeGraph([{"Id": "1", "Name": "John O'Doe", "UniqueName": "john@example.com"},
+                                {"Id": "2", "Name": "Jane Roe", "UniqueName": "jane@example.com"}])
+
+    def test_split_identity(self):
+        self.assertEqual(PersonNameIndex.split_identity("John Doe <john@example.com>"),
+                         ("John Doe", "john@example.com"))
+        self.assertEqual(PersonNameIndex.split_identity("John Doe"), ("John Doe", None))
+        self.assertEqual(PersonNameIndex.split_identity({"displayName": "A", "uniqueName": "a@b"}),
+                         ("A", "a@b"))
+
+    def test_lookup_from_loaded_index(self):
+        index = PersonNameIndex()
+        index.load(self.graph)
+        self.assertEqual(index.lookup(self.graph, "John O'Doe <john@example.com>"), "1")
+        self.assertEqual(index.lookup(self.graph, "jane  roe"), "2")
+        self.assertEqual(len(self.graph.runs), 1)
+
+    def test_unique_name_wins_over_display_name(self):
+        index = PersonNameIndex()
+        index.load(self.graph)
+        self.assertEqual(index.lookup(self.graph, "Jane Roe <john@example.com>"), "1")
+
+    def test_misses_are_queried_once(self):
+        index = PersonNameIndex()
+        self.assertEqual(index.lookup(self.graph, "Jane Roe <jane@example.com>"), "2")
+        self.assertIsNone(index.lookup(self.graph, "Nobody <nobody@example.com>"))
+        self.assertIsNone(index.lookup(self.graph, "Nobody <nobody@example.com>"))
+        self.assertEqual(index.queries, 2)
+        self.assertEqual(index.lookup(self.graph, "jane@example.com"), "2")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import shutil
+import tempfile
+import unittest
+from Journal import Journal
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = self.folder + "/state/journal.sqlite"
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_recorded_units_survive_a_restart(self):
+        Journal(self.path).record("comments", "Oystertoad", [1, 2])
+        journal = Journal(self.path)
+        self.assertEqual(journal.remaining("comments", "Oystertoad", [1, 2, 3]), [3])
+        self.assertEqual(journal.skipped, 2)
+        self.assertEqual(journal.remaining("comments", "OtherProject", [1]), [1])
+        self.assertEqual(journal.remaining("work_items", "Oystertoad", [1]), [1])
+
+    def test_remaining_with_key(self):
+        journal = Journal(self.path)
+        journal.record("comments", "proj", [7])
+        keys = [("repo", 7), ("repo", 8)]
+        self.assertEqual(journal.remaining("comments", "proj", keys, key=lambda key: str(key[1])),
+                         [("repo", 8)])
+
+    def test_results_are_kept_with_units(self):
+        journal = Journal(self.path)
+        journal.record("pull_requests.completed", "proj", ["repo"], [1, 2])
+        self.assertTrue(journal.is_done("pull_requests.completed", "proj", "repo"))
+        self.assertFalse(journal.is_done("pull_requests.completed", "proj", "other"))
+        self.assertEqual(journal.done("pull_requests.completed", "proj"), {"repo": [1, 2]})
+
+    def test_clear_scope(self):
+        journal = Journal(self.path)
+        journal.record("comments", "a", [1])
+        journal.record("comments", "b", [1])
+        journal.clear("comments", "a")
+        self.assertEqual(journal.scopes(), [("comments", "b", 1)])
+        journal.clear()
+        self.assertEqual(journal.scopes(), [])
+
+if __name__ == '__main__':
+    unittest.main()
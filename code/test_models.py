@@ -0,0 +1,25 @@
+import unittest
+import models
+
+class ForgettingDatabase(object):
+    forgotten = 0
+
+    @classmethod
+    def forget_all(cls):
+        cls.forgotten += 1
+
+class TestModels(unittest.TestCase):
+
+    def test_forked_child_forgets_inherited_graphs(self):
+        original = getattr(models.py2neo, "GraphDatabase", None)
+        models.py2neo.GraphDatabase = ForgettingDatabase
+        try:
+            models._GRAPHS[12345] = object()
+            models._forget_inherited_graphs()
+        finally:
+            models.py2neo.GraphDatabase = original
+        self.assertEqual(models._GRAPHS, {})
+        self.assertEqual(ForgettingDatabase.forgotten, 1)
+
+if __name__ == '__main__':
+    unittest.main()
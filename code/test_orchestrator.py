@@ -0,0 +1,53 @@
+import time
+import threading
+import unittest
+from Orchestrator import Orchestrator, Stage, order_stages, merge_keys
+
+class TestOrchestrator(unittest.TestCase):
+
+    def test_results_are_passed_to_dependents(self):
+        stages = [Stage("projects", lambda _: ["a", "b"]),
+                  Stage("repos", lambda results: {name: [name + "1"] for name in results["projects"]},
+                        ["projects"])]
+        results = Orchestrator(stages).run()
+        self.assertEqual(results["repos"], {"a": ["a1"], "b": ["b1"]})
+
+    def test_independent_stages_run_at_the_same_time(self):
+        both_started = threading.Barrier(2, timeout=5)
+
+        def wait_for_other(_):
+            both_started.wait()
+            return True
+
+        stages = [Stage("pull_requests", lambda _: []),
+                  Stage("comments", wait_for_other, ["pull_requests"]),
+                  Stage("work_items", wait_for_other, ["pull_requests"])]
+        results = Orchestrator(stages).run()
+        self.assertTrue(results["comments"] and results["work_items"])
+
+    def test_failed_stage_skips_dependents_only(self):
+        def fail(_):
+            raise RuntimeError("vsts is down")
+
+        stages = [Stage("a", fail), Stage("b", lambda _: 1, ["a"]), Stage("c", lambda _: 2, ["b"]),
+                  Stage("d", lambda _: time.sleep(0.05) or 3)]
+        orchestrator = Orchestrator(stages)
+        results = orchestrator.run()
+        statuses = {name: stage.status for name, stage in orchestrator.stages.items()}
+        self.assertEqual(statuses, {"a": "failed", "b": "skipped", "c": "skipped", "d": "done"})
+        self.assertEqual(results, {"d": 3})
+
+    def test_bad_graphs_are_rejected(self):
+        with self.assertRaises(ValueError):
+            order_stages([Stage("a", None, ["missing"])])
+        with self.assertRaises(ValueError):
+            order_stages([Stage("a", None, ["b"]), Stage("b", None, ["a"])])
+        ordered = order_stages([Stage("b", None, ["a"]), Stage("a", None)])
+        self.assertEqual(list(ordered), ["a", "b"])
+
+    def test_stored_pull_requests_follow_the_crawled_ones(self):
+        merged = merge_keys({"a": [("r", 3)]}, {"a": [("r", 1), ("r", 3)], "b": [("s", 2)]})
+        self.assertEqual(merged, {"a": [("r", 3), ("r", 1)], "b": [("s", 2)]})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+from models import Project
+from ProjectsTeamsUsers import ProjectsTeamsUsersWorker
+
+class RecordingTransaction(object):
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def merge(self, graph_object):
+        self.graph.merged.append(graph_object)
+
+    def push(self, graph_object):
+        pass
+
+    def create(self, graph_object):
+        self.graph.merged.append(graph_object)
+
+    def commit(self):
+        self.graph.committed += 1
+
+class RecordingGraph(object):
+    """
+    counts transactions, over bolt every begin holds a pooled connection until it is committed
+    """
+
+    def __init__(self):
+        self.begun = 0
+        self.committed = 0
+        self.merged = []
+
+    def begin(self):
+        self.begun += 1
+        return RecordingTransaction(self)
+
+    def merge(self, graph_object):
+        self.merged.append(graph_object)
+
+    def push(self, graph_object):
+        pass
+
+class FakeVsts(object):
+
+    def make_request(self, url):
+        if "/members" in url:
+            return {"value": [{"id": "u-1", "displayName": "Ann"},
+                              {"id": "g-1", "displayName": "Group", "isContainer": True}]}
+        return {"value": [{"id": "t-1", "name": "Team"}]}
+
+class TestProjectsTeamsUsers(unittest.TestCase):
+
+    def test_every_transaction_is_committed(self):
+        worker = ProjectsTeamsUsersWorker({"instance": "https://company.visualstudio.com",
+                                           "project_name": "None", "api_version": "3.0", "headers": {}},
+                                          ["Proj"], FakeVsts())
+        project = Project()
+        project.Id = "p-1"
+        graph = RecordingGraph()
+        worker.add_teams_to_repo(project, graph)
+        self.assertEqual([graph_object.Id for graph_object in graph.merged], ["t-1", "u-1"])
+        self.assertEqual(graph.begun, graph.committed)
+
+if __name__ == '__main__':
+    unittest.main()
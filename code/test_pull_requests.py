@@ -0,0 +1,119 @@
+import re
+import unittest
+from CrawlEngine import PageSizer
+from HttpSession import HttpStats
+from PullRequests import PullRequestsWorker
+from test_batch_writer import RecordingGraph
+
+class FakeCrawlState(dict):
+
+    def set(self, name, value):
+        self[name] = value
+
+def raw_pull(pull_request_id, created, closed):
+    return {"pullRequestId": pull_request_id, "creationDate": created, "closedDate": closed,
+            "status": "completed", "url": "detail", "repository": {"id": "repo", "name": "repo"},
+            "reviewers": [], "createdBy": {"id": "u"}}
+
+class FakeVsts(object):
+    """
+    serves pages of pull requests by $top and $skip, details have no links.
+    Every page comes with a slow, big pull request detail request from another thread.
+    """
+    instance = "https://company.visualstudio.com"
+    api_version = "3.0"
+    incremental_lookback_days = 30
+    neo4j_batch_size = 500
+    fingerprints = None
+    pipeline_fetch_workers = 1
+    pipeline_map_workers = 1
+    pipeline_queue_size = 10
+    pull_request_min_page_size = 1
+    pull_request_max_page_size = 1000
+    crawl_concurrency = 1
+
+    def __init__(self, pulls=(), cap=None):
+        self.pulls = list(pulls)
+        self.cap = cap
+        self.pages = []
+        self.http_stats = HttpStats()
+        self.crawl_state = FakeCrawlState()
+
+    def prefetch(self, urls, write_to_file=True, timings=None):
+        pass
+
+    def discard_prefetched(self, urls):
+        pass
+
+    def make_request(self, url, write_to_file=True, timings=None):
+        match = re.search(r"\$top=(\d+)&\$skip=(\d+)", url)
+        if match is None:
+            return {}
+        top, skip = int(match.group(1)), int(match.group(2))
+        if self.cap is not None:
+            top = min(top, self.cap)
+        self.pages.append((top, skip))
+        self.http_stats.record(1000, 1000, 0.5)
+        self.http_stats.record(10 ** 7, 10 ** 7, 10.0)
+        if timings is not None:
+            timings[url] = (0.5, 1000)
+        return {"value": self.pulls[skip:skip + top]}
+
+class TestPullRequests(unittest.TestCase):
+
+    def test_only_page_requests_size_the_pages(self):
+        worker = PullRequestsWorker("Completed", FakeVsts())
+        sizer = PageSizer(100, max_bytes=5000)
+        worker.fetch_pages([worker.get_vsts_pull_request_url("proj", "repo", 0, 100)], sizer)
+        self.assertEqual(sizer.size, 200)
+
+    def test_capped_pages_are_not_truncated(self):
+        vsts = FakeVsts([raw_pull(number, "2018-01-01T00:00:00Z", "2018-01-02T00:00:00Z")
+                         for number in range(10)], cap=3)
+        vsts.crawl_concurrency = 4
+        worker = PullRequestsWorker("Completed", vsts, 5)
+        saved = worker.crawl_repository(RecordingGraph(), "proj", "repo")
+        self.assertEqual(saved, list(range(10)))
+
+    def test_short_last_page_ends_an_uncapped_repository(self):
+        vsts = FakeVsts([raw_pull(number, "2018-01-01T00:00:00Z", "2018-01-02T00:00:00Z")
+                         for number in range(12)])
+        vsts.pull_request_max_page_size = 5
+        worker = PullRequestsWorker("Completed", vsts, 5)
+        saved = worker.crawl_repository(RecordingGraph(), "proj", "repo")
+        self.assertEqual(saved, list(range(12)))
+        #vsts served 5 in full so the page of 2 is the last one, no empty request after it
+        self.assertEqual(vsts.pages, [(5, 0), (5, 5), (5, 10)])
+
+    def test_capped_repository_stops_at_the_short_last_page(self):
+        vsts = FakeVsts([raw_pull(number, "2018-01-01T00:00:00Z", "2018-01-02T00:00:00Z")
+                         for number in range(10)], cap=3)
+        worker = PullRequestsWorker("Completed", vsts, 5)
+        saved = worker.crawl_repository(RecordingGraph(), "proj", "repo")
+        self.assertEqual(saved, list(range(10)))
+        self.assertEqual(vsts.pages, [(3, 0), (3, 3), (3, 6), (3, 9)])
+
+    def test_cap_below_the_smallest_page_size(self):
+        vsts = FakeVsts([raw_pull(number, "2018-01-01T00:00:00Z", "2018-01-02T00:00:00Z")
+                         for number in range(10)], cap=3)
+        vsts.pull_request_min_page_size = 4
+        vsts.crawl_concurrency = 4
+        worker = PullRequestsWorker("Completed", vsts, 5)
+        saved = worker.crawl_repository(RecordingGraph(), "proj", "repo")
+        self.assertEqual(saved, list(range(10)))
+
+    def test_incremental_crawl_finds_old_pull_requests_completed_since(self):
+        vsts = FakeVsts([raw_pull(3, "2017-06-01T00:00:00Z", "2018-03-01T00:00:00Z"),
+                         raw_pull(2, "2018-02-14T00:00:00Z", "2018-02-15T00:00:00Z"),
+                         raw_pull(1, "2017-12-01T00:00:00Z", "2018-01-01T00:00:00Z"),
+                         raw_pull(0, "2017-11-01T00:00:00Z", "2017-11-02T00:00:00Z")])
+        vsts.pull_request_max_page_size = 1
+        worker = PullRequestsWorker("Completed", vsts, 1, incremental=True)
+        vsts.crawl_state.set(worker.watermark_name("repo"), "2018-02-10T00:00:00Z")
+        saved = worker.crawl_repository(RecordingGraph(), "proj", "repo")
+        #pull request 3 was created long before the lookback but closed after the last crawl
+        self.assertEqual(saved, [3, 2, 1])
+        self.assertEqual(vsts.crawl_state[worker.watermark_name("repo")], "2018-03-01T00:00:00Z")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+import Repositories
+from Repositories import RepositoriesWorker
+from test_projects_teams_users import RecordingGraph
+
+class FakeVsts(object):
+    instance = "https://company.visualstudio.com"
+    api_version = "3.0"
+
+    def get_request_headers(self):
+        return {}
+
+    def make_request(self, url):
+        return {"value": [{"id": "r-1", "name": "repo", "url": "u",
+                           "project": {"id": "p-1", "name": "Proj", "url": "p"}}]}
+
+class FakeGraphBuilder(object):
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def GetNewGraph(self):
+        return self.graph
+
+class TestRepositories(unittest.TestCase):
+
+    def test_every_transaction_is_committed(self):
+        graph = RecordingGraph()
+        original = Repositories.GraphBuilder
+        Repositories.GraphBuilder = lambda: FakeGraphBuilder(graph)
+        try:
+            repo_ids = RepositoriesWorker(None, FakeVsts()).crawl("Proj")
+        finally:
+            Repositories.GraphBuilder = original
+        self.assertEqual(repo_ids, ["r-1"])
+        self.assertEqual(graph.begun, graph.committed)
+
+if __name__ == '__main__':
+    unittest.main()
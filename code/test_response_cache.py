@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+import unittest
+from CacheCodec import GzipCodec, PlainCodec
+from ResponseCache import (ShardedFileCache, SqliteCache, cache_key, normalize_url,
+                           legacy_file_name_to_url, migrate_legacy_cache, copy_cache,
+                           compression_report)
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_query_order_does_not_change_key(self):
+        first = cache_key("https://Company.visualstudio.com/a?foo=1&bar=2")
+        second = cache_key("https://company.visualstudio.com/a?bar=2&foo=1")
+        self.assertEqual(first, second)
+
+    def test_question_mark_and_ampersand_do_not_collide(self):
+        self.assertNotEqual(normalize_url("https://x/a?b=1&c=2"), normalize_url("https://x/a?b=1%26c=2"))
+
+    def test_put_then_get(self):
+        cache = ShardedFileCache(self.folder)
+        url = "https://company.visualstudio.com/a?foo=bar"
+        cache.put(url, {"value": [1, 2]})
+        entry = cache.get(url)
+        self.assertEqual(entry.data, {"value": [1, 2]})
+        self.assertEqual(entry.status, 200)
+
+    def test_files_are_sharded(self):
+        cache = ShardedFileCache(self.folder)
+        key = cache.put("https://company.visualstudio.com/a", {})
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, key[0:2], key[2:4], key + ".json")))
+
+    def test_index_survives_reload(self):
+        url = "https://company.visualstudio.com/a"
+        ShardedFileCache(self.folder).put(url, {}, fetched=123)
+        self.assertEqual(ShardedFileCache(self.folder).get(url).fetched, 123)
+
+    def test_touch_entries_written_by_another_process(self):
+        url = "https://company.visualstudio.com/a"
+        cache = ShardedFileCache(self.folder)
+        self.assertEqual(cache.index, {}) #loaded before the other process writes
+        ShardedFileCache(self.folder, GzipCodec()).put(url, {"a": 1}, fetched=1)
+        cache.touch(url, fetched=123)
+        self.assertEqual(cache.get(url).fetched, 123)
+        self.assertEqual(ShardedFileCache(self.folder).get(url).fetched, 123)
+        self.assertEqual(ShardedFileCache(self.folder).get(url).data, {"a": 1})
+
+    def test_gzip_entries_round_trip(self):
+        cache = ShardedFileCache(self.folder, GzipCodec())
+        url = "https://company.visualstudio.com/a"
+        key = cache.put(url, {"value": ["x"] * 100})
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, key[0:2], key[2:4], key + ".json.gz")))
+        self.assertEqual(ShardedFileCache(self.folder).get(url).data, {"value": ["x"] * 100})
+
+    def test_reads_plain_entries_after_switching_to_gzip(self):
+        url = "https://company.visualstudio.com/a"
+        ShardedFileCache(self.folder, PlainCodec()).put(url, {"a": 1})
+        self.assertEqual(ShardedFileCache(self.folder, GzipCodec()).get(url).data, {"a": 1})
+
+    def test_compression_report(self):
+        cache = ShardedFileCache(self.folder)
+        for number in range(5):
+            cache.put("https://company.visualstudio.com/" + str(number), {"value": ["same"] * 50})
+        results = compression_report(cache)
+        self.assertEqual(results[0][0], "none")
+        self.assertGreater(results[1][2], 1.0)
+
+    def test_keeps_validators_and_touch_renews(self):
+        cache = ShardedFileCache(self.folder)
+        url = "https://company.visualstudio.com/a"
+        cache.put(url, {}, fetched=1, etag='"abc"', last_modified="Mon, 01 Jan 2018 00:00:00 GMT")
+        cache.touch(url, fetched=50)
+        entry = ShardedFileCache(self.folder).get(url)
+        self.assertEqual(entry.etag, '"abc"')
+        self.assertEqual(entry.last_modified, "Mon, 01 Jan 2018 00:00:00 GMT")
+        self.assertEqual(entry.fetched, 50)
+
+    def test_missing_url_returns_none(self):
+        self.assertIsNone(ShardedFileCache(self.folder).get("https://company.visualstudio.com/nope"))
+
+    def test_legacy_file_name_to_url(self):
+        name = "vsts.DefaultCollection._apis.projects(qm)api-version=3.0.json"
+        url = legacy_file_name_to_url(name, "company.visualstudio.com", "vsts")
+        self.assertEqual(url, "https://company.visualstudio.com/DefaultCollection/_apis/projects?api-version=3.0")
+
+    def test_legacy_names_with_dotted_projects_are_skipped(self):
+        for name in ("vsts.DefaultCollection.My.Project._apis.git.repositories(qm)api-version=3.0.json",
+                     "vsts.My.Project._apis.git.repositories(qm)api-version=3.0.json"):
+            self.assertIsNone(legacy_file_name_to_url(name, "company.visualstudio.com", "vsts"))
+        name = "vsts.DefaultCollection.Proj._apis.git.repositories(qm)api-version=3.0.json"
+        self.assertEqual(legacy_file_name_to_url(name, "company.visualstudio.com", "vsts"),
+                         "https://company.visualstudio.com/DefaultCollection/Proj/_apis/git/repositories"
+                         "?api-version=3.0")
+
+    def test_migrate_legacy_cache(self):
+        name = "vsts.DefaultCollection._apis.projects(qm)api-version=3.0.json"
+        with open(os.path.join(self.folder, name), 'w') as legacy:
+            legacy.write('{"value": []}\n')
+        cache = ShardedFileCache(self.folder)
+        imported, skipped = migrate_legacy_cache(cache, self.folder, "company.visualstudio.com",
+                                                 "vsts", delete=True)
+        self.assertEqual((imported, skipped), (1, 0))
+        url = "https://company.visualstudio.com/DefaultCollection/_apis/projects?api-version=3.0"
+        self.assertEqual(cache.get(url).data, {"value": []})
+        self.assertFalse(os.path.isfile(os.path.join(self.folder, name)))
+
+class TestSqliteCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "responses.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_buffered_put_is_readable_before_flush(self):
+        cache = SqliteCache(self.path, batch_size=10)
+        url = "https://company.visualstudio.com/a"
+        cache.put(url, {"value": [1]})
+        self.assertEqual(cache.get(url).data, {"value": [1]})
+
+    def test_flushed_entries_survive_reopen(self):
+        url = "https://company.visualstudio.com/a"
+        cache = SqliteCache(self.path, batch_size=10)
+        cache.put(url, {"value": [1]}, fetched=123)
+        cache.flush()
+        entry = SqliteCache(self.path).get(url)
+        self.assertEqual(entry.data, {"value": [1]})
+        self.assertEqual(entry.fetched, 123)
+
+    def test_touch_renews_fetch_time(self):
+        url = "https://company.visualstudio.com/a"
+        cache = SqliteCache(self.path, batch_size=1)
+        cache.put(url, {"value": [1]}, fetched=1, etag='"abc"')
+        cache.touch(url, fetched=50)
+        entry = SqliteCache(self.path).get(url)
+        self.assertEqual((entry.fetched, entry.etag), (50, '"abc"'))
+
+    def test_gzip_bodies(self):
+        url = "https://company.visualstudio.com/a"
+        cache = SqliteCache(self.path, batch_size=1, codec=GzipCodec())
+        cache.put(url, {"value": [1]})
+        self.assertEqual(SqliteCache(self.path).get(url).data, {"value": [1]})
+
+    def test_copy_from_files(self):
+        files = ShardedFileCache(self.folder)
+        files.put("https://company.visualstudio.com/a", {"a": 1})
+        files.put("https://company.visualstudio.com/b", {"b": 2})
+        target = SqliteCache(self.path)
+        self.assertEqual(copy_cache(files, target), 2)
+        self.assertEqual(target.get("https://company.visualstudio.com/b").data, {"b": 2})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import Scheduler
+from Scheduler import chunks, run_task
+
+def double_task(item):
+    project_name, number = item
+    return project_name, [number * 2]
+
+def failing_task(item):
+    raise RuntimeError("vsts is down")
+
+def rate_share_task(item):
+    return item[0], [Scheduler._PROCESS["rate_share"]]
+
+def init_stub(pull_request_status, rate_share=1):
+    Scheduler._PROCESS["rate_share"] = rate_share
+
+class FlushCountingCache(object):
+    flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+class FakeVsts(object):
+
+    def __init__(self):
+        self.response_cache = FlushCountingCache()
+
+class TestScheduler(unittest.TestCase):
+
+    def test_chunks(self):
+        self.assertEqual(chunks(range(5), 2), [[0, 1], [2, 3], [4]])
+        self.assertEqual(chunks([], 2), [])
+
+    def test_run_task_hands_back_errors(self):
+        self.assertEqual(run_task((double_task, ("proj", 2))), ("proj", [4], None))
+        project_name, keys, error = run_task((failing_task, ("proj", 2)))
+        self.assertEqual(project_name, "proj")
+        self.assertIn("vsts is down", error)
+
+    def test_response_cache_is_flushed_after_every_task(self):
+        vsts = FakeVsts()
+        Scheduler._PROCESS["vsts"] = vsts
+        try:
+            run_task((double_task, ("proj", 2)))
+            run_task((failing_task, ("proj", 2)))
+        finally:
+            Scheduler._PROCESS.clear()
+        self.assertEqual(vsts.response_cache.flushes, 2)
+
+    def test_tasks_are_spread_over_processes(self):
+        scheduler = Scheduler.Scheduler(2)
+        scheduler.initializer = init_stub
+        results = scheduler.run("double", double_task, [("proj", number) for number in range(6)])
+        self.assertEqual(sorted(results["proj"]), [0, 2, 4, 6, 8, 10])
+        self.assertEqual(scheduler.tasks["double"], 6)
+        self.assertIn("double: 6 tasks", scheduler.summary())
+
+    def test_processes_split_the_request_budget(self):
+        scheduler = Scheduler.Scheduler(2, pools_at_once=2)
+        scheduler.initializer = init_stub
+        results = scheduler.run("share", rate_share_task, [("proj", number) for number in range(4)])
+        self.assertEqual(set(results["proj"]), {4})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from Schema import SchemaManager, plan_operators
+
+class FakeSchema(object):
+
+    def __init__(self):
+        self.constraints = {"Person": ["Id"]}
+        self.indexes = {"Person": ["Id"]}
+
+    def get_uniqueness_constraints(self, label):
+        return self.constraints.get(label, [])
+
+    def create_uniqueness_constraint(self, label, property_key):
+        if label == "Broken":
+            raise RuntimeError("duplicate values")
+        self.constraints.setdefault(label, []).append(property_key)
+
+    def get_indexes(self, label):
+        return self.indexes.get(label, [])
+
+    def create_index(self, label, property_key):
+        self.indexes.setdefault(label, []).append(property_key)
+
+class FakeCursor(object):
+
+    def __init__(self, plan):
+        self._plan = plan
+
+    def plan(self):
+        return self._plan
+
+class FakeGraph(object):
+
+    def __init__(self):
+        self.schema = FakeSchema()
+
+    def run(self, query, parameters=None):
+        if "Name" in query:
+            return FakeCursor({"operatorType": "ProduceResults",
+                               "children": [{"operatorType": "NodeByLabelScan"}]})
+        return FakeCursor({"operatorType": "ProduceResults",
+                           "children": [{"operatorType": "NodeUniqueIndexSeek"}]})
+
+class TestSchemaManager(unittest.TestCase):
+
+    def test_only_missing_items_are_created(self):
+        graph = FakeGraph()
+        manager = SchemaManager(graph, [("Person", "Id"), ("Project", "Id"), ("Broken", "Id")],
+                                [("Person", "Name")])
+        manager.apply()
+        self.assertEqual(manager.existing, ["constraint :Person(Id)"])
+        self.assertEqual(manager.created, ["constraint :Project(Id)", "index :Person(Name)"])
+        self.assertEqual(manager.failed[0][0], "constraint :Broken(Id)")
+        again = SchemaManager(graph, [("Person", "Id"), ("Project", "Id")], [("Person", "Name")])
+        again.apply()
+        self.assertEqual(again.created, [])
+        self.assertEqual(len(again.existing), 3)
+
+    def test_explain_flags_scans(self):
+        manager = SchemaManager(FakeGraph())
+        scanning = manager.explain([("by id", "MATCH (p:Person {Id: $id}) RETURN p", {"id": 1}),
+                                    ("by name", "MATCH (p:Person {Name: $n}) RETURN p", {"n": ""})])
+        self.assertEqual(scanning, ["by name"])
+
+    def test_plan_operators(self):
+        plan = {"operatorType": "ProduceResults@neo4j",
+                "children": [{"operatorType": "Filter", "children": [{"operatorType": "AllNodesScan"}]}]}
+        self.assertEqual(plan_operators(plan), ["ProduceResults", "Filter", "AllNodesScan"])
+        self.assertEqual(plan_operators(None), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import threading
+import unittest
+from StagedPipeline import StagedPipeline, RecordRows
+
+class ListWriter(object):
+
+    def __init__(self, fail_on=None):
+        self.rows = []
+        self.records = 0
+        self.units = []
+        self.flushed = False
+        self.fail_on = fail_on
+        self.threads = set()
+
+    def add(self, name, row):
+        if row == self.fail_on:
+            raise RuntimeError("neo4j is down")
+        self.threads.add(threading.current_thread().name)
+        self.rows.append((name, row))
+
+    def record_done(self, unit=None):
+        self.records += 1
+        self.units.append(unit)
+
+    def flush(self):
+        self.flushed = True
+
+def map_twice(writer, item):
+    writer.add("nodes", item)
+    writer.add("links", item)
+    writer.record_done(item)
+
+class TestStagedPipeline(unittest.TestCase):
+
+    def test_everything_is_fetched_mapped_and_written(self):
+        writer = ListWriter()
+        pipeline = StagedPipeline(lambda item: item * 10, map_twice, writer,
+                                  fetch_workers=3, map_workers=2, queue_size=2)
+        pipeline.run(range(20))
+        self.assertTrue(writer.flushed)
+        self.assertEqual(writer.records, 20)
+        self.assertEqual(sorted(row for name, row in writer.rows if name == "nodes"),
+                         [item * 10 for item in range(20)])
+        #only the write thread touches the writer
+        self.assertEqual(writer.threads, {"write-0"})
+        self.assertIn("fetch queue", pipeline.summary())
+
+    def test_already_fetched_items_skip_the_fetch_stage(self):
+        writer = ListWriter()
+        with StagedPipeline(None, map_twice, writer, queue_size=1) as pipeline:
+            for item in range(5):
+                pipeline.put(item)
+        self.assertEqual(writer.records, 5)
+        self.assertEqual(writer.units, [0, 1, 2, 3, 4])
+        self.assertNotIn("fetch queue", pipeline.summary())
+
+    def test_stage_error_is_raised_and_nothing_is_flushed(self):
+        writer = ListWriter(fail_on=30)
+        pipeline = StagedPipeline(lambda item: item * 10, map_twice, writer, queue_size=1)
+        with self.assertRaises(RuntimeError):
+            pipeline.run(range(100))
+        self.assertFalse(writer.flushed)
+
+    def test_record_rows_keeps_order(self):
+        rows = RecordRows()
+        map_twice(rows, 1)
+        self.assertEqual(rows.rows, [("nodes", 1), ("links", 1)])
+
+if __name__ == '__main__':
+    unittest.main()
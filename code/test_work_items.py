@@ -0,0 +1,58 @@
+import urllib.error
+import unittest
+from WorkItems import PullReqeustWorkItemsWorker
+
+class FakeVsts(object):
+    """
+    fails every batch request with batch_status, single work items are found unless listed as gone
+    """
+
+    def __init__(self, batch_status, gone=(), load_from_source=False):
+        self.batch_status = batch_status
+        self.gone = set(gone)
+        self.load_from_source = load_from_source
+        self.written = []
+
+    def get_fresh_data(self, url):
+        return None
+
+    def prefetch(self, urls, write_to_file=True, timings=None):
+        pass
+
+    def make_request(self, url, write_to_file=True, timings=None):
+        if "ids=" in url:
+            raise urllib.error.HTTPError(url, self.batch_status, "failed", {}, None)
+        work_item_id = url.split("/workitems/")[1].split("?")[0]
+        if work_item_id in self.gone:
+            raise urllib.error.HTTPError(url, 404, "not found", {}, None)
+        return {"id": int(work_item_id), "fields": {}}
+
+    def write_data(self, url, data, headers=None):
+        self.written.append(url)
+
+def make_worker(vsts):
+    return PullReqeustWorkItemsWorker({"instance": "https://company.visualstudio.com",
+                                       "api_version": "3.0", "headers": {}}, vsts)
+
+class TestHydrate(unittest.TestCase):
+
+    def test_missing_ids_fall_back_to_single_fetches(self):
+        vsts = FakeVsts(404, gone=["2"])
+        worker = make_worker(vsts)
+        worker.hydrate([1, 2, 3])
+        self.assertEqual(worker.get_raw_work_item(1)["id"], 1)
+        self.assertIsNone(worker.get_raw_work_item(2))
+        self.assertEqual(len(vsts.written), 2)
+
+    def test_throttling_and_server_errors_are_raised(self):
+        for status in (429, 500):
+            with self.assertRaises(urllib.error.HTTPError):
+                make_worker(FakeVsts(status)).hydrate([1, 2])
+
+    def test_nothing_is_cached_when_ignoring_the_cache(self):
+        vsts = FakeVsts(400, load_from_source=True)
+        make_worker(vsts).hydrate([1, 2])
+        self.assertEqual(vsts.written, [])
+
+if __name__ == '__main__':
+    unittest.main()